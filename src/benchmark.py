@@ -0,0 +1,258 @@
+"""
+基準測試腳本
+以本地建立的迷你隨機 SD 管道 (不需下載、不需 GPU)，經由 ModelManager / ImageGenerator
+量測不同解析度、步數、批次大小、執行緒數與優化開關下的延遲與吞吐量，並輸出 JSON 結果以便跨 commit 比較
+
+用法:
+    PYTHONPATH=$(pwd) python src/benchmark.py --quick
+    PYTHONPATH=$(pwd) python src/benchmark.py --compare outputs/benchmarks/舊結果.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+
+import torch
+
+from src.core.config_manager import Config
+from src.core.model_manager import ModelManager
+from src.core.image_generator import ImageGenerator
+from src.core import metrics
+
+# 優化開關組合：default 為模型預設值，legacy 明確關閉 CPU 加速 (目前的預設值也是關閉)，其餘只開啟單一項目
+_ALL_OFF = {"attention_slicing": False, "cpu_offload": False, "xformers": False, "vae_slicing": False, "vae_tiling": False, "cpu_profile": False}
+OPTIMIZATION_PROFILES = {
+    "default": {},
+    "legacy": {"cpu_profile": False},
+    "none": dict(_ALL_OFF),
+    "attention_slicing": {**_ALL_OFF, "attention_slicing": True},
+    "vae_tiling": {**_ALL_OFF, "vae_slicing": True, "vae_tiling": True},
+    "cpu_offload": {**_ALL_OFF, "cpu_offload": True},
+    "cpu_profile": {**_ALL_OFF, "cpu_profile": True},
+    "cpu_compile": {**_ALL_OFF, "cpu_profile": True},
+    "onnx": {**_ALL_OFF, "cpu_profile": True},
+}
+# LoRA 模式：adapter 以 PEFT adapter 推理，fused 融合進基礎權重 (迷你模型使用隨機 LoRA)
+LORA_MODES = ("none", "adapter", "fused")
+BENCHMARK_LORA = "benchmark_lora.safetensors"
+
+# 組合對應的 cpu_acceleration 覆寫 (執行緒數由 --threads 控制)
+CPU_ACCELERATION_PROFILES = {
+    "cpu_compile": {"compile": True},
+}
+
+def _int_list(value):
+    return [int(item) for item in value.split(",") if item.strip()]
+
+def _str_list(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="迷你隨機 SD 管道基準測試")
+    parser.add_argument("--model", default="TinyRandomSdModel", help="模型類別名稱 (預設為不需下載的迷你隨機模型)")
+    parser.add_argument("--resolutions", type=_int_list, default=[256, 512], help="正方形解析度列表，例如 256,512")
+    parser.add_argument("--steps", type=_int_list, default=[4, 8], help="步數列表")
+    parser.add_argument("--batch-sizes", type=_int_list, default=[1, 2], help="批次大小列表")
+    parser.add_argument("--threads", type=_int_list, default=[torch.get_num_threads()], help="torch 執行緒數列表")
+    parser.add_argument("--profiles", type=_str_list, default=["legacy", "default"],
+                        help=f"優化開關組合: {', '.join(OPTIMIZATION_PROFILES)}")
+    parser.add_argument("--lora-modes", type=_str_list, default=["none"],
+                        help=f"LoRA 模式列表: {', '.join(LORA_MODES)} (none 表示不使用 LoRA)")
+    parser.add_argument("--repeats", type=int, default=3, help="每組設定的量測次數")
+    parser.add_argument("--warmup", type=int, default=1, help="每組設定的預熱次數 (不計入結果)")
+    parser.add_argument("--quick", action="store_true", help="最小組合：256、4 步、批次 1、default 優化")
+    parser.add_argument("--output", default=None, help="結果 JSON 路徑 (預設 outputs/benchmarks/)")
+    parser.add_argument("--compare", default=None, help="與先前的結果 JSON 比較並印出差異")
+    args = parser.parse_args()
+    if args.quick:
+        args.resolutions, args.steps, args.batch_sizes, args.profiles = [256], [4], [1], ["default"]
+        args.repeats = min(args.repeats, 2)
+    unknown = [name for name in args.profiles if name not in OPTIMIZATION_PROFILES]
+    if unknown:
+        parser.error(f"未知的優化組合: {', '.join(unknown)}")
+    unknown = [name for name in args.lora_modes if name not in LORA_MODES]
+    if unknown:
+        parser.error(f"未知的 LoRA 模式: {', '.join(unknown)}")
+    return args
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def _environment():
+    try:
+        import diffusers
+        diffusers_version = diffusers.__version__
+    except Exception:
+        diffusers_version = None
+    return {
+        "git_commit": _git_commit(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "torch": torch.__version__,
+        "diffusers": diffusers_version,
+        "cuda": torch.cuda.is_available(),
+    }
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+def _build_config(model_name, profile, lora_mode="none"):
+    """基準測試用的設定：迷你模型、文字生成圖像、同步的 matte 去背"""
+    config = Config()
+    config.config = {
+        **config.config,
+        'model': model_name,
+        'optimizations': OPTIMIZATION_PROFILES[profile],
+        'cpu_acceleration': {
+            **(config.get('cpu_acceleration', {}) or {}),
+            'intra_op_threads': None,
+            **CPU_ACCELERATION_PROFILES.get(profile, {}),
+        },
+        'original_image': {},
+        'model_manager': {
+            'resident_base': True,
+            'lora_swap_mode': 'keep',
+            'lora_mode': 'fused' if lora_mode == "fused" else 'adapter',
+        },
+        'background_removal': {**(config.get('background_removal', {}) or {}), 'backend': 'matte'},
+        'postprocess': {**(config.get('postprocess', {}) or {}), 'workers': 0},
+        'profiling': {'enabled': False},
+        'onnx_runtime': {**(config.get('onnx_runtime', {}) or {}), 'enabled': profile == "onnx"},
+        # 基準測試的輸出在暫存目錄，不寫入正式的輸出清單
+        'manifest': {'enabled': False},
+    }
+    return config
+
+def run_case(model_manager, config, output_dir, resolution, steps, batch_size, repeats, warmup, weight_name=None):
+    """量測單一組設定，返回延遲與各階段耗時"""
+    pipe = model_manager.get_pipeline(weight_name)
+    generator = ImageGenerator(config, pipe, weight_name or "benchmark")
+    generator.height = generator.width = resolution
+    prompt, negative_prompt = generator.resolve_prompts()
+    items = [
+        {"prompt": prompt, "negative_prompt": negative_prompt, "seed": 1000 + index}
+        for index in range(batch_size)
+    ]
+
+    for _ in range(warmup):
+        generator.generate_batch_api(steps, output_dir, items)
+
+    latencies = []
+    stage_totals = {}
+    for _ in range(repeats):
+        with metrics.collect_timings():
+            start = time.perf_counter()
+            futures = generator.generate_batch_async(steps, output_dir, items)
+            for future in futures:
+                future.result()
+            latencies.append(time.perf_counter() - start)
+            for stage, seconds in futures[0].stage_timings.as_dict().items():
+                stage_totals.setdefault(stage, []).append(seconds)
+
+    stage_means = {stage: statistics.mean(values) for stage, values in stage_totals.items()}
+    denoise = stage_means.get("denoise", stage_means.get("denoise_and_decode"))
+    return {
+        "latency_seconds": latencies,
+        "mean_seconds": statistics.mean(latencies),
+        "p50_seconds": _percentile(latencies, 0.50),
+        "p95_seconds": _percentile(latencies, 0.95),
+        "images_per_second": batch_size * len(latencies) / sum(latencies),
+        "stage_timings_mean": stage_means,
+        # 每步去噪耗時 (LoRA adapter / 融合模式的差異主要出現在這裡)
+        "per_step_seconds": denoise / steps if denoise is not None else None,
+    }
+
+def _case_key(result):
+    return (result["profile"], result.get("lora_mode", "none"), result["height"], result["width"], result["steps"], result["batch_size"], result["threads"])
+
+def compare(previous_path, results):
+    """與先前的結果比較平均延遲，正值表示變慢"""
+    with open(previous_path, "r", encoding="utf-8") as f:
+        previous = {_case_key(result): result for result in json.load(f)["results"]}
+    print(f"\n--- 與 {previous_path} 比較 (平均延遲) ---")
+    for result in results:
+        old = previous.get(_case_key(result))
+        if old is None:
+            continue
+        change = (result["mean_seconds"] - old["mean_seconds"]) / old["mean_seconds"] * 100
+        flag = "⚠️" if change > 10 else "  "
+        print(f"{flag} {_case_key(result)}: {old['mean_seconds']:.3f}s -> {result['mean_seconds']:.3f}s ({change:+.1f}%)")
+
+def main():
+    args = parse_args()
+    os.environ.setdefault("FORCE_CPU", "true")
+    output_dir = tempfile.mkdtemp(prefix="mushroom_benchmark_")
+    results = []
+    original_threads = torch.get_num_threads()
+
+    try:
+        for profile in args.profiles:
+            for lora_mode in args.lora_modes:
+                config = _build_config(args.model, profile, lora_mode)
+                weight_name = None if lora_mode == "none" else BENCHMARK_LORA
+                # 每個優化組合 / LoRA 模式重新建立管道 (優化在加載時套用)
+                ImageGenerator._postprocessor = None
+                ImageGenerator._manifest = None
+                model_manager = ModelManager(config)
+                setup_start = time.perf_counter()
+                model_manager.load_base_pipeline()
+                setup_seconds = time.perf_counter() - setup_start
+
+                for threads in args.threads:
+                    torch.set_num_threads(threads)
+                    for resolution in args.resolutions:
+                        for steps in args.steps:
+                            for batch_size in args.batch_sizes:
+                                print(f"--- [Benchmark] {profile} | LoRA {lora_mode} | {resolution}x{resolution} | {steps} 步 | 批次 {batch_size} | {threads} 執行緒 ---", flush=True)
+                                case = run_case(
+                                    model_manager, config, output_dir, resolution, steps, batch_size,
+                                    args.repeats, args.warmup, weight_name
+                                )
+                                case.update({
+                                    "profile": profile,
+                                    "lora_mode": lora_mode,
+                                    "optimizations": model_manager.model_instance.optimizations,
+                                    "cpu_acceleration": model_manager.cpu_accelerator.applied,
+                                    "height": resolution,
+                                    "width": resolution,
+                                    "steps": steps,
+                                    "batch_size": batch_size,
+                                    "threads": threads,
+                                    "pipeline_setup_seconds": setup_seconds,
+                                })
+                                results.append(case)
+                                per_step = f"，每步 {case['per_step_seconds'] * 1000:.1f}ms" if case["per_step_seconds"] is not None else ""
+                                print(f"✅ 平均 {case['mean_seconds']:.3f}s，p95 {case['p95_seconds']:.3f}s，{case['images_per_second']:.2f} 張/秒{per_step}", flush=True)
+    finally:
+        torch.set_num_threads(original_threads)
+        ImageGenerator.get_postprocessor(_build_config(args.model, "default")).shutdown()
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    report = {"environment": _environment(), "settings": vars(args), "results": results}
+    output_path = args.output or os.path.join(
+        "outputs", "benchmarks", f"benchmark_{report['environment']['git_commit'] or 'local'}_{int(time.time())}.json"
+    )
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"✅ 基準測試結果已寫入: {output_path}")
+
+    if args.compare:
+        compare(args.compare, results)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
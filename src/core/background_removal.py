@@ -0,0 +1,186 @@
+"""
+去背模塊
+提供多種去背後端：純色背景的向量化遮罩 (matte) 與 rembg (U2Net)，並依背景均勻度自動選擇
+"""
+import time
+import threading
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+print("--- [BackgroundRemover] 模塊開始被導入... ---", flush=True)
+
+
+class BackgroundRemover:
+    """
+    去背處理器。
+    - matte: 以邊框像素估計背景色，從邊框做洪水填充找出與邊框相連的背景區域，
+      依顏色距離產生漸變 alpha 並羽化邊緣，完全以 NumPy 向量化運算，不需要 U2Net。
+    - rembg: 原本的 U2Net 路徑，直接傳入 PIL 圖像，不再經過 PNG 編碼 / 解碼。
+    - auto: 先以邊框像素檢查背景是否均勻，均勻時使用 matte，否則使用 rembg。
+    """
+    BACKENDS = ("auto", "matte", "rembg")
+
+    def __init__(self, backend="rembg", rembg_model="u2net", border_width=4,
+                 uniformity_threshold=18.0, tolerance_low=18.0, tolerance_high=48.0,
+                 feather_radius=1.0, min_foreground_ratio=0.02, max_foreground_ratio=0.95):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"未知的去背後端: {backend}，可用: {', '.join(self.BACKENDS)}")
+        self.backend = backend
+        self.rembg_model = rembg_model
+        self.border_width = max(1, int(border_width))
+        self.uniformity_threshold = float(uniformity_threshold)
+        self.tolerance_low = float(tolerance_low)
+        self.tolerance_high = max(float(tolerance_high), self.tolerance_low + 1.0)
+        self.feather_radius = float(feather_radius)
+        self.min_foreground_ratio = float(min_foreground_ratio)
+        self.max_foreground_ratio = float(max_foreground_ratio)
+        self._rembg_session = None
+        self._lock = threading.Lock()
+        self._timings = {}  # 後端 -> {"count", "total_seconds"}
+
+    @classmethod
+    def from_config(cls, config):
+        """從設定檔的 background_removal 區塊建立去背處理器"""
+        removal_config = dict(config.get('background_removal', {}) or {})
+        return cls(**removal_config)
+
+    # ------------------------------------------------------------------
+    # 公開介面
+    # ------------------------------------------------------------------
+    def remove(self, image):
+        """去背並返回 (RGBA 圖像, 實際使用的後端)"""
+        result, backend, _ = self.remove_with_info(image)
+        return result, backend
+
+    def remove_with_info(self, image):
+        """
+        去背並返回 (RGBA 圖像, 實際使用的後端, matte 被拒絕時花費的秒數或 None)。
+        後處理在獨立程序中執行，拒絕的次數與耗時需隨結果返回給父程序記錄，不能只留在此處理器的統計中。
+        """
+        rgb = np.asarray(image.convert("RGB"))
+        backend = self.backend
+        if backend == "auto":
+            backend = self.choose_backend(rgb)
+
+        if backend == "matte":
+            start = time.perf_counter()
+            result = self._matte(rgb)
+            if result is not None:
+                self._record("matte", time.perf_counter() - start)
+                return result, "matte", None
+            # 遮罩結果不合理 (前景過少或過多)，改用 rembg
+            matte_rejected_seconds = time.perf_counter() - start
+            self._record("matte_rejected", matte_rejected_seconds)
+        else:
+            matte_rejected_seconds = None
+
+        start = time.perf_counter()
+        result = self._rembg(image)
+        self._record("rembg", time.perf_counter() - start)
+        return result, "rembg", matte_rejected_seconds
+
+    def choose_backend(self, rgb):
+        """以邊框像素與背景色的距離判斷背景是否均勻"""
+        background, border_distance = self._border_statistics(rgb)
+        return "matte" if np.percentile(border_distance, 95) <= self.uniformity_threshold else "rembg"
+
+    def stats(self):
+        """返回各後端的次數與平均耗時"""
+        with self._lock:
+            return {
+                backend: {
+                    "count": timing["count"],
+                    "total_seconds": timing["total_seconds"],
+                    "average_seconds": timing["total_seconds"] / timing["count"] if timing["count"] else 0.0,
+                }
+                for backend, timing in self._timings.items()
+            }
+
+    # ------------------------------------------------------------------
+    # matte 後端
+    # ------------------------------------------------------------------
+    def _border_statistics(self, rgb):
+        b = self.border_width
+        border = np.concatenate([
+            rgb[:b].reshape(-1, 3), rgb[-b:].reshape(-1, 3),
+            rgb[:, :b].reshape(-1, 3), rgb[:, -b:].reshape(-1, 3),
+        ]).astype(np.float32)
+        background = np.median(border, axis=0)
+        return background, np.abs(border - background).max(axis=1)
+
+    def _matte(self, rgb):
+        background, _ = self._border_statistics(rgb)
+        # 以各通道最大差值作為顏色距離 (比歐氏距離便宜，且對純色背景足夠)
+        distance = np.abs(rgb.astype(np.float32) - background).max(axis=2)
+        candidate = distance < self.tolerance_high
+
+        background_region = self._flood_from_border(candidate)
+
+        # 背景區域內依距離線性漸變，其他區域 (含與邊框不相連的同色區域，例如白點) 保持不透明
+        ramp = np.clip((distance - self.tolerance_low) / (self.tolerance_high - self.tolerance_low), 0.0, 1.0)
+        alpha = np.where(background_region, ramp, 1.0)
+
+        foreground_ratio = float((alpha > 0.5).mean())
+        if not (self.min_foreground_ratio <= foreground_ratio <= self.max_foreground_ratio):
+            return None
+
+        alpha_image = Image.fromarray((alpha * 255.0 + 0.5).astype(np.uint8), mode="L")
+        if self.feather_radius > 0:
+            alpha_image = alpha_image.filter(ImageFilter.GaussianBlur(self.feather_radius))
+
+        output = Image.fromarray(rgb, mode="RGB").convert("RGBA")
+        output.putalpha(alpha_image)
+        return output
+
+    @staticmethod
+    def _flood_from_border(candidate):
+        """找出 candidate 中與圖像邊框相連的區域 (4 連通)"""
+        try:
+            import cv2
+            count, labels = cv2.connectedComponents(candidate.astype(np.uint8), connectivity=4)
+            border_labels = np.unique(np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]]))
+            border_labels = border_labels[border_labels != 0]
+            return np.isin(labels, border_labels) & candidate
+        except ImportError:
+            pass
+
+        # 沒有 OpenCV 時以向量化的反覆膨脹實作洪水填充
+        reached = np.zeros_like(candidate)
+        reached[0], reached[-1] = candidate[0], candidate[-1]
+        reached[:, 0], reached[:, -1] = candidate[:, 0], candidate[:, -1]
+        while True:
+            previous = reached
+            for _ in range(16):
+                grown = reached.copy()
+                grown[1:] |= reached[:-1]
+                grown[:-1] |= reached[1:]
+                grown[:, 1:] |= reached[:, :-1]
+                grown[:, :-1] |= reached[:, 1:]
+                reached = grown & candidate
+            if np.array_equal(reached, previous):
+                return reached
+
+    # ------------------------------------------------------------------
+    # rembg 後端
+    # ------------------------------------------------------------------
+    def _rembg(self, image):
+        from rembg import remove, new_session
+        with self._lock:
+            if self._rembg_session is None:
+                print(f"--- [BackgroundRemover] 初始化 rembg session ({self.rembg_model})... ---", flush=True)
+                self._rembg_session = new_session(self.rembg_model)
+            session = self._rembg_session
+        # 直接傳入 PIL 圖像，rembg 返回 PIL 圖像，不經過 PNG 編碼 / 解碼
+        result = remove(image, session=session)
+        if isinstance(result, np.ndarray):
+            result = Image.fromarray(result)
+        return result
+
+    def _record(self, backend, seconds):
+        with self._lock:
+            timing = self._timings.setdefault(backend, {"count": 0, "total_seconds": 0.0})
+            timing["count"] += 1
+            timing["total_seconds"] += seconds
+
+print("--- [BackgroundRemover] 模塊已成功被定義。---", flush=True)
@@ -0,0 +1,198 @@
+"""
+CPU 推理加速模塊
+裝置為 CPU 時取代 GPU 取向的優化：UNet 以 bf16 autocast 執行 (僅限原生支援 bf16 的 CPU)、
+UNet 與 VAE 使用 channels_last 記憶體格式、明確設定 intra / inter-op 執行緒數，
+並可選擇以 torch.compile 編譯 UNet，編譯結果快取在磁碟上，重啟後直接重用
+"""
+import os
+import threading
+
+import torch
+
+print("--- [CpuAccelerator] 模塊開始被導入... ---", flush=True)
+
+# 具備原生 bf16 運算指令的 CPU 旗標 (AVX512-BF16 / AMX)；沒有時 bf16 只是模擬，反而比 fp32 慢
+BF16_CPU_FLAGS = ("avx512_bf16", "amx_bf16")
+
+
+def _cpu_flags():
+    """讀取 /proc/cpuinfo 的 CPU 旗標 (非 Linux 時返回空集合)"""
+    try:
+        with open("/proc/cpuinfo", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    return set(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return set()
+
+
+def native_bf16_supported():
+    """CPU 是否原生支援 bf16 運算"""
+    return bool(_cpu_flags() & set(BF16_CPU_FLAGS))
+
+
+def available_cpus():
+    """
+    實際可用的 CPU 數：考慮 CPU 親和性與 cgroup (容器) 配額。
+    torch 預設依主機核心數開執行緒，在有配額的容器 (例如 Render) 中會超額使用而變慢。
+    """
+    try:
+        count = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        count = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max", "r", encoding="utf-8") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            count = min(count, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return max(1, count)
+
+
+def _cast_unet_output(output):
+    """把 autocast 下的 UNet 輸出轉回 fp32，scheduler 的計算維持原本的精度"""
+    if isinstance(output, tuple):
+        return (output[0].float(), *output[1:])
+    if hasattr(output, "sample"):
+        output.sample = output.sample.float()
+    return output
+
+
+class CpuAccelerator:
+    """
+    CPU 推理加速設定。
+    在 BaseModel.optimize_pipeline 中對裝置為 CPU 的管道套用 (optimizations.cpu_profile 開啟時)。
+    bf16 autocast 只包住 UNet：txt2img 與共用組件的 img2img 管道都會生效，VAE 維持 fp32 以保留畫質。
+    """
+    def __init__(self, bf16="auto", channels_last=True, intra_op_threads="auto", inter_op_threads=None,
+                 compile_unet=False, compile_mode="max-autotune-no-cudagraphs", compile_cache_dir="outputs/.torch_compile_cache"):
+        self.bf16 = bf16
+        self.channels_last = bool(channels_last)
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.compile_unet = bool(compile_unet)
+        self.compile_mode = compile_mode
+        self.compile_cache_dir = compile_cache_dir
+        self._lock = threading.Lock()
+        self._threads_configured = False
+        self.applied = {}
+
+    @classmethod
+    def from_config(cls, config):
+        """從設定檔的 cpu_acceleration 區塊建立加速設定"""
+        cpu_config = config.get('cpu_acceleration', {}) or {}
+        return cls(
+            bf16=cpu_config.get('bf16', 'auto'),
+            channels_last=cpu_config.get('channels_last', True),
+            intra_op_threads=cpu_config.get('intra_op_threads', 'auto'),
+            inter_op_threads=cpu_config.get('inter_op_threads'),
+            compile_unet=cpu_config.get('compile', False),
+            compile_mode=cpu_config.get('compile_mode', 'max-autotune-no-cudagraphs'),
+            compile_cache_dir=cpu_config.get('compile_cache_dir', 'outputs/.torch_compile_cache')
+        )
+
+    def use_bf16(self):
+        """bf16: auto 時只在 CPU 原生支援 bf16 時開啟"""
+        if self.bf16 == "auto":
+            return native_bf16_supported()
+        return bool(self.bf16)
+
+    def configure_threads(self):
+        """設定 intra / inter-op 執行緒數 (整個程序只設定一次)"""
+        with self._lock:
+            if self._threads_configured:
+                return
+            self._threads_configured = True
+        intra = available_cpus() if self.intra_op_threads == "auto" else self.intra_op_threads
+        if intra:
+            torch.set_num_threads(int(intra))
+        if self.inter_op_threads:
+            try:
+                torch.set_interop_threads(int(self.inter_op_threads))
+            except RuntimeError as e:
+                # 已開始平行運算後不能再設定，維持目前的值
+                print(f"⚠️ 無法設定 inter-op 執行緒數: {e}")
+        self.applied["intra_op_threads"] = torch.get_num_threads()
+        self.applied["inter_op_threads"] = torch.get_num_interop_threads()
+        print(f"✅ CPU 執行緒: intra-op {self.applied['intra_op_threads']}，inter-op {self.applied['inter_op_threads']}")
+
+    def apply(self, pipe, compile_unet=None):
+        """對已移至 CPU 的管道套用加速設定；compile_unet 可覆寫設定 (例如 UNet 改由 ONNX Runtime 執行時不編譯)"""
+        self.configure_threads()
+        unet = getattr(pipe, "unet", None)
+        vae = getattr(pipe, "vae", None)
+
+        if self.channels_last:
+            for module in (unet, vae):
+                if module is not None:
+                    module.to(memory_format=torch.channels_last)
+            self.applied["channels_last"] = True
+            print("✅ UNet / VAE 已使用 channels_last 記憶體格式")
+
+        if unet is not None and self.use_bf16():
+            self._autocast_unet(unet)
+            self.applied["bf16_autocast"] = True
+            print("✅ UNet 已啟用 bf16 autocast")
+        else:
+            self.applied["bf16_autocast"] = False
+
+        if unet is not None and (self.compile_unet if compile_unet is None else compile_unet):
+            self.applied["compiled"] = self._compile(unet)
+        return pipe
+
+    @staticmethod
+    def _autocast_unet(unet):
+        """以 bf16 autocast 包住 UNet 的 forward (權重維持 fp32，LoRA adapter 照常切換)"""
+        if getattr(unet, "_cpu_autocast_dtype", None) is not None:
+            return
+        forward = unet.forward
+
+        def autocast_forward(*args, **kwargs):
+            with torch.autocast("cpu", dtype=torch.bfloat16):
+                output = forward(*args, **kwargs)
+            return _cast_unet_output(output)
+
+        unet.forward = autocast_forward
+        unet._cpu_autocast_dtype = torch.bfloat16
+
+    def _compile(self, unet):
+        """
+        以 torch.compile 就地編譯 UNet (模組本身不變，快取與 LoRA 切換照常運作)。
+        Inductor 的 FX graph 快取寫在 compile_cache_dir，重啟後相同形狀不需重新編譯；
+        實際編譯發生在第一次推理。
+        """
+        if not hasattr(unet, "compile"):
+            print("⚠️ 此 torch 版本不支援 nn.Module.compile，略過 UNet 編譯")
+            return False
+        try:
+            if self.compile_cache_dir:
+                os.makedirs(self.compile_cache_dir, exist_ok=True)
+                os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(self.compile_cache_dir))
+                os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+                import torch._inductor.config as inductor_config
+                if hasattr(inductor_config, "fx_graph_cache"):
+                    inductor_config.fx_graph_cache = True
+            unet.compile(mode=self.compile_mode)
+            print(f"✅ UNet 已設定 torch.compile ({self.compile_mode})，快取目錄: {self.compile_cache_dir}")
+            return True
+        except Exception as e:
+            print(f"⚠️ torch.compile 不可用，改用未編譯的 UNet: {e}")
+            return False
+
+    def stats(self):
+        return {
+            "bf16": self.bf16,
+            "native_bf16": native_bf16_supported(),
+            "channels_last": self.channels_last,
+            "intra_op_threads": self.intra_op_threads,
+            "inter_op_threads": self.inter_op_threads,
+            "available_cpus": available_cpus(),
+            "compile": self.compile_unet,
+            "compile_mode": self.compile_mode,
+            "compile_cache_dir": self.compile_cache_dir,
+            "applied": dict(self.applied),
+        }
+
+print("--- [CpuAccelerator] 模塊已成功被定義。---", flush=True)
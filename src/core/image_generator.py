@@ -9,21 +9,36 @@ import torch
 # from rembg import remove  <--- [最終修正] 從頂部移除！
 from PIL import Image
 import time
+import inspect
 import numpy as np
-from io import BytesIO
-import gc
+from concurrent.futures import Future
+
+from src.core import metrics
+from src.core.output_manifest import perceptual_hash
 
 print("--- [ImageGenerator] 模塊開始被導入... ---", flush=True)
 
 class ImageGenerator:
-    # 類別變數：共享 rembg 模型，避免重複載入
-    _rembg_session = None
+    # 類別變數：共享後處理器 (各工作程序持有自己的 rembg session)
+    _postprocessor = None
+    # 類別變數：共享記憶體策略
+    _memory_policy = None
+    # 類別變數：共享剖析器 (頻率上限跨請求生效)
+    _profiler = None
+    # 類別變數：共享提示詞嵌入快取
+    _prompt_cache = None
+    # 類別變數：共享參考圖像 latents 快取
+    _latent_cache = None
+    # 類別變數：共享輸出清單 (False 表示設定檔停用)
+    _manifest = None
     
     # __init__ 和其他方法保持不變...
-    def __init__(self, config, pipe, weight_name):
+    def __init__(self, config, pipe, weight_name, img2img_pipe=None):
         print("--- [ImageGenerator] __init__ 開始執行... ---", flush=True)
         self.config = config
         self.pipe = pipe
+        # 與 pipe 共用組件的 img2img 管道，有參考圖像時使用
+        self.img2img_pipe = img2img_pipe
         self.weight_name = weight_name
         self.prompt = config.get('prompt_template', '')
         self.negative_prompt = config.get('negative_prompt', '')
@@ -36,29 +51,92 @@ class ImageGenerator:
         self.guidance_scale = parameters.get('guidance_scale', 7.5)
         self.strength = parameters.get('strength', 0.75)
         self.noise_level = parameters.get('noise_level', 0.0)
+        self.original_image_path = None
         self.original_image, self.original_image_name = self._load_original_image()
+        self.lora_scale = 1.0
+        # 記錄在輸出清單中的 scheduler 名稱，未指定時使用管道 scheduler 的類別名稱
+        self.scheduler_name = None
+        # 明確要求剖析 (請求旗標或 CLI --profile)，仍受剖析器的頻率上限約束
+        self.profile_requested = False
+        self.last_profile = None
+        self.prompt_cache = self.get_prompt_cache(config)
         print("--- [ImageGenerator] __init__ 完成。 ---", flush=True)
     
+    @classmethod
+    def get_prompt_cache(cls, config):
+        """取得共享的提示詞嵌入快取，設定檔停用時返回 None"""
+        cache_config = config.get('prompt_cache', {}) or {}
+        if not cache_config.get('enabled', True):
+            return None
+        if cls._prompt_cache is None:
+            from src.core.prompt_cache import PromptEmbeddingCache
+            cls._prompt_cache = PromptEmbeddingCache(cache_config.get('max_entries', 256))
+        return cls._prompt_cache
+    
+    def warmup_prompt_cache(self):
+        """預先計算所有動作 × 表情組合、提示詞範本與負向提示詞的嵌入"""
+        if self.prompt_cache is None or not self.prompt_cache.supports(self.pipe):
+            return 0
+        from src.utils.prompts import get_all_character_prompts
+        prompts = get_all_character_prompts() + [self.config.get('prompt_template', ''), self.negative_prompt]
+        encoded = self.prompt_cache.warmup(self.pipe, prompts, self.weight_name, self.lora_scale)
+        print(f"--- [ImageGenerator] 提示詞嵌入預熱完成，新編碼 {encoded} 條 ---", flush=True)
+        return encoded
+    
     # ... 省略其他沒有變動的方法，以保持簡潔 ...
     # 您可以只修改 _process_image 方法，或者直接用這整段覆蓋
     
-    def _load_original_image(self):
-        original_image_config = self.config.get('original_image', {})
+    @staticmethod
+    def reference_image_path(config):
+        """設定中實際會被使用的參考圖像路徑 (original_image.path 且檔案存在)，沒有時返回 None"""
+        original_image_config = config.get('original_image', {})
         if isinstance(original_image_config, dict):
             original_image_path = original_image_config.get('path')
             if original_image_path and os.path.exists(original_image_path):
-                return Image.open(original_image_path), os.path.splitext(os.path.basename(original_image_path))[0]
+                return original_image_path
+        return None
+
+    def _load_original_image(self):
+        original_image_path = self.reference_image_path(self.config)
+        if original_image_path:
+            self.original_image_path = original_image_path
+            return Image.open(original_image_path), os.path.splitext(os.path.basename(original_image_path))[0]
         return None, None
 
+    @classmethod
+    def get_manifest(cls, config):
+        """取得共享的輸出清單，設定檔停用時返回 None"""
+        if cls._manifest is None:
+            from src.core.output_manifest import OutputManifest
+            cls._manifest = OutputManifest.from_config(config) or False
+        return cls._manifest or None
+
+    @classmethod
+    def get_latent_cache(cls, config):
+        """取得共享的參考圖像 latents 快取"""
+        if cls._latent_cache is None:
+            from src.core.latent_cache import ReferenceLatentCache
+            img2img_config = config.get('img2img', {}) or {}
+            cls._latent_cache = ReferenceLatentCache(
+                cache_dir=img2img_config.get('latent_cache_dir', 'outputs/.cache/reference_latents'),
+                max_entries=img2img_config.get('latent_cache_max_entries', 64)
+            )
+        return cls._latent_cache
+
+    def _use_img2img(self):
+        return self.img2img_pipe is not None and self.original_image_path is not None
+
     def _prepare_prompt_for_api(self):
-        from src.utils.prompts import get_default_action_dict, get_default_expression_dict
+        from src.utils.prompts import build_character_prompt
         if self.original_image is None:
-            action_dict, expression_dict = get_default_action_dict(), get_default_expression_dict()
-            action, expression = action_dict.get(self.action_key, "standing"), expression_dict.get(self.expression_key, "smiling")
-            base_prompt = "a cartoon mushroom character with a light blue mushroom cap with white dots, eyes and mouth on its body, yellow feet"
-            self.prompt = f"{base_prompt}, {action}, {expression}, consistent proportions, symmetrical features"
+            self.prompt = build_character_prompt(self.action_key, self.expression_key)
+
+    def resolve_prompts(self):
+        """返回此生成器實際使用的 (prompt, negative_prompt)"""
+        self._prepare_prompt_for_api()
+        return self.prompt, self.negative_prompt
 
-    def _generate_image_result(self, steps, generator):
+    def _generate_image_result(self, steps, generator, prompt=None, negative_prompt=None):
         # # 除錯：印出 init_image 是否有被使用
         # print(f"[DEBUG] init_image 傳入: {self.original_image is not None}")
         # print(f"[DEBUG] prompt: {self.prompt}")
@@ -70,9 +148,15 @@ class ImageGenerator:
         # print(f"[DEBUG] num_inference_steps: {steps}")
         # print(f"[DEBUG] num_images_per_prompt: 1")
         # print(f"[DEBUG] generator: {generator}")
-        return self.pipe(
-            prompt=self.prompt,
-            negative_prompt=self.negative_prompt,
+        prompt_kwargs = self._prompt_kwargs(
+            self.prompt if prompt is None else prompt,
+            self.negative_prompt if negative_prompt is None else negative_prompt
+        )
+        if self._use_img2img():
+            return self._generate_img2img_result(steps, generator, prompt_kwargs)
+        step_timer = metrics.StepTimer()
+        result = self.pipe(
+            **prompt_kwargs,
             num_inference_steps=steps,
             height=self.height,
             width=self.width,
@@ -80,62 +164,222 @@ class ImageGenerator:
             init_image=self.original_image,
             strength=self.strength,
             num_images_per_prompt=1,
-            generator=generator
+            generator=generator,
+            **self._step_callback_kwargs(self.pipe, step_timer)
         )
+        step_timer.finish()
+        return result
+
+    def _generate_img2img_result(self, steps, generator, prompt_kwargs):
+        """
+        以參考圖像執行真正的 img2img：只跑 strength × steps 個去噪步數，
+        參考圖像的 VAE latents 從快取取得，不重複解碼與編碼。
+        """
+        batch_size = len(generator) if isinstance(generator, list) else 1
+        latents = self.get_latent_cache(self.config).get_latents(
+            self.img2img_pipe, self.original_image_path, self.height, self.width,
+            model_key=(self.config.get('model'), str(self.img2img_pipe.vae.dtype))
+        )
+        init_latents = latents.to(device=self.img2img_pipe._execution_device, dtype=self.img2img_pipe.vae.dtype)
+        if batch_size > 1:
+            init_latents = init_latents.repeat(batch_size, 1, 1, 1)
+        step_timer = metrics.StepTimer()
+        result = self.img2img_pipe(
+            **prompt_kwargs,
+            image=init_latents,
+            strength=self.strength,
+            num_inference_steps=steps,
+            guidance_scale=self.guidance_scale,
+            num_images_per_prompt=1,
+            generator=generator,
+            **self._step_callback_kwargs(self.img2img_pipe, step_timer)
+        )
+        step_timer.finish()
+        return result
+
+    @staticmethod
+    def _step_callback_kwargs(pipe, step_timer):
+        """管道支援 callback_on_step_end 時返回逐步計時的回調參數"""
+        try:
+            parameters = inspect.signature(pipe.__call__).parameters
+        except (TypeError, ValueError):
+            return {}
+        if 'callback_on_step_end' not in parameters:
+            return {}
+        return {"callback_on_step_end": step_timer.callback}
+
+    def _prompt_kwargs(self, prompt, negative_prompt):
+        """優先使用快取的提示詞嵌入，無法使用時退回原始字串"""
+        if self.prompt_cache is not None and self.prompt_cache.supports(self.pipe):
+            try:
+                return self.prompt_cache.build_pipeline_kwargs(
+                    self.pipe, prompt, negative_prompt, self.weight_name, self.lora_scale
+                )
+            except Exception as e:
+                print(f"⚠️ 提示詞嵌入快取不可用，改用原始提示詞: {e}", flush=True)
+        return {"prompt": prompt, "negative_prompt": negative_prompt}
 
     def _extract_image_from_result(self, result):
         image = result.images[0] if hasattr(result, "images") else result[0]
         if image is None: raise ValueError("生成的圖像為 None")
         return image
 
-    def _process_image(self, image):
-        """🚀 記憶體優化版本的圖像去背處理"""
-        # print("--- [ImageGenerator] 正在處理圖像去背... ---", flush=True)
-        
-        # 使用共享的 rembg session，避免重複載入模型
-        if ImageGenerator._rembg_session is None:
-            from rembg import new_session
-            print("--- [ImageGenerator] 初始化 rembg session... ---", flush=True)
-            ImageGenerator._rembg_session = new_session('u2net')  # 使用較小的模型
-        
-        from rembg import remove
-        
-        # 使用 BytesIO 減少記憶體複製
-        with BytesIO() as input_buffer:
-            # 將圖像保存到記憶體緩衝區
-            image.save(input_buffer, format="PNG")
-            input_buffer.seek(0)
-            
-            # 使用 session 進行去背
-            result = remove(input_buffer.getvalue(), session=ImageGenerator._rembg_session)
-            
-            # 處理返回結果
-            if isinstance(result, bytes):
-                processed_image = Image.open(BytesIO(result))
-            else:
-                # 如果返回的是 PIL Image 或其他格式
-                processed_image = result
-        
-        # print("--- [ImageGenerator] 圖像去背完成。 ---", flush=True)
-        return processed_image
+    def _extract_images_from_result(self, result, expected):
+        images = list(result.images) if hasattr(result, "images") else list(result[0])
+        if len(images) != expected or any(image is None for image in images):
+            raise ValueError(f"生成的圖像數量不正確: 預期 {expected} 張，實際 {len(images)} 張")
+        return images
+
+    def _make_generator(self, seed):
+        return torch.Generator(device="cuda" if torch.cuda.is_available() else "cpu").manual_seed(seed)
+
+    def _reserve_output_path(self, output_dir, seed, steps):
+        """
+        預留輸出檔名並返回 (完整路徑, 相對於 outputs/ 的路徑)。
+        以獨佔模式建立空檔案佔位，圖像交給後處理程序非同步儲存時也不會與同名檔案衝突。
+        """
+        timestamp = int(time.time())
+        filename = f"{self.weight_name}_{seed}_{timestamp}_transparent.png"
+        # filename = f"{self.weight_name}_{self.action_key}_{self.expression_key}_{seed}_{timestamp}_transparent.png"
+        # 同一秒內以相同種子生成多張時 (例如批次)，加上序號避免覆蓋
+        suffix = 1
+        while True:
+            full_path = os.path.join(output_dir, filename)
+            try:
+                with open(full_path, 'x'):
+                    pass
+                break
+            except FileExistsError:
+                filename = f"{self.weight_name}_{seed}_{timestamp}_{suffix}_transparent.png"
+                suffix += 1
+        return full_path, os.path.join(f"{self.weight_name}", str(steps), filename)
+
+    @classmethod
+    def get_postprocessor(cls, config):
+        """取得共享的後處理器 (去背、裁切、PNG 編碼與儲存)"""
+        if cls._postprocessor is None:
+            from src.core.postprocess import PostProcessor
+            cls._postprocessor = PostProcessor.from_config(config)
+        return cls._postprocessor
+
+    def _submit_postprocess(self, image, output_dir, seed, steps, item=None):
+        """
+        將解碼後的圖像交給後處理階段，返回 Future，結果為相對於 outputs/ 的路徑。
+        儲存完成後寫入輸出清單；後處理失敗時移除預留的空檔案。
+        """
+        full_path, relative_path = self._reserve_output_path(output_dir, seed, steps)
+        # 複製批次共用的階段耗時 (去噪、解碼...)，再加上這張圖像自己的後處理耗時
+        batch_timings = metrics.current_timings()
+        item_timings = batch_timings.fork() if batch_timings is not None else metrics.StageTimings()
+        manifest = self.get_manifest(self.config)
+        # 清單記錄實際位置相對於 outputs/ 的路徑；輸出目錄不在 outputs/ 之下 (例如基準測試的暫存目錄) 時不記錄
+        manifest_path = self._outputs_relative_path(full_path) if manifest else None
+        manifest_entry = self._manifest_entry(image, manifest_path, seed, steps, item or {}) if manifest_path else None
+        task = self.get_postprocessor(self.config).submit(image, full_path)
+        result = Future()
+        result.stage_timings = item_timings
+
+        def _on_done(done):
+            try:
+                info = done.result()
+                item_timings.add("background_removal", info["removal_seconds"])
+                item_timings.add("encode_save", info["save_seconds"])
+                if info.get("matte_rejected"):
+                    item_timings.add("matte_rejected", info["matte_rejected_seconds"])
+                print(f"✅ API 已生成圖像：{full_path}", flush=True)
+                if manifest_entry is not None:
+                    self._record_manifest(manifest, manifest_entry, full_path, item_timings)
+                result.set_result(relative_path)
+            except BaseException as e:
+                if os.path.exists(full_path) and os.path.getsize(full_path) == 0:
+                    os.remove(full_path)
+                result.set_exception(e)
+
+        task.add_done_callback(_on_done)
+        return result
+
+    @staticmethod
+    def _outputs_relative_path(full_path):
+        """相對於 outputs/ 的路徑，不在 outputs/ 之下時返回 None"""
+        relative = os.path.relpath(os.path.abspath(full_path), os.path.abspath("outputs"))
+        if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+            return None
+        return relative
+
+    def _manifest_entry(self, image, relative_path, seed, steps, item):
+        """
+        輸出清單記錄的參數部分 (提交後處理前建立，之後不受生成器狀態改變影響)。
+        感知雜湊以去背前的圖像計算，同一組參數的結果不受去背方式影響。
+        """
+        manifest = self.get_manifest(self.config)
+        phash = None
+        if manifest.phash:
+            try:
+                phash = perceptual_hash(image)
+            except Exception as e:
+                print(f"⚠️ 計算感知雜湊失敗: {e}", flush=True)
+        scheduler = getattr(self.pipe, "scheduler", None)
+        return {
+            "image_path": relative_path,
+            "weight_name": self.weight_name,
+            "seed": seed,
+            "steps": steps,
+            "action_key": item.get("action_key", self.action_key),
+            "expression_key": item.get("expression_key", self.expression_key),
+            "scheduler": self.scheduler_name or (type(scheduler).__name__ if scheduler is not None else None),
+            "prompt": item.get("prompt", self.prompt),
+            "negative_prompt": item.get("negative_prompt", self.negative_prompt),
+            "guidance_scale": self.guidance_scale,
+            "strength": self.strength,
+            "noise_level": self.noise_level,
+            "height": self.height,
+            "width": self.width,
+            "original_image": self.original_image_path,
+            "phash": phash,
+        }
+
+    @staticmethod
+    def _record_manifest(manifest, entry, full_path, item_timings):
+        """寫入輸出清單，失敗只印出警告，不影響生成結果"""
+        try:
+            manifest.record({**entry, "file_size": os.path.getsize(full_path), "timings": item_timings.as_dict()})
+        except Exception as e:
+            print(f"⚠️ 寫入輸出清單失敗: {e}", flush=True)
+
+    @staticmethod
+    def _wait_postprocess(futures):
+        """等待一組後處理 Future，返回成功的數量並印出失敗原因"""
+        succeeded = 0
+        for future in futures:
+            try:
+                future.result()
+                succeeded += 1
+            except Exception as e:
+                print(f"⚠️ 圖像後處理失敗: {e}", flush=True)
+        return succeeded
+
+    @classmethod
+    def get_memory_policy(cls, config):
+        """取得共享的記憶體策略 (依設定檔的 memory_policy 區塊建立)"""
+        if cls._memory_policy is None:
+            from src.core.memory_policy import MemoryPolicy
+            cls._memory_policy = MemoryPolicy.from_config(config)
+        return cls._memory_policy
+
+    @classmethod
+    def get_profiler(cls, config):
+        """取得共享的剖析器 (依設定檔的 profiling 區塊建立)"""
+        if cls._profiler is None:
+            from src.core.profiler import GenerationProfiler
+            cls._profiler = GenerationProfiler.from_config(config)
+        return cls._profiler
 
     def _close_images(self, *images):
-        """強化的圖像記憶體清理 (支援 CUDA/MPS/CPU)"""
+        """關閉圖像，是否回收裝置記憶體由記憶體策略決定"""
         for img in images:
             if isinstance(img, Image.Image):
                 img.close()
-        
-        # 強制垃圾回收
-        gc.collect()
-        
-        # 清理 GPU 快取 (如果可用)
-        if torch.cuda.is_available() and torch.cuda.device_count() > 0:
-            torch.cuda.empty_cache()
-            torch.cuda.synchronize()
-        elif hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
-            # Mac M1 MPS 記憶體清理
-            torch.mps.empty_cache()
-        # CPU 環境不需要特殊的快取清理
+        self.get_memory_policy(self.config).after_images()
 
     def generate_images(self):
         print("--- [ImageGenerator] 開始批次生成圖像... ---", flush=True)
@@ -143,6 +387,18 @@ class ImageGenerator:
         inference_configs = self.config.get('inference_config', [{'steps': 50, 'num_images': 1}])
         random_seed_list = self.config.get('random_seed_list', [])
         
+        sweep_config = self.config.get('batch_sweep', {}) or {}
+        if sweep_config.get('enabled', False):
+            self._generate_images_batched(
+                inference_configs,
+                random_seed_list if random_seed_list else [int(time.time())],
+                batch_size=sweep_config.get('batch_size', 4)
+            )
+            print("--- [ImageGenerator] 批次生成完成。 ---", flush=True)
+            return
+        
+        prompt, negative_prompt = self.resolve_prompts()
+        postprocess_futures = []
         for seed in (random_seed_list if random_seed_list else [int(time.time())]):
             for config in inference_configs:
                 steps = config.get('steps', 50)
@@ -155,103 +411,151 @@ class ImageGenerator:
                         output_dir = f"outputs/{self.weight_name}/{steps}"
                         os.makedirs(output_dir, exist_ok=True)
                         
-                        self.generate_single_image_api(steps, output_dir, seed)
+                        # 後處理在背景進行，不等待即開始下一次生成
+                        postprocess_futures.extend(self.generate_batch_async(
+                            steps, output_dir,
+                            [{"prompt": prompt, "negative_prompt": negative_prompt, "seed": seed}]
+                        ))
                         print(f"✅ 已生成第 {i+1}/{num_images} 張圖像")
                         
                     except Exception as e:
                         print(f"⚠️ 生成第 {i+1} 張圖像時出錯: {e}")
                         continue
         
+        self._wait_postprocess(postprocess_futures)
         print("--- [ImageGenerator] 批次生成完成。 ---", flush=True)
 
+    def _generate_images_batched(self, inference_configs, seeds, batch_size):
+        """
+        批次種子掃描：同一步數下的所有種子與重複張數分塊送入管道。
+        每張圖像使用各自的 Generator，結果與逐張生成一致。
+        每個分塊之前依記憶體策略的剩餘記憶體決定分塊大小 (CPU 上記憶體不足時行程會被直接終止)，
+        捕捉到記憶體不足的例外時再縮小批次重試作為後備。
+        """
+        prompt, negative_prompt = self.resolve_prompts()
+        batch_size = max(1, int(batch_size))
+        memory_policy = self.get_memory_policy(self.config)
+        postprocess_futures = []
+        
+        for config in inference_configs:
+            steps = config.get('steps', 50)
+            num_images = config.get('num_images', 1)
+            output_dir = f"outputs/{self.weight_name}/{steps}"
+            os.makedirs(output_dir, exist_ok=True)
+            
+            items = [
+                {"prompt": prompt, "negative_prompt": negative_prompt, "seed": seed}
+                for seed in seeds
+                for _ in range(num_images)
+            ]
+            print(f"--- [ImageGenerator] 步數 {steps}：以每批 {batch_size} 張生成 {len(items)} 張圖像 ---", flush=True)
+            
+            start = 0
+            while start < len(items):
+                chunk_size = memory_policy.max_batch_size(self.height, self.width, batch_size)
+                if chunk_size < batch_size:
+                    print(f"🔍 剩餘記憶體不足以生成 {batch_size} 張，此分塊改為 {chunk_size} 張", flush=True)
+                chunk = items[start:start + chunk_size]
+                try:
+                    # 後處理在背景進行，下一個分塊的去噪可以立即開始
+                    postprocess_futures.extend(self.generate_batch_async(steps, output_dir, chunk))
+                    print(f"✅ 已生成第 {start + 1}-{start + len(chunk)}/{len(items)} 張圖像")
+                    start += len(chunk)
+                except Exception as e:
+                    if self._is_out_of_memory(e) and len(chunk) > 1:
+                        batch_size = max(1, len(chunk) // 2)
+                        print(f"⚠️ 記憶體不足，批次大小縮小為 {batch_size} 後重試", flush=True)
+                        continue
+                    print(f"⚠️ 生成第 {start + 1}-{start + len(chunk)} 張圖像時出錯: {e}")
+                    start += len(chunk)
+        
+        self._wait_postprocess(postprocess_futures)
+
+    @staticmethod
+    def _is_out_of_memory(error):
+        """判斷例外是否為 CUDA / MPS / CPU 記憶體不足"""
+        oom_error = getattr(torch.cuda, 'OutOfMemoryError', None)
+        if oom_error is not None and isinstance(error, oom_error):
+            return True
+        if isinstance(error, MemoryError):
+            return True
+        return isinstance(error, RuntimeError) and 'out of memory' in str(error).lower()
+
     def generate_single_image_api(self, steps, output_dir, seed):
         """🚀 記憶體優化版本的圖像生成"""
-        image = None
-        output_img = None
+        prompt, negative_prompt = self.resolve_prompts()
+        return self.generate_batch_api(
+            steps, output_dir,
+            [{"prompt": prompt, "negative_prompt": negative_prompt, "seed": seed}]
+        )[0]
+
+    def generate_batch_api(self, steps, output_dir, items):
+        """
+        以單次管道調用生成一批圖像，並等待後處理完成。
+        返回與 items 對應的相對路徑列表。
+        """
+        return [future.result() for future in self.generate_batch_async(steps, output_dir, items)]
+
+    def generate_batch_async(self, steps, output_dir, items):
+        """
+        以單次管道調用生成一批圖像，去背與儲存交給後處理階段。
+        items 為 [{"prompt", "negative_prompt", "seed"}]，每張圖像使用各自的 torch.Generator，
+        因此每張結果與逐張以相同種子生成時一致。
+        VAE 解碼完成後即返回與 items 對應的 Future 列表 (結果為相對路徑)，生成執行緒可以立即處理下一批。
+        """
+        images = []
+        output_futures = []
         result = None
         
         try:
-            # 生成前清理記憶體和檢查記憶體使用
-            if torch.cuda.is_available() and torch.cuda.device_count() > 0:
-                torch.cuda.empty_cache()
-                print(f"🔍 生成前 CUDA 記憶體使用: {torch.cuda.memory_allocated()/1024**3:.2f}GB")
-            elif hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
-                torch.mps.empty_cache()
-                print(f"🔍 生成前 MPS 記憶體使用: {torch.mps.current_allocated_memory()/1024**3:.2f}GB")
-            else:
-                print("🔍 生成前記憶體清理完成 (CPU 模式)")
+            # 只在超過高水位或解析度 / 批次變大時回收 (aggressive 策略則每次都回收)
+            memory_policy = self.get_memory_policy(self.config)
+            memory_policy.before_generation(self.height, self.width, len(items))
             
-            self._prepare_prompt_for_api()
-            generator = torch.Generator(device="cuda" if torch.cuda.is_available() else "cpu").manual_seed(seed)
-            # 生成圖像的邏輯
-            result = self._generate_image_result(steps, generator)
-            image = self._extract_image_from_result(result)
+            profile_name = f"{self.weight_name}_{items[0]['seed']}_{steps}"
+            with self.get_profiler(self.config).profile(profile_name, output_dir, self.profile_requested) as profile:
+                if len(items) == 1:
+                    item = items[0]
+                    generator = self._make_generator(item["seed"])
+                    result = self._generate_image_result(steps, generator, item["prompt"], item["negative_prompt"])
+                else:
+                    print(f"--- [ImageGenerator] 批次生成 {len(items)} 張圖像，步數: {steps} ---", flush=True)
+                    generators = [self._make_generator(item["seed"]) for item in items]
+                    result = self._generate_image_result(
+                        steps, generators,
+                        [item["prompt"] for item in items],
+                        [item["negative_prompt"] for item in items]
+                    )
+            self.last_profile = profile
+            images = self._extract_images_from_result(result, len(items))
             
-            # 立即清理生成結果
+            # 立即釋放生成結果
             del result
-            if torch.cuda.is_available() and torch.cuda.device_count() > 0:
-                torch.cuda.empty_cache()
-                print(f"🔍 圖像生成後 CUDA 記憶體使用: {torch.cuda.memory_allocated()/1024**3:.2f}GB")
-            elif hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
-                torch.mps.empty_cache()
-                # print(f"🔍 圖像生成後 MPS 記憶體使用: {torch.mps.current_allocated_memory()/1024**3:.2f}GB")
-            else:
-                print("🔍 圖像生成後記憶體清理完成 (CPU 模式)")
+            result = None
+            memory_policy.after_generation()
             
-            # 處理圖像 (去背)
-            output_img = self._process_image(image)
-            
-            # 立即清理原始圖像
-            if image:
+            for index, item in enumerate(items):
+                image = images[index]
+                # 交給後處理階段 (去背、裁切、儲存)，提交時已複製像素資料
+                output_futures.append(self._submit_postprocess(image, output_dir, item["seed"], steps, item))
+                
+                # 立即清理原始圖像
                 image.close()
-                del image
-                image = None
-            
-            timestamp = int(time.time())
-            filename = f"{self.weight_name}_{seed}_{timestamp}_transparent.png"
-            # filename = f"{self.weight_name}_{self.action_key}_{self.expression_key}_{seed}_{timestamp}_transparent.png"
-            full_path = os.path.join(output_dir, filename)
-            
-            # 修正 output_img 可能為 ndarray 或 bytes 的情況
-            if isinstance(output_img, np.ndarray):
-                output_img = Image.fromarray(output_img)
-            elif isinstance(output_img, bytes):
-                output_img = Image.open(BytesIO(output_img))
-            
-            # 儲存圖像
-            output_img.save(full_path)
-            print(f"✅ API 已生成圖像：{full_path}", flush=True)
-            
-            # 清理輸出圖像
-            if output_img:
-                output_img.close()
-                del output_img
-                output_img = None
+                images[index] = None
             
-            # 最終記憶體清理
-            gc.collect()
-            if torch.cuda.is_available() and torch.cuda.device_count() > 0:
-                torch.cuda.empty_cache()
-                print(f"🔍 完成後 CUDA 記憶體使用: {torch.cuda.memory_allocated()/1024**3:.2f}GB")
-            elif hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
-                torch.mps.empty_cache()
-                print(f"🔍 完成後 MPS 記憶體使用: {torch.mps.current_allocated_memory()/1024**3:.2f}GB")
-            else:
-                print("🔍 完成後記憶體清理完成 (CPU 模式)")
+            self._close_images()
             
-            return os.path.join(f"{self.weight_name}", str(steps), filename)
+            return output_futures
             
         except Exception as e:
             print(f"!!!!!!!! ⚠️ API 生成圖片時出錯: {e} !!!!!!!!", file=sys.stderr, flush=True)
-            # 錯誤時也要清理記憶體
-            self._close_images(image, output_img)
+            # 錯誤時 (通常是記憶體不足) 一律回收記憶體
+            for img in images:
+                if isinstance(img, Image.Image):
+                    img.close()
             if result:
                 del result
-            gc.collect()
-            if torch.cuda.is_available() and torch.cuda.device_count() > 0:
-                torch.cuda.empty_cache()
-            elif hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
-                torch.mps.empty_cache()
+            self.get_memory_policy(self.config).on_error()
             raise e
 # 我們甚至可以在 class 定義之後也加上 print，確保整個檔案都執行完畢
 print("--- [ImageGenerator] 模塊已成功被定義，所有頂層代碼執行完畢。 ---", flush=True)
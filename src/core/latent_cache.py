@@ -0,0 +1,125 @@
+"""
+參考圖像潛在向量快取模塊
+快取參考圖像經 VAE 編碼後的 latents (記憶體 + 磁碟)，重複請求不再解碼圖片與執行 VAE 編碼
+"""
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import torch
+from PIL import Image
+
+from src.core import metrics
+
+print("--- [ReferenceLatentCache] 模塊開始被導入... ---", flush=True)
+
+
+class ReferenceLatentCache:
+    """
+    參考圖像 latents 快取。
+    鍵為 (檔案內容雜湊, 解析度, 模型識別)，記憶體中以 LRU 保存，
+    磁碟上以 .pt 檔保存，重啟後仍可直接讀取。
+    """
+    def __init__(self, cache_dir="outputs/.cache/reference_latents", max_entries=64):
+        self.cache_dir = cache_dir
+        self.max_entries = max(1, int(max_entries))
+        self._entries = OrderedDict()
+        self._file_hashes = {}  # (path, mtime, size) -> sha256
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def file_hash(self, image_path):
+        """以檔案內容計算 sha256，並依修改時間與大小快取結果"""
+        stat = os.stat(image_path)
+        stat_key = (os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._file_hashes.get(stat_key)
+        if cached:
+            return cached
+        digest = hashlib.sha256()
+        with open(image_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        file_hash = digest.hexdigest()
+        with self._lock:
+            self._file_hashes[stat_key] = file_hash
+        return file_hash
+
+    def _key(self, image_path, height, width, model_key):
+        model_part = hashlib.sha256(str(model_key).encode('utf-8')).hexdigest()[:12]
+        return f"{self.file_hash(image_path)[:32]}_{width}x{height}_{model_part}"
+
+    def _remember(self, key, latents):
+        with self._lock:
+            self._entries[key] = latents
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_latents(self, pipe, image_path, height, width, model_key=None):
+        """返回參考圖像在指定解析度下的 latents (已乘上 VAE scaling factor，位於 CPU)"""
+        key = self._key(image_path, height, width, model_key)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                metrics.record_cache_lookup("reference_latent", "memory_hit")
+                return self._entries[key]
+
+        disk_path = os.path.join(self.cache_dir, f"{key}.pt") if self.cache_dir else None
+        if disk_path and os.path.exists(disk_path):
+            try:
+                latents = torch.load(disk_path, map_location="cpu")
+                self.disk_hits += 1
+                metrics.record_cache_lookup("reference_latent", "disk_hit")
+                self._remember(key, latents)
+                return latents
+            except Exception as e:
+                print(f"⚠️ 讀取 latents 快取失敗，重新編碼: {e}", flush=True)
+
+        self.misses += 1
+        metrics.record_cache_lookup("reference_latent", "miss")
+        with metrics.stage("reference_encode"):
+            latents = self._encode(pipe, image_path, height, width)
+        self._remember(key, latents)
+        if disk_path:
+            try:
+                tmp_path = f"{disk_path}.tmp"
+                torch.save(latents, tmp_path)
+                os.replace(tmp_path, disk_path)
+            except Exception as e:
+                print(f"⚠️ 寫入 latents 快取失敗: {e}", flush=True)
+        return latents
+
+    @staticmethod
+    def _encode(pipe, image_path, height, width):
+        """以管道的 VAE 編碼參考圖像，使用分佈的平均值以確保結果可重現"""
+        print(f"--- [ReferenceLatentCache] 以 VAE 編碼參考圖像: {image_path} ({width}x{height}) ---", flush=True)
+        with Image.open(image_path) as image:
+            image = image.convert("RGB")
+            pixels = pipe.image_processor.preprocess(image, height=height, width=width)
+        device = pipe._execution_device
+        with torch.no_grad():
+            pixels = pixels.to(device=device, dtype=pipe.vae.dtype)
+            latent_dist = pipe.vae.encode(pixels).latent_dist
+            latents = latent_dist.mean * pipe.vae.config.scaling_factor
+        return latents.detach().to("cpu")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+            }
+
+print("--- [ReferenceLatentCache] 模塊已成功被定義。---", flush=True)
@@ -0,0 +1,156 @@
+"""
+LoRA 融合模塊
+把 LoRA 的權重增量 (delta) 直接合併進 UNet / Text Encoder 的基礎權重，
+推理時不再經過 PEFT 的低秩矩陣乘法；每個 LoRA 的增量依 LRU 快取，切換時不需重新加載權重檔
+"""
+import time
+import threading
+import weakref
+
+import torch
+
+from src.core.pipeline_cache import PipelineCache
+
+print("--- [LoraFuser] 模塊開始被導入... ---", flush=True)
+
+COMPONENTS = ("unet", "text_encoder")
+
+
+def _base_weight(module):
+    """取得層的基礎權重 (PEFT 包裝層時取 base_layer 的權重)"""
+    return getattr(module, "base_layer", module).weight
+
+
+class LoraFuser:
+    """
+    LoRA 融合器。
+    - extract(): 從已掛載的 PEFT adapter 計算每一層的增量 (強度 1.0)，放入以位元組預算管理的 LRU 快取。
+    - fuse(): 先把所有已融合的層還原成原始權重，再以原始權重 + Σ 強度 × 增量寫回，
+      因此每次融合都從原始權重出發，不會累積浮點誤差。
+    - restore(): 以保存的原始權重複本還原，結果與未融合前完全相同。
+    原始權重只在某一層第一次被融合時複製 (只包含 LoRA 觸及的層)，存放在 CPU。
+    """
+    def __init__(self, max_delta_bytes=None):
+        self.deltas = PipelineCache(max_bytes=max_delta_bytes, name="lora_delta")
+        self._pristine = weakref.WeakKeyDictionary()  # 組件模組 -> {層名稱: 原始權重}
+        self._fused = weakref.WeakKeyDictionary()  # 管道 -> ((weight_name, 強度), ...)
+        self._lock = threading.RLock()
+        self.extractions = 0
+        self.fuses = 0
+        self.fuse_seconds = 0.0
+
+    @classmethod
+    def from_config(cls, config):
+        """從設定檔的 model_manager 區塊建立融合器"""
+        manager_config = config.get('model_manager', {}) or {}
+        max_delta_mb = manager_config.get('fused_delta_cache_mb', 1024)
+        return cls(max_delta_bytes=int(max_delta_mb * 1024**2) if max_delta_mb else None)
+
+    def has_deltas(self, weight_name):
+        return weight_name in self.deltas
+
+    def extract(self, pipe, weight_name, adapter_name):
+        """計算 adapter 在各組件每一層的權重增量並快取，返回增量的總位元組數"""
+        from peft.tuners.tuners_utils import BaseTunerLayer
+
+        deltas = {}
+        size_bytes = 0
+        with torch.no_grad():
+            for component_name in COMPONENTS:
+                component = getattr(pipe, component_name, None)
+                if component is None:
+                    continue
+                for name, module in component.named_modules():
+                    if not isinstance(module, BaseTunerLayer) or not hasattr(module, "get_delta_weight"):
+                        continue
+                    adapters = set(getattr(module, "lora_A", {}) or {}) | set(getattr(module, "lora_embedding_A", {}) or {})
+                    if adapter_name not in adapters:
+                        continue
+                    delta = module.get_delta_weight(adapter_name).detach().to("cpu", dtype=torch.float32, copy=True)
+                    deltas[(component_name, name)] = delta
+                    size_bytes += delta.numel() * delta.element_size()
+        self.deltas.put(weight_name, deltas, size_bytes)
+        self.extractions += 1
+        print(f"✅ 已計算 LoRA 增量: {weight_name} ({len(deltas)} 層，{size_bytes / 1024**2:.1f}MB)", flush=True)
+        return size_bytes
+
+    def fuse(self, pipe, loras):
+        """
+        把 loras ([(weight_name, 強度)]) 融合進管道的基礎權重，空列表表示還原成基礎模型。
+        與目前已融合的組合相同時不做任何事。
+        """
+        loras = tuple((weight_name, float(scale)) for weight_name, scale in loras)
+        with self._lock:
+            if self._fused.get(pipe, ()) == loras:
+                return pipe
+            start = time.perf_counter()
+            deltas = []
+            for weight_name, scale in loras:
+                weight_deltas = self.deltas.get(weight_name)
+                if weight_deltas is None:
+                    raise KeyError(f"尚未計算 LoRA 增量: {weight_name}")
+                deltas.append((weight_deltas, scale))
+
+            with torch.no_grad():
+                self._restore_layers(pipe)
+                targets = {}
+                for weight_deltas, scale in deltas:
+                    for key, delta in weight_deltas.items():
+                        targets.setdefault(key, []).append((delta, scale))
+                for (component_name, name), items in targets.items():
+                    component = getattr(pipe, component_name)
+                    weight = _base_weight(component.get_submodule(name))
+                    pristine = self._pristine.setdefault(component, {})
+                    if name not in pristine:
+                        pristine[name] = weight.detach().to("cpu", copy=True)
+                    fused = pristine[name].float()
+                    for delta, scale in items:
+                        fused = fused + scale * delta
+                    weight.copy_(fused.to(device=weight.device, dtype=weight.dtype))
+
+            for component_name in COMPONENTS:
+                component = getattr(pipe, component_name, None)
+                if component is not None:
+                    # 讓依權重指紋快取的後端 (例如 ONNX Runtime) 區分融合狀態
+                    component._fused_loras = [list(item) for item in loras] or None
+            self._fused[pipe] = loras
+            self.fuses += 1
+            self.fuse_seconds += time.perf_counter() - start
+            print(f"✅ 已融合 LoRA: {', '.join(f'{w}×{s:g}' for w, s in loras) or '無 (基礎模型)'}", flush=True)
+            return pipe
+
+    def restore(self, pipe):
+        """還原成未融合的基礎權重"""
+        return self.fuse(pipe, [])
+
+    def _restore_layers(self, pipe):
+        """把目前已融合的層寫回原始權重"""
+        for component_name in COMPONENTS:
+            component = getattr(pipe, component_name, None)
+            if component is None:
+                continue
+            for name, pristine in self._pristine.get(component, {}).items():
+                weight = _base_weight(component.get_submodule(name))
+                weight.copy_(pristine.to(device=weight.device, dtype=weight.dtype))
+
+    def fused(self, pipe):
+        """目前融合在管道中的 ((weight_name, 強度), ...)"""
+        with self._lock:
+            return self._fused.get(pipe, ())
+
+    def stats(self):
+        with self._lock:
+            pristine_bytes = sum(
+                tensor.numel() * tensor.element_size()
+                for layers in self._pristine.values()
+                for tensor in layers.values()
+            )
+            return {
+                "delta_cache": self.deltas.stats(),
+                "pristine_bytes": pristine_bytes,
+                "extractions": self.extractions,
+                "fuses": self.fuses,
+                "fuse_seconds": round(self.fuse_seconds, 3),
+            }
+
+print("--- [LoraFuser] 模塊已成功被定義。---", flush=True)
@@ -0,0 +1,249 @@
+"""
+LoRA 註冊表模塊
+啟動時掃描 assets/weights，只讀取 safetensors 標頭建立索引 (metadata、rank、目標模組、大小)，
+並以 LRU + 位元組預算快取已解析、已轉換鍵名的 state dict：
+快取命中時加載 adapter 只需要把張量複製進 PEFT 層，不再讀檔與轉換
+"""
+import os
+import re
+import json
+import struct
+import threading
+
+from src.core.pipeline_cache import PipelineCache
+
+print("--- [LoraRegistry] 模塊開始被導入... ---", flush=True)
+
+# 各種 LoRA 格式中表示低秩矩陣的鍵名後綴
+_DOWN_SUFFIXES = (".lora_down.weight", ".lora_A.weight", ".lora.down.weight", "_lora.down.weight")
+_SUFFIX_PATTERN = re.compile(
+    r"(\.lora_down\.weight|\.lora_up\.weight|\.lora_A\.weight|\.lora_B\.weight|"
+    r"\.lora\.down\.weight|\.lora\.up\.weight|_lora\.down\.weight|_lora\.up\.weight|\.alpha|\.lora_mid\.weight)$"
+)
+# Kohya 格式以底線連接模組路徑，以已知的葉模組名稱辨識目標模組
+_KOHYA_LEAF_PATTERN = re.compile(
+    r"(to_q|to_k|to_v|to_out_0|proj_in|proj_out|ff_net_0_proj|ff_net_2|q_proj|k_proj|v_proj|out_proj|"
+    r"fc1|fc2|conv1|conv2|conv_shortcut|time_emb_proj|conv_in|conv_out|conv)$"
+)
+_COMPONENT_PREFIXES = (
+    ("lora_unet_", "unet"), ("unet.", "unet"),
+    ("lora_te1_", "text_encoder"), ("lora_te2_", "text_encoder_2"), ("lora_te_", "text_encoder"),
+    ("text_encoder_2.", "text_encoder_2"), ("text_encoder.", "text_encoder"), ("te_", "text_encoder"),
+)
+
+
+def read_safetensors_header(path):
+    """只讀取 safetensors 的 JSON 標頭 (張量名稱、dtype、形狀與 __metadata__)，不讀取張量資料"""
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        return json.loads(f.read(header_size))
+
+
+def _component(key):
+    for prefix, component in _COMPONENT_PREFIXES:
+        if key.startswith(prefix):
+            return component
+    return "unknown"
+
+
+def _leaf_module(module_path):
+    """模組路徑的葉模組名稱 (例如 ...attn1.to_q -> to_q、...to_out.0 -> to_out.0)"""
+    if "." in module_path:
+        parts = module_path.split(".")
+        return ".".join(parts[-2:]) if parts[-1].isdigit() else parts[-1]
+    match = _KOHYA_LEAF_PATTERN.search(module_path)
+    if match:
+        return match.group(1).replace("to_out_0", "to_out.0")
+    return module_path.rsplit("_", 1)[-1]
+
+
+def describe_lora(header):
+    """從標頭推斷 LoRA 的格式、rank、目標模組與對應的基礎模型"""
+    metadata = header.get("__metadata__", {}) or {}
+    tensors = {key: value for key, value in header.items() if key != "__metadata__"}
+    ranks = set()
+    targets = set()
+    components = {}
+    cross_attention_dim = None
+    for key, info in tensors.items():
+        component = _component(key)
+        module_path = _SUFFIX_PATTERN.sub("", key)
+        if module_path == key:
+            continue
+        components[component] = components.get(component, 0) + 1
+        targets.add(f"{component}:{_leaf_module(module_path)}")
+        if key.endswith(_DOWN_SUFFIXES) and info.get("shape"):
+            ranks.add(int(info["shape"][0]))
+            if component == "unet" and re.search(r"attn2[._]to_k", key) and len(info["shape"]) >= 2:
+                cross_attention_dim = int(info["shape"][1])
+
+    keys = list(tensors)
+    if any(key.startswith(("lora_unet_", "lora_te")) for key in keys):
+        lora_format = "kohya"
+    elif any(".lora_A." in key for key in keys):
+        lora_format = "peft"
+    else:
+        lora_format = "diffusers"
+    if "text_encoder_2" in components or cross_attention_dim == 2048:
+        base = "sdxl"
+    elif cross_attention_dim == 768:
+        base = "sd15"
+    else:
+        base = metadata.get("ss_base_model_version") or "unknown"
+
+    return {
+        "format": lora_format,
+        "base": base,
+        "rank": max(ranks) if ranks else None,
+        "ranks": sorted(ranks),
+        "alpha": metadata.get("ss_network_alpha"),
+        "target_modules": sorted(targets),
+        "components": components,
+        "tensor_count": len(tensors),
+        "metadata": metadata,
+    }
+
+
+class LoraRegistry:
+    """
+    LoRA 註冊表。
+    - scan(): 索引 weights_dir 中所有 .safetensors (只讀標頭，啟動時執行)。
+    - load_into(): 從快取取得轉換後的 state dict 並加載為具名 adapter；
+      未命中時以記憶體映射讀取 safetensors、轉換鍵名後放入 LRU (依張量位元組數計算預算)。
+    權重檔的大小或修改時間改變時自動重新讀取。
+    """
+    def __init__(self, weights_dir="assets/weights", max_cache_bytes=None):
+        self.weights_dir = weights_dir
+        self.state_dicts = PipelineCache(max_bytes=max_cache_bytes, name="lora_state_dict")
+        self._index = {}  # weight_name -> 檔案資訊
+        self._lock = threading.RLock()
+        self.loads = 0
+        self.disk_reads = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """從設定檔的 lora_registry 區塊建立註冊表"""
+        registry_config = config.get('lora_registry', {}) or {}
+        max_cache_mb = registry_config.get('max_cache_mb', 512)
+        return cls(
+            weights_dir=registry_config.get('weights_dir', 'assets/weights'),
+            max_cache_bytes=int(max_cache_mb * 1024**2) if max_cache_mb else None
+        )
+
+    def scan(self):
+        """重新索引權重目錄，返回索引的檔案數"""
+        index = {}
+        if os.path.isdir(self.weights_dir):
+            for name in sorted(os.listdir(self.weights_dir)):
+                if not name.endswith(".safetensors"):
+                    continue
+                info = self._describe_file(name)
+                if info is not None:
+                    index[name] = info
+        with self._lock:
+            self._index = index
+        print(f"--- [LoraRegistry] 已索引 {len(index)} 個 LoRA 權重檔: {self.weights_dir} ---", flush=True)
+        return len(index)
+
+    def _describe_file(self, weight_name):
+        path = os.path.join(self.weights_dir, weight_name)
+        try:
+            stat = os.stat(path)
+            info = describe_lora(read_safetensors_header(path))
+        except Exception as e:
+            print(f"⚠️ 無法讀取 LoRA 標頭 {weight_name}: {e}", flush=True)
+            return None
+        info.update({"weight_name": weight_name, "size_bytes": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+        return info
+
+    def info(self, weight_name):
+        """取得單一權重檔的索引資訊 (索引中沒有或檔案已改變時重新讀取標頭)"""
+        path = os.path.join(self.weights_dir, weight_name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            info = self._index.get(weight_name)
+            if info is not None and info["size_bytes"] == stat.st_size and info["mtime_ns"] == stat.st_mtime_ns:
+                return info
+        info = self._describe_file(weight_name)
+        if info is not None:
+            with self._lock:
+                self._index[weight_name] = info
+        return info
+
+    def list(self):
+        with self._lock:
+            return [
+                {key: value for key, value in info.items() if key != "metadata"}
+                for info in self._index.values()
+            ]
+
+    @staticmethod
+    def _pipeline_kind(pipe):
+        """SDXL 管道有第二個 Text Encoder，轉換方式不同，分開快取"""
+        return "sdxl" if hasattr(pipe, "text_encoder_2") else "sd"
+
+    def _state_dict(self, pipe, weight_name):
+        """取得轉換後的 (state_dict, network_alphas)，快取鍵包含檔案大小與修改時間"""
+        info = self.info(weight_name)
+        if info is None:
+            raise FileNotFoundError(f"LoRA 權重檔不存在: {os.path.join(self.weights_dir, weight_name)}")
+        key = (weight_name, self._pipeline_kind(pipe), info["size_bytes"], info["mtime_ns"])
+        cached = self.state_dicts.get(key)
+        if cached is not None:
+            return cached
+
+        from safetensors.torch import load_file
+        # load_file 以記憶體映射讀取，張量資料由作業系統的頁面快取提供
+        raw = load_file(os.path.join(self.weights_dir, weight_name), device="cpu")
+        self.disk_reads += 1
+        if self._pipeline_kind(pipe) == "sd" and hasattr(type(pipe), "lora_state_dict"):
+            converted = type(pipe).lora_state_dict(raw)
+            state_dict, network_alphas = converted[0], converted[1]
+        else:
+            state_dict, network_alphas = raw, None
+        size_bytes = sum(tensor.numel() * tensor.element_size() for tensor in state_dict.values())
+        # 同一權重檔的舊版本不再需要
+        for stale_key in [k for k in self._keys() if k[0] == weight_name and k != key]:
+            self.state_dicts.pop(stale_key)
+        return self.state_dicts.put(key, (state_dict, network_alphas), size_bytes)
+
+    def _keys(self):
+        return [entry["key"] for entry in self.state_dicts.stats()["entries"]]
+
+    def load_into(self, pipe, weight_name, adapter_name=None):
+        """把 LoRA 加載到管道 (與 pipe.load_lora_weights 相同的結果，但使用快取的 state dict)"""
+        state_dict, network_alphas = self._state_dict(pipe, weight_name)
+        self.loads += 1
+        if network_alphas is None and self._pipeline_kind(pipe) == "sdxl":
+            # SDXL 的鍵名轉換交給管道處理，快取省下的是讀檔與解析
+            pipe.load_lora_weights(dict(state_dict), adapter_name=adapter_name)
+            return pipe
+        # 與 load_lora_weights 內部相同的兩個步驟，傳入淺複本以免快取的字典被修改
+        pipe.load_lora_into_unet(
+            dict(state_dict), network_alphas=network_alphas, unet=pipe.unet,
+            adapter_name=adapter_name, _pipeline=pipe
+        )
+        if getattr(pipe, "text_encoder", None) is not None and any(key.startswith("text_encoder.") for key in state_dict):
+            pipe.load_lora_into_text_encoder(
+                dict(state_dict), network_alphas=network_alphas, text_encoder=pipe.text_encoder,
+                lora_scale=getattr(pipe, "lora_scale", 1.0), adapter_name=adapter_name, _pipeline=pipe
+            )
+        return pipe
+
+    def stats(self):
+        with self._lock:
+            indexed = len(self._index)
+            indexed_bytes = sum(info["size_bytes"] for info in self._index.values())
+        return {
+            "weights_dir": self.weights_dir,
+            "indexed": indexed,
+            "indexed_bytes": indexed_bytes,
+            "loads": self.loads,
+            "disk_reads": self.disk_reads,
+            "state_dict_cache": self.state_dicts.stats(),
+        }
+
+print("--- [LoraRegistry] 模塊已成功被定義。---", flush=True)
@@ -0,0 +1,257 @@
+"""
+記憶體策略模塊
+追蹤裝置已分配 / 已保留記憶體與行程 RSS，只在必要時才執行 gc 與清空快取
+"""
+import os
+import gc
+import time
+import threading
+
+import torch
+
+print("--- [MemoryPolicy] 模塊開始被導入... ---", flush=True)
+
+
+def current_rss_bytes():
+    """目前行程的常駐記憶體 (RSS)，無法取得時返回 None"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except Exception:
+        pass
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        return None
+
+
+# cgroup v2 / v1 的記憶體上限檔案；沒有限制時 v2 為 "max"，v1 為接近 2^63 的數值
+CGROUP_MEMORY_LIMIT_FILES = ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes")
+
+
+def _cgroup_memory_limit_bytes():
+    """容器 (cgroup) 的記憶體上限，沒有限制或無法讀取時返回 None"""
+    for path in CGROUP_MEMORY_LIMIT_FILES:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value == "max":
+            return None
+        try:
+            limit = int(value)
+        except ValueError:
+            continue
+        # v1 沒有限制時是以頁面對齊的極大值表示
+        return limit if 0 < limit < 2**60 else None
+    return None
+
+
+def _system_memory_bytes():
+    """
+    可用的記憶體總量：主機實體記憶體與 cgroup 記憶體上限取較小者。
+    在有記憶體配額的容器 (例如 Render) 中，超過配額時行程會被直接終止，高水位必須以配額計算。
+    """
+    total = None
+    try:
+        import psutil
+        total = psutil.virtual_memory().total
+    except Exception:
+        try:
+            total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        except Exception:
+            pass
+    limit = _cgroup_memory_limit_bytes()
+    if limit is not None and (total is None or limit < total):
+        return limit
+    return total
+
+
+class MemoryPolicy:
+    """
+    記憶體回收策略。
+    - watermark: 只在 (裝置已保留記憶體 / 裝置總記憶體) 或 RSS 超過高水位時回收，
+      以及在較大的配置之前 (解析度改變或批次變大) 回收一次；穩定的批次生成不會反覆清空分配器快取。
+    - aggressive: 每張圖像前後都執行 gc 與清空快取 (原本的行為)。
+    發生例外時兩種策略都會回收。
+    max_batch_size() 依高水位下的剩餘記憶體與每張圖像的預估啟動記憶體決定批次大小，
+    在 CPU 上記憶體不足通常是行程被系統直接終止，無法以例外捕捉後再縮小批次。
+    """
+    POLICIES = ("watermark", "aggressive")
+
+    def __init__(self, policy="watermark", high_watermark=0.85, rss_high_watermark_mb=None, activation_mb_per_image=1200):
+        if policy not in self.POLICIES:
+            raise ValueError(f"未知的記憶體策略: {policy}，可用: {', '.join(self.POLICIES)}")
+        self.policy = policy
+        self.high_watermark = float(high_watermark)
+        self.rss_high_watermark = int(rss_high_watermark_mb * 1024 * 1024) if rss_high_watermark_mb else None
+        self.activation_bytes_per_image = int(activation_mb_per_image * 1024 * 1024) if activation_mb_per_image else None
+        self.device = self._detect_device()
+        self._last_shape = None
+        self._lock = threading.Lock()
+        self.reclaims = {}  # 原因 -> 次數
+        self.reclaim_seconds = 0.0
+        self.skipped = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """從設定檔的 memory_policy 區塊建立策略"""
+        policy_config = config.get('memory_policy', {}) or {}
+        return cls(
+            policy=policy_config.get('policy', 'watermark'),
+            high_watermark=policy_config.get('high_watermark', 0.85),
+            rss_high_watermark_mb=policy_config.get('rss_high_watermark_mb'),
+            activation_mb_per_image=policy_config.get('activation_mb_per_image', 1200)
+        )
+
+    @staticmethod
+    def _detect_device():
+        if torch.cuda.is_available() and torch.cuda.device_count() > 0:
+            return "cuda"
+        if hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
+            return "mps"
+        return "cpu"
+
+    def snapshot(self):
+        """返回目前的記憶體使用量 (位元組)，無法取得的欄位為 None"""
+        allocated = reserved = total = None
+        try:
+            if self.device == "cuda":
+                allocated = torch.cuda.memory_allocated()
+                reserved = torch.cuda.memory_reserved()
+                total = torch.cuda.get_device_properties(torch.cuda.current_device()).total_memory
+            elif self.device == "mps":
+                allocated = torch.mps.current_allocated_memory()
+                reserved = torch.mps.driver_allocated_memory()
+                if hasattr(torch.mps, 'recommended_max_memory'):
+                    total = torch.mps.recommended_max_memory()
+        except Exception:
+            pass
+        return {
+            "device": self.device,
+            "allocated_bytes": allocated,
+            "reserved_bytes": reserved,
+            "device_total_bytes": total,
+            "rss_bytes": current_rss_bytes(),
+        }
+
+    def above_watermark(self, snapshot=None):
+        """裝置已保留記憶體或 RSS 是否超過高水位"""
+        snapshot = snapshot or self.snapshot()
+        if snapshot["reserved_bytes"] is not None and snapshot["device_total_bytes"]:
+            if snapshot["reserved_bytes"] / snapshot["device_total_bytes"] >= self.high_watermark:
+                return True
+        rss = snapshot["rss_bytes"]
+        if rss is not None:
+            if self.rss_high_watermark is not None:
+                return rss >= self.rss_high_watermark
+            if self.device == "cpu":
+                system_total = _system_memory_bytes()
+                return bool(system_total) and rss / system_total >= self.high_watermark
+        return False
+
+    def headroom_bytes(self, snapshot=None):
+        """高水位以下還可使用的記憶體 (裝置為 GPU 時看已保留記憶體，CPU 時看 RSS)，無法判斷時返回 None"""
+        snapshot = snapshot or self.snapshot()
+        if snapshot["reserved_bytes"] is not None and snapshot["device_total_bytes"]:
+            return snapshot["device_total_bytes"] * self.high_watermark - snapshot["reserved_bytes"]
+        rss = snapshot["rss_bytes"]
+        if rss is None or self.device != "cpu":
+            return None
+        if self.rss_high_watermark is not None:
+            return self.rss_high_watermark - rss
+        system_total = _system_memory_bytes()
+        return system_total * self.high_watermark - rss if system_total else None
+
+    def estimate_image_bytes(self, height, width):
+        """
+        每張圖像在去噪時的預估啟動記憶體。
+        以 512×512 的 activation_mb_per_image 為基準，依像素數的平方縮放 (未切片的 attention 隨 token 數平方成長)。
+        """
+        ratio = (height * width) / (512 * 512)
+        return self.activation_bytes_per_image * max(ratio, 1e-3) ** 2
+
+    def max_batch_size(self, height, width, requested):
+        """在不超過高水位的前提下可一次生成的張數 (至少 1)，無法判斷剩餘記憶體時返回 requested"""
+        requested = max(1, int(requested))
+        if self.activation_bytes_per_image is None:
+            return requested
+        headroom = self.headroom_bytes()
+        if headroom is None:
+            return requested
+        return max(1, min(requested, int(headroom // self.estimate_image_bytes(height, width))))
+
+    def reclaim(self, reason, synchronize=False):
+        """執行 gc 並清空裝置的分配器快取"""
+        start = time.perf_counter()
+        gc.collect()
+        if self.device == "cuda":
+            torch.cuda.empty_cache()
+            if synchronize:
+                torch.cuda.synchronize()
+        elif self.device == "mps":
+            torch.mps.empty_cache()
+        with self._lock:
+            self.reclaims[reason] = self.reclaims.get(reason, 0) + 1
+            self.reclaim_seconds += time.perf_counter() - start
+
+    def _maybe_reclaim(self, reason):
+        snapshot = self.snapshot()
+        if self.above_watermark(snapshot):
+            print(f"🔍 記憶體超過高水位 ({reason})，執行回收: {self._format(snapshot)}", flush=True)
+            self.reclaim(f"watermark_{reason}")
+        else:
+            with self._lock:
+                self.skipped += 1
+
+    def before_generation(self, height, width, batch_size=1):
+        """生成前：解析度改變或批次變大時先回收，讓大型配置從乾淨的快取開始"""
+        if self.policy == "aggressive":
+            self.reclaim("before_generation")
+            return
+        shape = (height, width, batch_size)
+        last_shape, self._last_shape = self._last_shape, shape
+        if last_shape is not None and (shape[:2] != last_shape[:2] or batch_size > last_shape[2]):
+            self.reclaim("shape_change")
+        else:
+            self._maybe_reclaim("before_generation")
+
+    def after_generation(self):
+        """VAE 解碼完成、結果已釋放後"""
+        if self.policy == "aggressive":
+            self.reclaim("after_generation")
+        else:
+            self._maybe_reclaim("after_generation")
+
+    def after_images(self):
+        """圖像交給後處理並關閉後"""
+        if self.policy == "aggressive":
+            self.reclaim("after_images", synchronize=True)
+
+    def on_error(self):
+        """生成失敗時 (通常是記憶體不足) 一律回收"""
+        self.reclaim("error")
+
+    @staticmethod
+    def _format(snapshot):
+        parts = []
+        for key in ("allocated_bytes", "reserved_bytes", "rss_bytes"):
+            if snapshot[key] is not None:
+                parts.append(f"{key.replace('_bytes', '')}={snapshot[key] / 1024**3:.2f}GB")
+        return ", ".join(parts)
+
+    def stats(self):
+        """返回策略、回收次數與目前記憶體使用量"""
+        with self._lock:
+            return {
+                "policy": self.policy,
+                "high_watermark": self.high_watermark,
+                "reclaims": dict(self.reclaims),
+                "reclaim_seconds": self.reclaim_seconds,
+                "skipped": self.skipped,
+                "memory": self.snapshot(),
+            }
+
+print("--- [MemoryPolicy] 模塊已成功被定義。---", flush=True)
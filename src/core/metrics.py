@@ -0,0 +1,273 @@
+"""
+指標模塊
+輕量的計數器 / 量測值 / 直方圖與分階段計時，輸出 Prometheus 文字格式，
+並收集每個請求的各階段耗時
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+print("--- [Metrics] 模塊開始被導入... ---", flush=True)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.extend(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    metric_type = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} 需要標籤 {self.label_names}，實際為 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    """單調遞增的計數器"""
+    metric_type = "counter"
+
+    def inc(self, amount=1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    """可任意設定的量測值"""
+    metric_type = "gauge"
+
+    def set(self, value, **labels):
+        if value is None:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+
+class Histogram(_Metric):
+    """累積分桶直方圖"""
+    metric_type = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][index] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    def _render_sample(self, key, state):
+        lines = []
+        for bound, count in zip(self.buckets, state["counts"]):
+            labels = _format_labels(self.label_names, key, [("le", _format_value(bound))])
+            lines.append(f"{self.name}_bucket{labels} {count}")
+        labels = _format_labels(self.label_names, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(state['sum'])}")
+        lines.append(f"{self.name}_count{labels} {state['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    """指標登記處，render() 輸出 Prometheus 文字格式"""
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self._register(Counter(name, help_text, label_names))
+
+    def gauge(self, name, help_text, label_names=()):
+        return self._register(Gauge(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, label_names, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+STAGE_SECONDS = registry.histogram(
+    "mushroom_stage_seconds", "各處理階段的耗時 (秒)", ("stage",)
+)
+DENOISE_STEP_SECONDS = registry.histogram(
+    "mushroom_denoise_step_seconds", "單一去噪步驟的耗時 (秒)",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0)
+)
+CACHE_LOOKUPS = registry.counter(
+    "mushroom_cache_lookups_total", "快取查詢次數", ("cache", "result")
+)
+REQUESTS = registry.counter(
+    "mushroom_requests_total", "API 請求數", ("endpoint", "status")
+)
+MEMORY_BYTES = registry.gauge(
+    "mushroom_memory_bytes", "記憶體使用量 (位元組)", ("kind",)
+)
+QUEUE_DEPTH = registry.gauge(
+    "mushroom_queue_depth", "佇列深度", ("queue", "state")
+)
+
+
+# ----------------------------------------------------------------------
+# 每個請求的分階段計時
+# ----------------------------------------------------------------------
+class StageTimings:
+    """單一請求 (或批次) 的各階段耗時，同一階段多次記錄時累加"""
+    def __init__(self, stages=None):
+        self._stages = dict(stages or {})
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self._stages[stage] = self._stages.get(stage, 0.0) + seconds
+
+    def fork(self):
+        """複製目前的耗時，讓批次中的每張圖像各自累加後處理階段"""
+        with self._lock:
+            return StageTimings(self._stages)
+
+    def as_dict(self):
+        with self._lock:
+            return {stage: round(seconds, 6) for stage, seconds in self._stages.items()}
+
+
+_local = threading.local()
+
+
+def current_timings():
+    """目前執行緒正在收集的 StageTimings，沒有時返回 None"""
+    return getattr(_local, "timings", None)
+
+
+@contextmanager
+def collect_timings(timings=None):
+    """在此區塊內，stage() / record_stage() 的耗時會累加到 timings"""
+    previous = current_timings()
+    _local.timings = timings if timings is not None else StageTimings()
+    try:
+        yield _local.timings
+    finally:
+        _local.timings = previous
+
+
+def observe_stage(stage, seconds):
+    """只記錄到直方圖 (不累加到請求的耗時)"""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+def record_stage(stage, seconds):
+    """記錄到直方圖，並累加到目前執行緒的請求耗時"""
+    observe_stage(stage, seconds)
+    timings = current_timings()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+@contextmanager
+def stage(name):
+    """計時一個處理階段"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def record_cache_lookup(cache, result):
+    """記錄快取查詢結果 (hit / miss / disk_hit ...)"""
+    CACHE_LOOKUPS.inc(cache=cache, result=result)
+
+
+class StepTimer:
+    """
+    以 callback_on_step_end 量測每個去噪步驟。
+    第一步包含管道內的前置工作 (準備 latents、未快取時的提示詞編碼)；
+    最後一步回調到管道返回之間的時間視為 VAE 解碼 (含轉換為 PIL 圖像)。
+    """
+    def __init__(self):
+        self._last = time.perf_counter()
+        self.steps = 0
+        self.denoise_seconds = 0.0
+
+    def callback(self, pipe, step, timestep, callback_kwargs):
+        now = time.perf_counter()
+        elapsed = now - self._last
+        self._last = now
+        self.steps += 1
+        self.denoise_seconds += elapsed
+        DENOISE_STEP_SECONDS.observe(elapsed)
+        return callback_kwargs
+
+    def finish(self):
+        """管道返回後調用，記錄去噪總耗時與 VAE 解碼耗時"""
+        decode_seconds = time.perf_counter() - self._last
+        if self.steps:
+            record_stage("denoise", self.denoise_seconds)
+            record_stage("vae_decode", decode_seconds)
+        else:
+            # 管道不支援步驟回調，無法拆分
+            record_stage("denoise_and_decode", decode_seconds)
+
+
+def render_latest():
+    """輸出 Prometheus 文字格式"""
+    return registry.render()
+
+print("--- [Metrics] 模塊已成功被定義。---", flush=True)
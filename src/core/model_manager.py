@@ -3,39 +3,434 @@
 用於加載和管理模型
 (偵錯修正版)
 """
+import os
 import sys
+import hashlib
+import re
+import gc
+import threading
+import weakref
 import importlib
+from contextlib import contextmanager
+
+from src.core import metrics
+from src.core.schedulers import SchedulerRegistry
+from src.core.cpu_acceleration import CpuAccelerator
+from src.core.onnx_backend import OnnxRuntimeBackend, sampled_parameter_hash
+from src.core.lora_fusion import LoraFuser
+from src.core.lora_registry import LoraRegistry
+from src.core.pipeline_cache import (
+    PipelineCache,
+    estimate_adapter_bytes,
+    estimate_pipeline_bytes,
+)
 
 print("--- [ModelManager] 模塊開始被導入... ---", flush=True)
 
 class ModelManager:
     """模型管理類，用於加載和管理模型"""
+    BASE_CACHE_KEY = "__base__"
+    
     def __init__(self, config):
         print("--- [ModelManager] __init__ 開始執行... ---", flush=True)
         self.config = config
         # 從設定檔獲取模型名稱，如果沒有則使用預設值
-        self.model_name = self.config.get('model', 'StableDiffusionV15Model')
-        print(f"--- [ModelManager] __init__ 完成。將要使用的模型名稱為: {self.model_name} ---", flush=True)
+        # 環境變數 MUSHROOM_MODEL 可覆寫 (例如負載測試使用 StubPipelineModel / TinyRandomSdModel)
+        self.model_name = os.getenv('MUSHROOM_MODEL') or self.config.get('model', 'StableDiffusionV15Model')
+        
+        # 常駐基礎管道模式：只加載一次基礎管道，LoRA 以具名 adapter 熱切換
+        manager_config = self.config.get('model_manager', {}) or {}
+        self.resident_base = manager_config.get('resident_base', False)
+        # keep: 保留已加載的 adapter，以 set_adapters 切換；unload: 切換前卸載其他 adapter
+        self.lora_swap_mode = manager_config.get('lora_swap_mode', 'keep')
+        # adapter: 以 PEFT adapter 推理；fused: 把 LoRA 增量融合進基礎權重 (僅常駐模式)，推理沒有額外開銷
+        self.lora_mode = manager_config.get('lora_mode', 'adapter')
+        self.fused_scale = float(manager_config.get('fused_scale', 1.0))
+        self.lora_fuser = LoraFuser.from_config(self.config) if self.resident_base and self.lora_mode == 'fused' else None
+        self.model_instance = None
+        self.base_pipe = None
+        self.loaded_adapters = {}  # weight_name -> adapter_name，依加載順序
+        self.active_weight_name = None
+        self.active_loras = ()  # 目前啟用的 ((weight_name, 強度), ...)
+        # 基礎模型權重的取樣雜湊 (第一次加載管道後、掛載 LoRA 之前計算)，用於識別實際使用的權重
+        self.model_fingerprint = None
+        # 切換 adapter 與使用管道生成必須互斥，避免多執行緒互相覆蓋 LoRA 狀態
+        self.lock = threading.RLock()
+        
+        # 管道 / adapter 快取：常駐模式下快取 adapter (基礎管道固定常駐)，否則快取完整管道
+        cache_config = self.config.get('pipeline_cache', {}) or {}
+        max_memory_mb = cache_config.get('max_memory_mb')
+        self.cache = PipelineCache(
+            max_bytes=int(max_memory_mb * 1024**2) if max_memory_mb else None,
+            max_entries=cache_config.get('max_entries'),
+            on_evict=self._on_cache_evict
+        )
+        
+        # CPU 加速設定：裝置為 CPU 時由模型在 optimize_pipeline 中套用
+        self.cpu_accelerator = CpuAccelerator.from_config(self.config)
+        # ONNX Runtime 後端 (onnx_runtime.enabled 時)：CPU 上以 ONNX Runtime 執行 UNet / VAE 解碼 / Text Encoder
+        self.onnx_backend = OnnxRuntimeBackend.from_config(self.config)
+        
+        # LoRA 註冊表：啟動時索引權重檔 (只讀標頭)，加載時重用快取的 state dict
+        self.lora_registry = LoraRegistry.from_config(self.config)
+        self.lora_registry.scan()
+        
+        # Scheduler 註冊表：依模型預設或請求在快取的管道上切換 scheduler
+        self.schedulers = SchedulerRegistry.from_config(self.config)
+        
+        # img2img 管道與 txt2img 管道共用組件，依基礎管道快取
+        img2img_config = self.config.get('img2img', {}) or {}
+        self.img2img_enabled = img2img_config.get('enabled', False)
+        self._img2img_pipes = weakref.WeakKeyDictionary()
+        print(f"--- [ModelManager] __init__ 完成。將要使用的模型名稱為: {self.model_name} (常駐基礎管道: {self.resident_base}) ---", flush=True)
     
-    def load_model(self, weight_name):
-        """加載模型"""
+    def load_model(self, loras):
+        """加載模型 (非常駐模式)，loras 為單一權重檔名或 [(weight_name, 強度)]"""
+        loras = self.normalize_loras(loras)
         print(f"--- [ModelManager] load_model 開始執行，準備加載模型: {self.model_name} ---", flush=True)
         # 動態創建模型實例
         model_instance = self._create_model_instance()
+        if self.model_instance is None:
+            self.model_instance = model_instance
         
         # 加載模型管道 (這一步可能會非常耗時和耗資源)
         print(f"--- [ModelManager] 準備調用 {self.model_name}.load_pipeline()... ---", flush=True)
-        pipe = model_instance.load_pipeline()
+        with metrics.stage("pipeline_load"):
+            pipe = model_instance.load_pipeline()
+        self._record_model_fingerprint(pipe)
         print("--- [ModelManager] pipeline 加載成功。---", flush=True)
         
         # 加載 LoRA 權重
-        if weight_name:
+        if len(loras) == 1 and loras[0][1] == 1.0:
+            weight_name = loras[0][0]
             print(f"--- [ModelManager] 準備為 pipeline 加載 LoRA 權重: {weight_name} ---", flush=True)
-            pipe = model_instance.load_lora_weights(pipe, weight_name)
+            with metrics.stage("lora_load"):
+                pipe = model_instance.load_lora_weights(pipe, weight_name)
             print("--- [ModelManager] LoRA 權重加載成功。---", flush=True)
+        elif loras:
+            # 多個 LoRA 或非 1.0 的強度：以具名 adapter 加載後以 adapter 權重組合
+            adapter_names = []
+            with metrics.stage("lora_load"):
+                for weight_name, _ in loras:
+                    adapter_name = self._adapter_name(weight_name)
+                    pipe = model_instance.load_lora_weights(pipe, weight_name, adapter_name=adapter_name)
+                    adapter_names.append(adapter_name)
+            pipe.set_adapters(adapter_names, adapter_weights=[scale for _, scale in loras])
+            print(f"--- [ModelManager] LoRA 權重加載成功: {self.lora_key(loras)} ---", flush=True)
         
         return pipe
     
+    def load_base_pipeline(self):
+        """加載常駐基礎管道 (只在第一次調用時真正加載)"""
+        with self.lock:
+            if self.base_pipe is None:
+                print(f"--- [ModelManager] 常駐模式：準備加載基礎管道 {self.model_name}... ---", flush=True)
+                self.model_instance = self._create_model_instance()
+                with metrics.stage("pipeline_load"):
+                    self.base_pipe = self.model_instance.load_pipeline()
+                self._record_model_fingerprint(self.base_pipe)
+                self.loaded_adapters = {}
+                self._set_active([])
+                self.cache.put(self.BASE_CACHE_KEY, self.base_pipe, estimate_pipeline_bytes(self.base_pipe), pinned=True)
+                print("--- [ModelManager] 常駐基礎管道加載成功。---", flush=True)
+            return self.base_pipe
+    
+    def _record_model_fingerprint(self, pipe):
+        """計算基礎模型權重的指紋 (UNet / Text Encoder / VAE 的取樣雜湊)，只計算一次"""
+        if self.model_fingerprint is not None:
+            return
+        try:
+            digest = hashlib.sha256(self.model_name.encode())
+            for component_name in ("unet", "text_encoder", "text_encoder_2", "vae"):
+                module = getattr(pipe, component_name, None)
+                if module is not None and hasattr(module, "state_dict"):
+                    digest.update(component_name.encode())
+                    digest.update(sampled_parameter_hash(module).encode())
+            self.model_fingerprint = digest.hexdigest()
+        except Exception as e:
+            print(f"⚠️ 無法計算基礎模型指紋: {e}", flush=True)
+    
+    def output_fingerprint(self):
+        """
+        影響生成結果的模型與執行設定：基礎權重指紋、裝置、管道優化開關、CPU bf16 / 編譯、
+        ONNX Runtime (含量化) 與融合強度。基礎管道尚未加載 (指紋未知) 時返回 None。
+        """
+        if self.model_fingerprint is None:
+            return None
+        device = getattr(self.model_instance, 'device', None)
+        optimizations = dict(getattr(self.model_instance, 'optimizations', None) or {})
+        on_cpu = device == "cpu"
+        cpu_profile = on_cpu and optimizations.get("cpu_profile", False)
+        onnx = None
+        if self.onnx_backend is not None and on_cpu:
+            onnx = {
+                "components": list(self.onnx_backend.components),
+                "quantize": self.onnx_backend.quantize,
+                "quantize_components": list(self.onnx_backend.quantize_components),
+                "opset": self.onnx_backend.opset,
+            }
+        return {
+            "model_fingerprint": self.model_fingerprint,
+            "device": device,
+            "optimizations": optimizations,
+            "cpu_bf16": bool(cpu_profile and self.cpu_accelerator.use_bf16()),
+            "cpu_compile": bool(cpu_profile and onnx is None and self.cpu_accelerator.compile_unet),
+            "cpu_compile_mode": self.cpu_accelerator.compile_mode if cpu_profile else None,
+            "onnx_runtime": onnx,
+            "lora_mode": self.lora_mode if self.resident_base else "pipeline",
+            "fused_scale": self.fused_scale if self.lora_fuser is not None else None,
+        }
+    
+    def get_pipeline(self, loras, scheduler=None):
+        """
+        取得已切換到指定 LoRA 與 scheduler 的管道。
+        loras 為單一權重檔名 (強度 1.0)、None (基礎模型) 或 [(weight_name, 強度)]。
+        常駐模式下重用同一個基礎管道；非常駐模式則依 LoRA 組合從管道快取取得，未命中時以 load_model 完整重建。
+        scheduler 為 None 時使用模型在設定檔中的預設 scheduler。
+        """
+        with self.lock:
+            if not self.resident_base:
+                pipe = self.cache.get_or_load(
+                    self.lora_key(loras),
+                    lambda: self.load_model(loras),
+                    sizer=estimate_pipeline_bytes
+                )
+            else:
+                self.load_base_pipeline()
+                pipe = self.activate_loras(loras)
+            return self.apply_scheduler(pipe, scheduler)
+    
+    def apply_scheduler(self, pipe, scheduler=None):
+        """在管道上切換 scheduler (不重新加載模型)"""
+        scheduler = scheduler or self.schedulers.resolve(self.model_name, 0)[0]
+        overrides = getattr(self.model_instance, '_scheduler_overrides', None)
+        return self.schedulers.apply(pipe, scheduler, overrides)
+    
+    @contextmanager
+    def pipeline_session(self, loras, scheduler=None):
+        """在持有鎖的期間切換 LoRA 組合與 scheduler 並提供管道，確保生成過程中不被其他請求切換"""
+        with self.lock:
+            yield self.get_pipeline(loras, scheduler)
+    
+    def get_img2img_pipeline(self, pipe):
+        """
+        取得與指定管道共用組件的 img2img 管道 (包含已掛載的 LoRA adapter)。
+        設定檔停用或模型不支援時返回 None。
+        """
+        if not self.img2img_enabled or pipe is None:
+            return None
+        with self.lock:
+            if pipe in self._img2img_pipes:
+                img2img_pipe = self._img2img_pipes[pipe]
+                if img2img_pipe is not None:
+                    # 與 txt2img 管道共用目前的 scheduler
+                    img2img_pipe.scheduler = pipe.scheduler
+                return img2img_pipe
+            model_instance = self.model_instance or self._create_model_instance()
+            self.model_instance = model_instance
+            try:
+                img2img_pipe = model_instance.to_img2img_pipeline(pipe)
+            except Exception as e:
+                print(f"⚠️ 建立 img2img 管道失敗，將使用文字生成圖像: {e}", file=sys.stderr, flush=True)
+                img2img_pipe = None
+            self._img2img_pipes[pipe] = img2img_pipe
+            return img2img_pipe
+    
+    def cache_stats(self):
+        """返回管道 / adapter 快取的統計資訊"""
+        stats = self.cache.stats()
+        stats["mode"] = "adapter" if self.resident_base else "pipeline"
+        stats["lora_mode"] = self.lora_mode if self.resident_base else "pipeline"
+        stats["active_weight_name"] = self.active_weight_name
+        stats["active_loras"] = [list(item) for item in self.active_loras]
+        if self.lora_fuser is not None:
+            stats["lora_fusion"] = self.lora_fuser.stats()
+        return stats
+    
+    @staticmethod
+    def normalize_loras(loras):
+        """
+        將 LoRA 指定統一為 [(weight_name, 強度)]：
+        None / 空字串表示基礎模型，字串表示單一 LoRA (強度 1.0)，列表的項目可為字串或 (weight_name, 強度)
+        """
+        if not loras:
+            return []
+        if isinstance(loras, str):
+            return [(loras, 1.0)]
+        normalized = []
+        for item in loras:
+            weight_name, scale = (item, 1.0) if isinstance(item, str) else item
+            if weight_name:
+                normalized.append((weight_name, float(scale)))
+        return normalized
+    
+    @staticmethod
+    def lora_key(loras):
+        """
+        LoRA 組合的識別字串 (用於輸出目錄、提示詞嵌入快取與非常駐模式的管道快取)。
+        單一 LoRA 且強度 1.0 時就是權重檔名，與原本的行為相同。
+        """
+        loras = ModelManager.normalize_loras(loras)
+        if not loras:
+            return "base"
+        if len(loras) == 1 and loras[0][1] == 1.0:
+            return loras[0][0]
+        return "+".join(f"{weight_name}@{scale:g}" for weight_name, scale in loras)
+    
+    def activate_lora(self, weight_name):
+        """在常駐基礎管道上啟用指定 LoRA，尚未加載時先以具名 adapter 加載"""
+        return self.activate_loras(weight_name)
+    
+    def activate_loras(self, loras):
+        """
+        在常駐基礎管道上啟用一組 LoRA ([(weight_name, 強度)])。
+        每個 LoRA 只以具名 adapter 加載一次，之後以 set_adapters 的 adapter 權重組合，不複製管道；
+        調用者必須持有 self.lock 直到生成結束 (pipeline_session)，其他執行緒才不會在生成途中改變組合。
+        """
+        loras = self.normalize_loras(loras)
+        with self.lock:
+            pipe = self.load_base_pipeline()
+            if self.lora_fuser is not None:
+                return self._activate_fused_loras(pipe, loras)
+            for weight_name, _ in loras:
+                # 記錄命中 / 未命中並更新 LRU 順序
+                self.cache.get(weight_name)
+            if tuple(loras) == self.active_loras:
+                return pipe
+            
+            requested = {weight_name for weight_name, _ in loras}
+            if self.lora_swap_mode == 'unload':
+                for loaded_weight_name in list(self.loaded_adapters):
+                    if loaded_weight_name not in requested:
+                        self.unload_lora(loaded_weight_name)
+            
+            for weight_name, _ in loras:
+                if weight_name in self.loaded_adapters:
+                    continue
+                adapter_name = self._adapter_name(weight_name)
+                print(f"--- [ModelManager] 準備為常駐管道加載 LoRA adapter: {weight_name} ({adapter_name}) ---", flush=True)
+                with metrics.stage("lora_load"):
+                    self.model_instance.load_lora_weights(pipe, weight_name, adapter_name=adapter_name)
+                if self._has_adapter(pipe, adapter_name):
+                    self.loaded_adapters[weight_name] = adapter_name
+                    # 登記到快取，超出預算時會淘汰最久未使用的 adapter
+                    self.cache.put(weight_name, adapter_name, estimate_adapter_bytes(pipe, adapter_name))
+            
+            active = [(weight_name, scale) for weight_name, scale in loras if weight_name in self.loaded_adapters]
+            missing = [weight_name for weight_name, _ in loras if weight_name not in self.loaded_adapters]
+            if missing:
+                # 加載失敗，或管道快取預算不足以同時容納整組 adapter
+                print(f"⚠️ 無法啟用 LoRA，將略過: {', '.join(missing)}", file=sys.stderr, flush=True)
+            
+            try:
+                if active:
+                    pipe.enable_lora()
+                    pipe.set_adapters(
+                        [self.loaded_adapters[weight_name] for weight_name, _ in active],
+                        adapter_weights=[scale for _, scale in active]
+                    )
+                    print(f"--- [ModelManager] 已切換到 LoRA adapter: {self.lora_key(active)} ---", flush=True)
+                elif self.loaded_adapters:
+                    # 沒有指定 LoRA，停用其他 adapter 以使用基礎模型
+                    pipe.disable_lora()
+                    print("--- [ModelManager] 未啟用 LoRA，使用基礎模型。---", flush=True)
+            except Exception as e:
+                print(f"⚠️ 切換 LoRA adapter 失敗: {e}", file=sys.stderr, flush=True)
+                raise
+            
+            self._set_active(loras)
+            return pipe
+    
+    def _set_active(self, loras):
+        self.active_loras = tuple(loras)
+        self.active_weight_name = self.lora_key(loras) if loras else None
+    
+    def _activate_fused_loras(self, pipe, loras):
+        """
+        融合模式：增量未快取時先以 adapter 加載並計算增量，隨即移除 PEFT 層，
+        再從原始權重融合整組 LoRA (強度再乘上 fused_scale；切換回已快取的 LoRA 不需重新讀取權重檔)。
+        """
+        if tuple(loras) == self.active_loras:
+            return pipe
+        for weight_name, _ in loras:
+            if self.lora_fuser.has_deltas(weight_name):
+                continue
+            adapter_name = self._adapter_name(weight_name)
+            print(f"--- [ModelManager] 融合模式：準備加載 LoRA 並計算增量: {weight_name} ---", flush=True)
+            with metrics.stage("lora_load"):
+                self.model_instance.load_lora_weights(pipe, weight_name, adapter_name=adapter_name)
+                if self._has_adapter(pipe, adapter_name):
+                    self.lora_fuser.extract(pipe, weight_name, adapter_name)
+                # 融合模式不保留任何 adapter，移除 PEFT 包裝層
+                self.model_instance.unload_lora_weights(pipe)
+        
+        missing = [weight_name for weight_name, _ in loras if not self.lora_fuser.has_deltas(weight_name)]
+        if missing:
+            print(f"⚠️ 無法融合 LoRA，將略過: {', '.join(missing)}", file=sys.stderr, flush=True)
+        with metrics.stage("lora_fuse"):
+            self.lora_fuser.fuse(pipe, [
+                (weight_name, scale * self.fused_scale)
+                for weight_name, scale in loras if weight_name not in missing
+            ])
+        self._set_active(loras)
+        return pipe
+    
+    def unload_lora(self, weight_name):
+        """從常駐基礎管道卸載指定 LoRA adapter"""
+        with self.lock:
+            adapter_name = self.loaded_adapters.pop(weight_name, None)
+            self.cache.pop(weight_name)
+            if adapter_name is None or self.base_pipe is None:
+                return
+            self.model_instance.unload_lora_weights(self.base_pipe, adapter_name)
+            if any(active_weight_name == weight_name for active_weight_name, _ in self.active_loras):
+                self._set_active([])
+    
+    def _on_cache_evict(self, key, value):
+        """快取淘汰回調：卸載 adapter 或釋放完整管道"""
+        if self.resident_base:
+            if key in self.loaded_adapters:
+                self.unload_lora(key)
+            return
+        del value
+        gc.collect()
+        try:
+            import torch
+            if torch.cuda.is_available() and torch.cuda.device_count() > 0:
+                torch.cuda.empty_cache()
+            elif hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
+                torch.mps.empty_cache()
+        except Exception:
+            pass
+    
+    @staticmethod
+    def _adapter_name(weight_name):
+        """將權重檔名轉為合法的 adapter 名稱 (例如 dgu-01.safetensors -> dgu_01)"""
+        stem = weight_name.rsplit('.', 1)[0] if weight_name.endswith('.safetensors') else weight_name
+        return re.sub(r'[^0-9A-Za-z_]', '_', stem)
+    
+    @staticmethod
+    def _has_adapter(pipe, adapter_name):
+        """檢查管道上是否已成功掛載指定 adapter"""
+        try:
+            adapters = pipe.get_list_adapters()
+        except Exception:
+            return False
+        return any(adapter_name in names for names in adapters.values())
+    
+    def _configure_model(self, model_instance):
+        """套用設定檔 optimizations 區塊的管道優化開關、CPU 加速設定、執行後端與 LoRA 註冊表"""
+        optimizations = self.config.get('optimizations', {}) or {}
+        if optimizations and hasattr(model_instance, 'set_optimizations'):
+            model_instance.set_optimizations(optimizations)
+        if hasattr(model_instance, 'set_cpu_accelerator'):
+            model_instance.set_cpu_accelerator(self.cpu_accelerator)
+        if hasattr(model_instance, 'set_execution_backend'):
+            model_instance.set_execution_backend(self.onnx_backend)
+        if hasattr(model_instance, 'set_lora_registry'):
+            model_instance.set_lora_registry(self.lora_registry)
+        return model_instance
+    
     def _create_model_instance(self):
         """
         創建模型實例。
@@ -62,7 +457,7 @@ class ModelManager:
             module = importlib.import_module(module_name)
             model_class = getattr(module, self.model_name)
             print(f"--- [ModelManager] 成功從 {module_name} 找到類別: {self.model_name} ---", flush=True)
-            return model_class()
+            return self._configure_model(model_class())
         except (ImportError, AttributeError, ModuleNotFoundError) as e:
             print(f"--- [ModelManager] 從 {module_name} 導入失敗: {e}。嘗試備用路徑... ---", flush=True)
             # 可以在此添加其他備用路徑，但為了除錯，我們先專注於主要路徑
@@ -75,7 +470,7 @@ class ModelManager:
                 # 在這裡才進行導入，而不是在檔案頂部
                 from src.models.stable_diffusion_v1_5 import StableDiffusionV15Model
                 print("--- [ModelManager] 預設模型 StableDiffusionV15Model 導入成功，將使用它。 ---", flush=True)
-                return StableDiffusionV15Model()
+                return self._configure_model(StableDiffusionV15Model())
             except Exception as final_e:
                 print(f"!!!!!!!! 致命錯誤：連預設的 StableDiffusionV15Model 都無法導入！錯誤: {final_e} !!!!!!!!", file=sys.stderr, flush=True)
                 # 拋出一個更清晰的異常，讓 FastAPI 可以捕捉並返回 500 錯誤
@@ -0,0 +1,484 @@
+"""
+ONNX Runtime 執行後端模塊
+將 SD v1.5 管道的 UNet (融合目前啟用的 LoRA)、VAE 解碼器與 Text Encoder 匯出為 ONNX，
+以 CPU 的 ONNX Runtime session 執行推理；匯出結果依模型、LoRA 與 dtype 指紋快取在磁碟上，
+並可選擇動態 int8 量化
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import weakref
+from types import SimpleNamespace
+from collections import OrderedDict
+
+import torch
+
+from src.core import metrics
+from src.core.cpu_acceleration import available_cpus
+
+print("--- [OnnxRuntimeBackend] 模塊開始被導入... ---", flush=True)
+
+# 匯出格式版本：匯出方式改變時遞增，讓舊的快取失效
+EXPORT_FORMAT_VERSION = 1
+COMPONENTS = ("unet", "vae_decoder", "text_encoder")
+
+
+def _tuner_layers(module):
+    """模組中的 PEFT LoRA 層"""
+    try:
+        from peft.tuners.tuners_utils import BaseTunerLayer
+    except ImportError:
+        return []
+    return [layer for layer in module.modules() if isinstance(layer, BaseTunerLayer)]
+
+
+def _lora_state(layers):
+    """
+    目前 LoRA 狀態的輕量鍵：(是否停用, 啟用的 adapter, 第一層的強度, LoRA 層數)。
+    set_adapters / disable_lora / 調整強度都會改變這個鍵。
+    """
+    if not layers:
+        return None
+    first = layers[0]
+    if getattr(first, "disable_adapters", False):
+        return (True,)
+    active = tuple(first.active_adapters)
+    scaling = getattr(first, "scaling", {}) or {}
+    return (False, active, tuple(float(scaling.get(name, 1.0)) for name in active), len(layers))
+
+
+def sampled_parameter_hash(module):
+    """
+    基礎權重的指紋：每個參數取固定數量的等距樣本計算雜湊，不讀取全部權重。
+    PEFT 包裝後的參數名稱 (base_layer) 還原為原名，LoRA 參數不計入。
+    """
+    digest = hashlib.sha256()
+    with torch.no_grad():
+        for name, parameter in module.state_dict().items():
+            if "lora_" in name:
+                continue
+            flat = parameter.detach().reshape(-1)
+            stride = max(1, flat.numel() // 64)
+            digest.update(name.replace(".base_layer", "").encode())
+            digest.update(str(tuple(parameter.shape)).encode())
+            digest.update(flat[::stride][:64].float().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def _module_config(module):
+    config = getattr(module, "config", None)
+    if config is None:
+        return {}
+    if hasattr(config, "to_dict"):
+        config = config.to_dict()
+    return {key: value for key, value in dict(config).items() if not key.startswith("_")}
+
+
+class _UNetExport(torch.nn.Module):
+    def __init__(self, unet, forward):
+        super().__init__()
+        self.unet = unet
+        self._forward = forward
+
+    def forward(self, sample, timestep, encoder_hidden_states):
+        return self._forward(sample, timestep, encoder_hidden_states, return_dict=False)[0]
+
+
+class _VaeDecoderExport(torch.nn.Module):
+    def __init__(self, vae, decode):
+        super().__init__()
+        self.vae = vae
+        self._decode = decode
+
+    def forward(self, latent_sample):
+        return self._decode(latent_sample, return_dict=False)[0]
+
+
+class _TextEncoderExport(torch.nn.Module):
+    def __init__(self, text_encoder, forward):
+        super().__init__()
+        self.text_encoder = text_encoder
+        self._forward = forward
+
+    def forward(self, input_ids):
+        outputs = self._forward(input_ids, return_dict=False)
+        return outputs[0], outputs[1]
+
+
+class OnnxRuntimeBackend:
+    """
+    ONNX Runtime 執行後端。
+    attach() 把管道中 UNet / Text Encoder 的 forward 與 VAE 的 decode 換成 ONNX Runtime 推理，
+    原本的 PyTorch 模組保留在管道中：LoRA 加載與切換、scheduler 切換、提示詞快取與 img2img 都照常運作。
+    每次推理依目前啟用的 LoRA 選擇對應的匯出結果，尚未匯出時先匯出 (融合 LoRA 後匯出再還原)；
+    不支援的調用 (例如 SDXL 的額外條件、非 1.0 的 LoRA 強度參數) 退回 PyTorch。
+    """
+    def __init__(self, cache_dir="assets/models/onnx", components=COMPONENTS, quantize=None,
+                 quantize_components=("unet", "text_encoder"), opset=17, intra_op_threads=None,
+                 max_sessions_per_component=1):
+        self.cache_dir = cache_dir
+        self.components = tuple(components or ())
+        self.quantize = quantize or None
+        self.quantize_components = tuple(quantize_components or ())
+        self.opset = int(opset)
+        self.intra_op_threads = intra_op_threads
+        self.max_sessions_per_component = max(1, int(max_sessions_per_component))
+        self._sessions = OrderedDict()  # (component, fingerprint) -> InferenceSession
+        self._base_fingerprints = weakref.WeakKeyDictionary()  # module -> 基礎權重指紋
+        self._lora_fingerprints = {}  # (id(module), LoRA 狀態) -> LoRA 權重雜湊
+        self._lock = threading.RLock()
+        self.exports = 0
+        self.export_seconds = 0.0
+        self.session_loads = 0
+        self.fallbacks = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """從設定檔的 onnx_runtime 區塊建立後端，未啟用時返回 None"""
+        onnx_config = config.get('onnx_runtime', {}) or {}
+        if not onnx_config.get('enabled', False):
+            return None
+        return cls(
+            cache_dir=onnx_config.get('cache_dir', 'assets/models/onnx'),
+            components=onnx_config.get('components', COMPONENTS),
+            quantize=onnx_config.get('quantize'),
+            quantize_components=onnx_config.get('quantize_components', ("unet", "text_encoder")),
+            opset=onnx_config.get('opset', 17),
+            intra_op_threads=onnx_config.get('intra_op_threads'),
+            max_sessions_per_component=onnx_config.get('max_sessions_per_component', 1)
+        )
+
+    @staticmethod
+    def supports(pipe):
+        """只支援 SD v1.5 架構 (單一 Text Encoder、沒有額外條件嵌入)"""
+        unet = getattr(pipe, "unet", None)
+        if unet is None or getattr(pipe, "text_encoder", None) is None or hasattr(pipe, "text_encoder_2"):
+            return False
+        return getattr(unet.config, "addition_embed_type", None) is None
+
+    def attach(self, pipe, model_name):
+        """以 ONNX Runtime 取代管道的推理模組 (模組本身保留，作為匯出來源與退回路徑)"""
+        try:
+            import onnxruntime  # noqa: F401
+        except ImportError:
+            print("⚠️ 未安裝 onnxruntime，維持 PyTorch 推理")
+            return pipe
+        if not self.supports(pipe):
+            print(f"ℹ️ ONNX Runtime 後端只支援 SD v1.5 架構，{model_name} 維持 PyTorch 推理")
+            return pipe
+
+        dtype = str(pipe.unet.dtype)
+        if "unet" in self.components:
+            self._attach_unet(pipe.unet, model_name, dtype)
+        if "vae_decoder" in self.components and getattr(pipe, "vae", None) is not None:
+            self._attach_vae_decoder(pipe.vae, model_name, dtype)
+        if "text_encoder" in self.components:
+            self._attach_text_encoder(pipe.text_encoder, model_name, dtype)
+        print(f"✅ 已啟用 ONNX Runtime 後端: {', '.join(self.components)} (量化: {self.quantize or '無'})")
+        return pipe
+
+    # ---------- 各組件的替換 ----------
+
+    def _attach_unet(self, unet, model_name, dtype):
+        torch_forward = unet.forward
+        # 匯出時使用類別原本的 forward，不包含 autocast 等包裝
+        export_forward = type(unet).forward.__get__(unet)
+        backend = self
+
+        def onnx_forward(sample, timestep, encoder_hidden_states, timestep_cond=None, attention_mask=None,
+                         cross_attention_kwargs=None, added_cond_kwargs=None, return_dict=True, **kwargs):
+            unsupported = (
+                timestep_cond is not None or attention_mask is not None or added_cond_kwargs
+                or any(value is not None for value in kwargs.values())
+                or float((cross_attention_kwargs or {}).get("scale", 1.0)) != 1.0
+            )
+            if unsupported:
+                backend.fallbacks += 1
+                return torch_forward(
+                    sample, timestep, encoder_hidden_states, timestep_cond=timestep_cond,
+                    attention_mask=attention_mask, cross_attention_kwargs=cross_attention_kwargs,
+                    added_cond_kwargs=added_cond_kwargs, return_dict=return_dict, **kwargs
+                )
+            session = backend._session("unet", unet, model_name, dtype, lambda path: backend._export(
+                _UNetExport(unet, export_forward),
+                (
+                    torch.randn(2, unet.config.in_channels, 64, 64),
+                    torch.tensor([999.0, 999.0]),
+                    torch.randn(2, 77, unet.config.cross_attention_dim)
+                ),
+                path,
+                input_names=["sample", "timestep", "encoder_hidden_states"],
+                output_names=["out_sample"],
+                dynamic_axes={
+                    "sample": {0: "batch", 2: "height", 3: "width"},
+                    "timestep": {0: "batch"},
+                    "encoder_hidden_states": {0: "batch", 1: "sequence"},
+                    "out_sample": {0: "batch", 2: "height", 3: "width"},
+                },
+                merge_lora_of=unet
+            ))
+            timesteps = torch.as_tensor(timestep, dtype=torch.float32).reshape(-1).expand(sample.shape[0])
+            output = session.run(None, {
+                "sample": sample.detach().float().cpu().numpy(),
+                "timestep": timesteps.contiguous().numpy(),
+                "encoder_hidden_states": encoder_hidden_states.detach().float().cpu().numpy(),
+            })[0]
+            output = torch.from_numpy(output).to(device=sample.device, dtype=sample.dtype)
+            return (output,) if not return_dict else SimpleNamespace(sample=output)
+
+        unet.forward = onnx_forward
+
+    def _attach_vae_decoder(self, vae, model_name, dtype):
+        torch_decode = vae.decode
+        export_decode = type(vae).decode.__get__(vae)
+        backend = self
+
+        def export(path):
+            # 以完整張量匯出 (不經過切片 / 平鋪分支)
+            use_slicing, use_tiling = getattr(vae, "use_slicing", False), getattr(vae, "use_tiling", False)
+            vae.use_slicing = vae.use_tiling = False
+            try:
+                backend._export(
+                    _VaeDecoderExport(vae, export_decode),
+                    (torch.randn(1, vae.config.latent_channels, 64, 64),),
+                    path,
+                    input_names=["latent_sample"],
+                    output_names=["sample"],
+                    dynamic_axes={
+                        "latent_sample": {0: "batch", 2: "height", 3: "width"},
+                        "sample": {0: "batch", 2: "height", 3: "width"},
+                    }
+                )
+            finally:
+                vae.use_slicing, vae.use_tiling = use_slicing, use_tiling
+
+        def onnx_decode(z, return_dict=True, generator=None, **kwargs):
+            if kwargs:
+                backend.fallbacks += 1
+                return torch_decode(z, return_dict=return_dict, generator=generator, **kwargs)
+            session = backend._session("vae_decoder", vae, model_name, dtype, export)
+            output = session.run(None, {"latent_sample": z.detach().float().cpu().numpy()})[0]
+            output = torch.from_numpy(output).to(device=z.device, dtype=z.dtype)
+            return (output,) if not return_dict else SimpleNamespace(sample=output)
+
+        vae.decode = onnx_decode
+
+    def _attach_text_encoder(self, text_encoder, model_name, dtype):
+        from transformers.modeling_outputs import BaseModelOutputWithPooling
+
+        torch_forward = text_encoder.forward
+        export_forward = type(text_encoder).forward.__get__(text_encoder)
+        max_length = getattr(text_encoder.config, "max_position_embeddings", 77)
+        backend = self
+
+        def onnx_forward(input_ids=None, attention_mask=None, position_ids=None, output_attentions=None,
+                         output_hidden_states=None, return_dict=None, **kwargs):
+            if attention_mask is not None or position_ids is not None or output_attentions or output_hidden_states or kwargs:
+                # clip_skip 需要中間層的輸出，退回 PyTorch
+                backend.fallbacks += 1
+                return torch_forward(
+                    input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                    output_attentions=output_attentions, output_hidden_states=output_hidden_states,
+                    return_dict=return_dict, **kwargs
+                )
+            session = backend._session("text_encoder", text_encoder, model_name, dtype, lambda path: backend._export(
+                _TextEncoderExport(text_encoder, export_forward),
+                (torch.ones(1, max_length, dtype=torch.long),),
+                path,
+                input_names=["input_ids"],
+                output_names=["last_hidden_state", "pooler_output"],
+                dynamic_axes={
+                    "input_ids": {0: "batch", 1: "sequence"},
+                    "last_hidden_state": {0: "batch", 1: "sequence"},
+                    "pooler_output": {0: "batch"},
+                },
+                merge_lora_of=text_encoder
+            ))
+            last_hidden_state, pooler_output = session.run(None, {"input_ids": input_ids.detach().cpu().long().numpy()})
+            last_hidden_state = torch.from_numpy(last_hidden_state).to(input_ids.device)
+            pooler_output = torch.from_numpy(pooler_output).to(input_ids.device)
+            if return_dict is False:
+                return (last_hidden_state, pooler_output)
+            return BaseModelOutputWithPooling(last_hidden_state=last_hidden_state, pooler_output=pooler_output)
+
+        text_encoder.forward = onnx_forward
+
+    # ---------- 指紋、匯出與 session ----------
+
+    def fingerprint(self, component, module, model_name, dtype):
+        """
+        匯出結果的指紋：模型名稱、組件設定、基礎權重的取樣雜湊、啟用中 LoRA 的權重雜湊與強度、
+        dtype、量化方式、opset 與匯出格式版本
+        """
+        base = self._base_fingerprints.get(module)
+        if base is None:
+            base = sampled_parameter_hash(module)
+            self._base_fingerprints[module] = base
+        layers = _tuner_layers(module) if component != "vae_decoder" else []
+        state = _lora_state(layers)
+        lora = None
+        if state is not None and not state[0]:
+            lora_key = (id(module), state)
+            lora = self._lora_fingerprints.get(lora_key)
+            if lora is None:
+                lora = self._lora_hash(module, state[1])
+                self._lora_fingerprints[lora_key] = lora
+            lora = {"adapters": list(state[1]), "scaling": list(state[2]), "sha256": lora}
+        details = {
+            "format_version": EXPORT_FORMAT_VERSION,
+            "model": model_name,
+            "component": component,
+            "class": type(module).__name__,
+            "config": _module_config(module),
+            "base_sha256": base,
+            "lora": lora,
+            # LoraFuser 直接改寫基礎權重時標記的融合組合
+            "fused_lora": getattr(module, "_fused_loras", None),
+            "dtype": dtype,
+            "quantize": self.quantize if component in self.quantize_components else None,
+            "opset": self.opset,
+        }
+        key = hashlib.sha256(json.dumps(details, sort_keys=True, default=str).encode()).hexdigest()
+        return key, details
+
+    @staticmethod
+    def _lora_hash(module, adapters):
+        """啟用中 adapter 的完整 LoRA 權重雜湊 (LoRA 參數量小，每個狀態只計算一次)"""
+        digest = hashlib.sha256()
+        with torch.no_grad():
+            for name, parameter in module.state_dict().items():
+                if "lora_" in name and any(f".{adapter}." in name or name.endswith(f".{adapter}") for adapter in adapters):
+                    digest.update(name.encode())
+                    digest.update(parameter.detach().float().cpu().numpy().tobytes())
+        return digest.hexdigest()
+
+    def _session(self, component, module, model_name, dtype, export):
+        """取得目前狀態對應的 session：記憶體中 -> 磁碟快取 -> 匯出"""
+        key, details = self.fingerprint(component, module, model_name, dtype)
+        with self._lock:
+            session = self._sessions.get((component, key))
+            if session is not None:
+                self._sessions.move_to_end((component, key))
+                metrics.record_cache_lookup("onnx_session", "hit")
+                return session
+            metrics.record_cache_lookup("onnx_session", "miss")
+
+            export_dir = os.path.join(self.cache_dir, f"{component}-{key[:16]}")
+            model_path = os.path.join(export_dir, "model.onnx")
+            if not self._export_is_valid(export_dir, details):
+                self._export_component(component, export_dir, details, export)
+
+            session = self._load_session(model_path)
+            self._sessions[(component, key)] = session
+            # 每個組件只保留最近使用的 session (UNet 的 session 與模型同樣大)
+            same_component = [entry for entry in self._sessions if entry[0] == component]
+            for entry in same_component[:-self.max_sessions_per_component]:
+                del self._sessions[entry]
+            return session
+
+    @staticmethod
+    def _export_is_valid(export_dir, details):
+        fingerprint_path = os.path.join(export_dir, "fingerprint.json")
+        if not os.path.exists(fingerprint_path):
+            return False
+        try:
+            with open(fingerprint_path, 'r', encoding='utf-8') as f:
+                return json.load(f) == json.loads(json.dumps(details, sort_keys=True, default=str))
+        except Exception as e:
+            print(f"⚠️ 讀取 ONNX 匯出指紋失敗: {e}")
+            return False
+
+    def _export_component(self, component, export_dir, details, export):
+        """匯出到暫存目錄 (必要時量化)，最後才寫入指紋並替換正式目錄"""
+        tmp_dir = f"{export_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir, exist_ok=True)
+        start = time.perf_counter()
+        print(f"🔄 匯出 {component} 到 ONNX: {export_dir}", flush=True)
+        try:
+            with metrics.stage("onnx_export"):
+                export(os.path.join(tmp_dir, "model.onnx"))
+                if details["quantize"]:
+                    self._quantize(tmp_dir)
+            with open(os.path.join(tmp_dir, "fingerprint.json"), 'w', encoding='utf-8') as f:
+                json.dump(json.loads(json.dumps(details, sort_keys=True, default=str)), f, indent=2)
+            shutil.rmtree(export_dir, ignore_errors=True)
+            os.replace(tmp_dir, export_dir)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        elapsed = time.perf_counter() - start
+        self.exports += 1
+        self.export_seconds += elapsed
+        print(f"✅ {component} 匯出完成，耗時 {elapsed:.1f}s", flush=True)
+
+    def _export(self, wrapper, args, path, input_names, output_names, dynamic_axes, merge_lora_of=None):
+        """
+        以 torch.onnx.export 匯出。merge_lora_of 指定時先把啟用中的 LoRA 合併進基礎權重，
+        匯出完成後還原 (超過 2GB 的模型由 torch 自動使用外部資料格式)。
+        """
+        layers = _tuner_layers(merge_lora_of) if merge_lora_of is not None else []
+        state = _lora_state(layers)
+        merged = state is not None and not state[0]
+        with torch.no_grad():
+            if merged:
+                for layer in layers:
+                    layer.merge(adapter_names=list(state[1]))
+            try:
+                torch.onnx.export(
+                    wrapper, args, path,
+                    input_names=input_names,
+                    output_names=output_names,
+                    dynamic_axes=dynamic_axes,
+                    opset_version=self.opset,
+                    do_constant_folding=True
+                )
+            finally:
+                if merged:
+                    for layer in layers:
+                        layer.unmerge()
+
+    def _quantize(self, export_dir):
+        """動態 int8 量化 (權重量化為 int8，激活值在推理時量化)"""
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        model_path = os.path.join(export_dir, "model.onnx")
+        fp32_dir = os.path.join(export_dir, "fp32")
+        os.makedirs(fp32_dir, exist_ok=True)
+        for name in os.listdir(export_dir):
+            if name != "fp32":
+                shutil.move(os.path.join(export_dir, name), os.path.join(fp32_dir, name))
+        quantize_dynamic(
+            os.path.join(fp32_dir, "model.onnx"), model_path,
+            weight_type=QuantType.QInt8 if self.quantize == "int8" else QuantType.QUInt8,
+            use_external_data_format=True
+        )
+        shutil.rmtree(fp32_dir, ignore_errors=True)
+
+    def _load_session(self, model_path):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = int(self.intra_op_threads or available_cpus())
+        with metrics.stage("onnx_session_load"):
+            session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.session_loads += 1
+        return session
+
+    def stats(self):
+        with self._lock:
+            sessions = [f"{component}-{key[:16]}" for component, key in self._sessions]
+        return {
+            "components": list(self.components),
+            "quantize": self.quantize,
+            "cache_dir": self.cache_dir,
+            "sessions": sessions,
+            "exports": self.exports,
+            "export_seconds": round(self.export_seconds, 3),
+            "session_loads": self.session_loads,
+            "fallbacks": self.fallbacks,
+        }
+
+print("--- [OnnxRuntimeBackend] 模塊已成功被定義。---", flush=True)
@@ -0,0 +1,170 @@
+"""
+輸出清單模塊
+把每一張生成的圖像 (API 與 main.py 掃描) 記錄在 SQLite 清單中：參數、種子、各階段耗時、檔案大小與感知雜湊，
+圖庫查詢走索引與游標分頁，不需要走訪 outputs/ 目錄
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+print("--- [OutputManifest] 模塊開始被導入... ---", flush=True)
+
+# 可供 /gallery 篩選的欄位，每個欄位都有 (欄位, id) 索引，篩選後依 id 倒序分頁不需要排序
+FILTER_COLUMNS = ("weight_name", "seed", "steps", "action_key", "expression_key")
+
+
+@lru_cache(maxsize=4)
+def _dct_matrix(size):
+    """正交 DCT-II 矩陣"""
+    n = np.arange(size)
+    matrix = np.sqrt(2.0 / size) * np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size))
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+def perceptual_hash(image, hash_size=8, highfreq_factor=4):
+    """
+    DCT 感知雜湊 (pHash)，返回 16 位十六進位字串。
+    縮成 32×32 灰階後取低頻 8×8 DCT 係數，與中位數比較得到 64 位元；透明像素先合成到白底。
+    """
+    if image.mode in ("RGBA", "LA", "P"):
+        rgba = image.convert("RGBA")
+        background = Image.new("RGBA", rgba.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, rgba)
+    size = hash_size * highfreq_factor
+    pixels = np.asarray(image.convert("L").resize((size, size), Image.LANCZOS), dtype=np.float64)
+    dct = _dct_matrix(size)
+    low = (dct @ pixels @ dct.T)[:hash_size, :hash_size]
+    bits = (low > np.median(low)).flatten()
+    return f"{int(''.join('1' if bit else '0' for bit in bits), 2):0{hash_size * hash_size // 4}x}"
+
+
+class OutputManifest:
+    """輸出清單，所有記錄寫入 SQLite (WAL)，API 與 main.py 共用同一個檔案"""
+    def __init__(self, db_path="outputs/manifest.sqlite3", phash=True):
+        self.db_path = db_path
+        self.phash = bool(phash)
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # 多個程序 (API 與 main.py) 同時寫入時等待鎖，而不是立即失敗
+            self._conn.execute("PRAGMA busy_timeout=5000")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS outputs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    image_path TEXT NOT NULL UNIQUE,
+                    weight_name TEXT,
+                    seed INTEGER,
+                    steps INTEGER,
+                    action_key TEXT,
+                    expression_key TEXT,
+                    scheduler TEXT,
+                    prompt TEXT,
+                    negative_prompt TEXT,
+                    guidance_scale REAL,
+                    strength REAL,
+                    noise_level REAL,
+                    height INTEGER,
+                    width INTEGER,
+                    original_image TEXT,
+                    file_size INTEGER,
+                    phash TEXT,
+                    timings_json TEXT,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            for column in FILTER_COLUMNS:
+                self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_outputs_{column}_id ON outputs ({column}, id)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_outputs_phash ON outputs (phash)")
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        從設定檔的 manifest 區塊建立清單，停用時返回 None。
+        環境變數 MUSHROOM_MANIFEST=false 可停用 (例如行程內負載測試，不寫入正式的清單)。
+        """
+        manifest_config = config.get('manifest', {}) or {}
+        if not manifest_config.get('enabled', False) or os.getenv('MUSHROOM_MANIFEST', 'true').lower() == 'false':
+            return None
+        return cls(
+            db_path=manifest_config.get('db_path', 'outputs/manifest.sqlite3'),
+            phash=manifest_config.get('phash', True)
+        )
+
+    def record(self, entry):
+        """新增一筆輸出記錄 (相同 image_path 時覆寫)，返回記錄 id"""
+        entry = dict(entry)
+        timings = entry.pop("timings", None)
+        entry["timings_json"] = json.dumps(timings or {}, ensure_ascii=False)
+        entry.setdefault("created_at", time.time())
+        columns = list(entry)
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                f"INSERT OR REPLACE INTO outputs ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                [entry[column] for column in columns]
+            )
+            return cursor.lastrowid
+
+    def query(self, cursor=None, limit=50, **filters):
+        """
+        依篩選條件查詢，結果由新到舊。
+        cursor 為上一頁最後一筆的 id，返回 {"items", "next_cursor"}，沒有下一頁時 next_cursor 為 None。
+        """
+        limit = int(limit)
+        conditions = []
+        params = []
+        for column in FILTER_COLUMNS:
+            value = filters.get(column)
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if cursor is not None:
+            conditions.append("id < ?")
+            params.append(int(cursor))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        # 多取一筆以判斷是否還有下一頁
+        params.append(limit + 1)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT * FROM outputs {where} ORDER BY id DESC LIMIT ?", params
+            ).fetchall()
+        items = [self._row_to_item(row) for row in rows[:limit]]
+        next_cursor = items[-1]["id"] if len(rows) > limit and items else None
+        return {"items": items, "next_cursor": next_cursor}
+
+    def get(self, image_path):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM outputs WHERE image_path = ?", (image_path,)).fetchone()
+        return self._row_to_item(row) if row is not None else None
+
+    @staticmethod
+    def _row_to_item(row):
+        item = dict(row)
+        item["timings"] = json.loads(item.pop("timings_json") or "{}")
+        return item
+
+    def stats(self):
+        with self._lock:
+            count, total_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(file_size), 0) FROM outputs"
+            ).fetchone()
+        return {"db_path": self.db_path, "entries": count, "total_bytes": total_bytes, "phash": self.phash}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+print("--- [OutputManifest] 模塊已成功被定義。---", flush=True)
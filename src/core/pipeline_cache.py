@@ -0,0 +1,209 @@
+"""
+管道快取模塊
+以 LRU 策略與位元組預算管理常駐的管道 / LoRA adapter
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from src.core import metrics
+
+print("--- [PipelineCache] 模塊開始被導入... ---", flush=True)
+
+
+def estimate_module_bytes(module):
+    """以參數與 buffer 的元素數量 × dtype 大小估算模組常駐位元組數"""
+    total = 0
+    try:
+        for tensor in module.parameters():
+            total += tensor.numel() * tensor.element_size()
+        for tensor in module.buffers():
+            total += tensor.numel() * tensor.element_size()
+    except Exception:
+        pass
+    return total
+
+
+def estimate_pipeline_bytes(pipe):
+    """估算整個管道 (UNet、VAE、Text Encoder 等所有 torch 模組) 的常駐位元組數"""
+    components = getattr(pipe, 'components', None) or {}
+    total = 0
+    for component in components.values():
+        if hasattr(component, 'parameters') and hasattr(component, 'buffers'):
+            total += estimate_module_bytes(component)
+    return total
+
+
+def estimate_adapter_bytes(pipe, adapter_name):
+    """估算指定 LoRA adapter 掛在管道各組件上的參數位元組數"""
+    marker = f".{adapter_name}."
+    total = 0
+    components = getattr(pipe, 'components', None) or {}
+    for component in components.values():
+        if not hasattr(component, 'named_parameters'):
+            continue
+        try:
+            for name, param in component.named_parameters():
+                if marker in name and 'lora_' in name:
+                    total += param.numel() * param.element_size()
+        except Exception:
+            pass
+    return total
+
+
+class PipelineCache:
+    """
+    LRU + 位元組預算快取。
+    放入新項目後會依最近最少使用的順序淘汰，直到常駐位元組數不超過預算；
+    pinned 項目 (例如常駐的基礎管道) 計入常駐大小但不會被淘汰。
+    """
+    def __init__(self, max_bytes=None, max_entries=None, on_evict=None, name="pipeline"):
+        self.name = name  # 指標中的快取名稱
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.on_evict = on_evict
+        self._entries = OrderedDict()  # key -> (value, size_bytes, pinned)
+        self._loading = {}  # key -> Future，正在加載的項目
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def resident_bytes(self):
+        with self._lock:
+            return sum(size for _, size, _ in self._entries.values())
+
+    def get(self, key, default=None):
+        """取得項目並更新 LRU 順序，同時記錄命中 / 未命中"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                metrics.record_cache_lookup(self.name, "hit")
+                return self._entries[key][0]
+            self.misses += 1
+            metrics.record_cache_lookup(self.name, "miss")
+            return default
+
+    def touch(self, key):
+        """只更新 LRU 順序，不計入命中統計"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+
+    def put(self, key, value, size_bytes=0, pinned=False):
+        """放入項目並淘汰到預算以內 (剛放入的項目不會被淘汰)"""
+        with self._lock:
+            self._entries[key] = (value, int(size_bytes or 0), pinned)
+            self._entries.move_to_end(key)
+            self._evict_to_budget(protected_key=key)
+            return value
+
+    def get_or_load(self, key, loader, sizer=None, pinned=False, estimated_bytes=None):
+        """
+        命中時直接返回，否則調用 loader 加載並以 sizer 估算大小後放入快取。
+        加載前先淘汰到 max_bytes - 預估大小 (未指定時取目前最大的非 pinned 項目)，
+        新舊項目不會同時常駐而超出預算；loader 在鎖外執行，加載期間 stats() 等操作不被阻塞，
+        同一個鍵同時只會加載一次，其他執行緒等待同一個結果。
+        """
+        with self._lock:
+            if key in self._entries:
+                return self.get(key)
+            pending = self._loading.get(key)
+            owner = pending is None
+            if owner:
+                pending = Future()
+                self._loading[key] = pending
+                self.misses += 1
+                metrics.record_cache_lookup(self.name, "miss")
+                if estimated_bytes is None:
+                    estimated_bytes = max(
+                        (size for _, size, entry_pinned in self._entries.values() if not entry_pinned), default=0
+                    )
+                self._evict_to_budget(reserve_bytes=estimated_bytes, reserve_entries=1)
+        if not owner:
+            return pending.result()
+        try:
+            value = loader()
+            size_bytes = sizer(value) if sizer else 0
+            value = self.put(key, value, size_bytes, pinned=pinned)
+            pending.set_result(value)
+            return value
+        except BaseException as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+
+    def pop(self, key):
+        """移除項目 (不觸發 on_evict，由調用者自行釋放)"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return entry[0] if entry else None
+
+    def clear(self):
+        with self._lock:
+            for key in [k for k, (_, _, pinned) in self._entries.items() if not pinned]:
+                self._evict(key)
+
+    def _over_budget(self, reserve_bytes=0, reserve_entries=0):
+        """reserve_bytes / reserve_entries 為即將加載的項目預留的空間"""
+        if self.max_entries is not None and len(self._entries) + reserve_entries > self.max_entries:
+            return True
+        if self.max_bytes is not None and self.resident_bytes + reserve_bytes > self.max_bytes:
+            return True
+        return False
+
+    def _evict_to_budget(self, protected_key=None, reserve_bytes=0, reserve_entries=0):
+        while self._over_budget(reserve_bytes, reserve_entries):
+            victim = next(
+                (k for k, (_, _, pinned) in self._entries.items() if not pinned and k != protected_key),
+                None
+            )
+            if victim is None:
+                # 只剩 pinned 或剛放入的項目，無法再淘汰
+                if self.max_bytes is not None and self.resident_bytes > self.max_bytes:
+                    print(f"⚠️ [PipelineCache] 常駐大小 {self.resident_bytes / 1024**2:.1f}MB 超出預算 "
+                          f"{self.max_bytes / 1024**2:.1f}MB，但已無可淘汰的項目", flush=True)
+                break
+            self._evict(victim)
+
+    def _evict(self, key):
+        value, size_bytes, _ = self._entries.pop(key)
+        self.evictions += 1
+        print(f"--- [PipelineCache] 淘汰快取項目: {key} ({size_bytes / 1024**2:.1f}MB) ---", flush=True)
+        if self.on_evict:
+            try:
+                self.on_evict(key, value)
+            except Exception as e:
+                print(f"⚠️ [PipelineCache] 淘汰 {key} 時釋放資源失敗: {e}", flush=True)
+
+    def stats(self):
+        """返回命中、未命中、淘汰次數與常駐位元組數"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "resident_bytes": self.resident_bytes,
+                "max_bytes": self.max_bytes,
+                "max_entries": self.max_entries,
+                "entries": [
+                    {"key": key, "bytes": size_bytes, "pinned": pinned}
+                    for key, (_, size_bytes, pinned) in self._entries.items()
+                ],
+            }
+
+print("--- [PipelineCache] 模塊已成功被定義。---", flush=True)
@@ -0,0 +1,209 @@
+"""
+後處理模塊
+將去背、透明邊界裁切、PNG 編碼與儲存移出生成執行緒，交由獨立的處理程序池執行，
+讓下一次擴散推理在 VAE 解碼完成後即可開始
+"""
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from PIL import Image
+
+from src.core import metrics
+
+print("--- [PostProcessor] 模塊開始被導入... ---", flush=True)
+
+# 每個工作程序各自的去背處理器 (各自持有一個 rembg / ONNX session)
+_worker_remover = None
+
+
+def _init_worker(removal_config):
+    """工作程序初始化：建立該程序專用的去背處理器"""
+    global _worker_remover
+    from src.core.background_removal import BackgroundRemover
+    _worker_remover = BackgroundRemover(**(removal_config or {}))
+
+
+def _crop_to_alpha(image, padding=0):
+    """裁切到 alpha 通道的非透明範圍，保留 padding 像素的邊距"""
+    bbox = image.getchannel("A").getbbox()
+    if bbox is None:
+        return image
+    left, top, right, bottom = bbox
+    bbox = (
+        max(0, left - padding), max(0, top - padding),
+        min(image.width, right + padding), min(image.height, bottom + padding)
+    )
+    return image.crop(bbox)
+
+
+def _postprocess_task(mode, size, data, full_path, crop_alpha=False, crop_padding=0):
+    """在工作程序中執行：去背 -> (可選) 透明邊界裁切 -> PNG 編碼並儲存"""
+    image = Image.frombytes(mode, size, data)
+    start = time.perf_counter()
+    output, backend, matte_rejected_seconds = _worker_remover.remove_with_info(image)
+    removal_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if crop_alpha:
+        output = _crop_to_alpha(output, crop_padding)
+    output.save(full_path, format="PNG")
+    save_seconds = time.perf_counter() - start
+    output.close()
+    image.close()
+    return {
+        "path": full_path,
+        "backend": backend,
+        "removal_seconds": removal_seconds,
+        "matte_rejected": matte_rejected_seconds is not None,
+        "matte_rejected_seconds": matte_rejected_seconds or 0.0,
+        "save_seconds": save_seconds,
+        "bytes": os.path.getsize(full_path),
+    }
+
+
+class PostProcessor:
+    """
+    後處理階段 (生產者 / 消費者)。
+    生成執行緒以 submit() 交出解碼後的圖像並立即返回 Future；
+    已提交但未完成的工作最多 max_pending 個，超過時 submit() 會阻塞生產者，形成背壓。
+    workers 為 0 時在呼叫執行緒中同步處理 (與原本的行為相同)。
+    """
+    def __init__(self, workers=1, max_pending=8, removal_config=None, crop_alpha=False, crop_padding=0):
+        self.workers = max(0, int(workers))
+        self.max_pending = max(1, int(max_pending))
+        self.removal_config = dict(removal_config or {})
+        self.crop_alpha = bool(crop_alpha)
+        self.crop_padding = max(0, int(crop_padding))
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.peak_pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.producer_wait_seconds = 0.0
+        self.matte_rejected = 0
+        self._backend_timings = {}  # 後端 -> {"count", "removal_seconds", "save_seconds"}
+
+    @classmethod
+    def from_config(cls, config):
+        """從設定檔的 postprocess 與 background_removal 區塊建立後處理器"""
+        postprocess_config = config.get('postprocess', {}) or {}
+        return cls(
+            workers=postprocess_config.get('workers', 1),
+            max_pending=postprocess_config.get('max_pending', 8),
+            removal_config=config.get('background_removal', {}) or {},
+            crop_alpha=postprocess_config.get('crop_alpha', False),
+            crop_padding=postprocess_config.get('crop_padding', 0)
+        )
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None and self.workers > 0:
+                print(f"--- [PostProcessor] 啟動 {self.workers} 個後處理程序... ---", flush=True)
+                # 使用 spawn：子程序不繼承父程序的 torch / CUDA 狀態
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.removal_config,)
+                )
+            return self._pool
+
+    def submit(self, image, full_path):
+        """
+        提交一張圖像的後處理，返回 concurrent.futures.Future，結果為處理資訊字典。
+        圖像內容在提交時即被複製，呼叫者可以立即關閉圖像。
+        """
+        wait_start = time.perf_counter()
+        self._slots.acquire()
+        waited = time.perf_counter() - wait_start
+        with self._lock:
+            self.producer_wait_seconds += waited
+            self._pending += 1
+            self.submitted += 1
+            self.peak_pending = max(self.peak_pending, self._pending)
+
+        # 序列化與提交失敗時以失敗的 Future 返回，由 _on_done 釋放名額並減少待處理數
+        try:
+            args = (image.mode, image.size, image.tobytes(), full_path, self.crop_alpha, self.crop_padding)
+            pool = self._get_pool()
+            if pool is not None:
+                future = pool.submit(_postprocess_task, *args)
+            else:
+                future = self._run_inline(args)
+        except Exception as e:
+            future = Future()
+            future.set_exception(e)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _run_inline(self, args):
+        if _worker_remover is None:
+            _init_worker(self.removal_config)
+        future = Future()
+        try:
+            future.set_result(_postprocess_task(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _on_done(self, future):
+        error = None if future.cancelled() else future.exception()
+        with self._lock:
+            self._pending -= 1
+            if future.cancelled() or error is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+                info = future.result()
+                metrics.observe_stage("background_removal", info["removal_seconds"])
+                metrics.observe_stage("encode_save", info["save_seconds"])
+                if info.get("matte_rejected"):
+                    # matte 被拒絕後改用 rembg，拒絕前花費的時間已包含在 removal_seconds 中
+                    self.matte_rejected += 1
+                    metrics.observe_stage("matte_rejected", info["matte_rejected_seconds"])
+                timing = self._backend_timings.setdefault(
+                    info["backend"], {"count": 0, "removal_seconds": 0.0, "save_seconds": 0.0}
+                )
+                timing["count"] += 1
+                timing["removal_seconds"] += info["removal_seconds"]
+                timing["save_seconds"] += info["save_seconds"]
+        self._slots.release()
+
+    def stats(self):
+        """返回佇列深度與各去背後端的耗時統計"""
+        with self._lock:
+            running = min(self._pending, self.workers) if self.workers else self._pending
+            return {
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "pending": self._pending,
+                "running": running,
+                "queued": self._pending - running,
+                "peak_pending": self.peak_pending,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "matte_rejected": self.matte_rejected,
+                "producer_wait_seconds": self.producer_wait_seconds,
+                "backends": {
+                    backend: {
+                        **timing,
+                        "average_removal_seconds": timing["removal_seconds"] / timing["count"],
+                    }
+                    for backend, timing in self._backend_timings.items()
+                },
+            }
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait)
+
+print("--- [PostProcessor] 模塊已成功被定義。---", flush=True)
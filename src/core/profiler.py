@@ -0,0 +1,134 @@
+"""
+效能剖析模塊
+以 torch.profiler 包住一次管道調用，輸出 Chrome trace 與前 N 名運算子表，
+並以取樣率與頻率上限保護線上環境
+"""
+import os
+import time
+import random
+import threading
+from contextlib import contextmanager
+
+import torch
+
+print("--- [GenerationProfiler] 模塊開始被導入... ---", flush=True)
+
+
+class GenerationProfiler:
+    """
+    生成剖析器。
+    - 明確要求 (請求旗標 / CLI 參數) 時一定嘗試剖析；否則依 sample_rate 隨機取樣。
+    - 兩者都受頻率上限約束：同時只剖析一次、兩次之間至少間隔 min_interval_seconds、
+      每小時最多 max_per_hour 次。
+    """
+    def __init__(self, sample_rate=0.0, min_interval_seconds=60.0, max_per_hour=10,
+                 output_dir=None, top_n=30, record_shapes=True, profile_memory=True, with_stack=True):
+        self.sample_rate = max(0.0, min(1.0, float(sample_rate)))
+        self.min_interval_seconds = max(0.0, float(min_interval_seconds))
+        self.max_per_hour = max(0, int(max_per_hour))
+        self.output_dir = output_dir  # None 表示寫在圖像輸出目錄旁
+        self.top_n = max(1, int(top_n))
+        self.record_shapes = bool(record_shapes)
+        self.profile_memory = bool(profile_memory)
+        self.with_stack = bool(with_stack)
+        self._lock = threading.Lock()
+        self._in_progress = False
+        self._recent = []  # 最近一小時內開始剖析的時間
+        self.profiles = 0
+        self.rate_limited = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """從設定檔的 profiling 區塊建立剖析器"""
+        profiling_config = config.get('profiling', {}) or {}
+        return cls(
+            sample_rate=profiling_config.get('sample_rate', 0.0) if profiling_config.get('enabled', False) else 0.0,
+            min_interval_seconds=profiling_config.get('min_interval_seconds', 60.0),
+            max_per_hour=profiling_config.get('max_per_hour', 10),
+            output_dir=profiling_config.get('output_dir'),
+            top_n=profiling_config.get('top_n', 30),
+            record_shapes=profiling_config.get('record_shapes', True),
+            profile_memory=profiling_config.get('profile_memory', True),
+            with_stack=profiling_config.get('with_stack', True)
+        )
+
+    def _acquire(self, requested):
+        """決定這次是否剖析，是則標記為進行中"""
+        if not requested and (self.sample_rate <= 0.0 or random.random() >= self.sample_rate):
+            return False
+        now = time.time()
+        with self._lock:
+            self._recent = [t for t in self._recent if now - t < 3600.0]
+            if (
+                self._in_progress
+                or len(self._recent) >= self.max_per_hour
+                or (self._recent and now - self._recent[-1] < self.min_interval_seconds)
+            ):
+                self.rate_limited += 1
+                return False
+            self._in_progress = True
+            self._recent.append(now)
+            return True
+
+    @contextmanager
+    def profile(self, name, output_dir, requested=False):
+        """
+        剖析區塊內的工作。yield 一個字典，剖析完成後填入 trace 與運算子表的路徑；
+        未剖析時 yield None。
+        """
+        if not self._acquire(requested):
+            yield None
+            return
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        info = {}
+        try:
+            print(f"--- [GenerationProfiler] 開始剖析: {name} ---", flush=True)
+            with torch.profiler.profile(
+                activities=activities,
+                record_shapes=self.record_shapes,
+                profile_memory=self.profile_memory,
+                with_stack=self.with_stack
+            ) as prof:
+                yield info
+            info.update(self._export(prof, name, self.output_dir or output_dir, cuda=len(activities) > 1))
+            self.profiles += 1
+        finally:
+            with self._lock:
+                self._in_progress = False
+
+    def _export(self, prof, name, output_dir, cuda=False):
+        """寫出 Chrome trace 與前 N 名運算子表，失敗時只印出警告"""
+        os.makedirs(output_dir, exist_ok=True)
+        base = os.path.join(output_dir, f"{name}_{int(time.time())}_profile")
+        paths = {}
+        try:
+            prof.export_chrome_trace(f"{base}.json")
+            paths["trace_path"] = f"{base}.json"
+        except Exception as e:
+            print(f"⚠️ 輸出 Chrome trace 失敗: {e}", flush=True)
+        try:
+            sort_by = "self_cuda_time_total" if cuda else "self_cpu_time_total"
+            table = prof.key_averages().table(sort_by=sort_by, row_limit=self.top_n)
+            with open(f"{base}_ops.txt", "w", encoding="utf-8") as f:
+                f.write(table)
+            paths["operators_path"] = f"{base}_ops.txt"
+        except Exception as e:
+            print(f"⚠️ 輸出運算子表失敗: {e}", flush=True)
+        print(f"✅ 剖析結果已輸出: {paths}", flush=True)
+        return paths
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sample_rate": self.sample_rate,
+                "profiles": self.profiles,
+                "rate_limited": self.rate_limited,
+                "in_progress": self._in_progress,
+                "last_hour": len(self._recent),
+                "max_per_hour": self.max_per_hour,
+            }
+
+print("--- [GenerationProfiler] 模塊已成功被定義。---", flush=True)
@@ -0,0 +1,126 @@
+"""
+提示詞嵌入快取模塊
+快取 Text Encoder 的輸出，相同提示詞不再重複執行 CLIP 編碼
+"""
+import uuid
+import threading
+from collections import OrderedDict
+
+import torch
+
+from src.core import metrics
+
+print("--- [PromptEmbeddingCache] 模塊開始被導入... ---", flush=True)
+
+
+def text_encoder_identity(pipe):
+    """
+    取得 Text Encoder 的唯一識別碼。
+    不使用 id()，避免管道被釋放後新管道重用相同位址而讀到舊的嵌入。
+    """
+    text_encoder = getattr(pipe, 'text_encoder', None)
+    if text_encoder is None:
+        return None
+    token = getattr(text_encoder, '_prompt_cache_token', None)
+    if token is None:
+        token = uuid.uuid4().hex
+        text_encoder._prompt_cache_token = token
+    return token
+
+
+class PromptEmbeddingCache:
+    """
+    提示詞嵌入的 LRU 快取。
+    鍵為 (Text Encoder 識別碼, 啟用的 LoRA, LoRA 強度, 提示詞)，
+    正向與負向提示詞分開快取，因此所有請求共用同一個負向提示詞的嵌入。
+    """
+    def __init__(self, max_entries=256):
+        self.max_entries = max(1, int(max_entries))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def supports(pipe):
+        return hasattr(pipe, 'encode_prompt') and getattr(pipe, 'text_encoder', None) is not None
+
+    def _encode(self, pipe, text):
+        """以管道的 encode_prompt 編碼單一提示詞 (不含 CFG)，返回嵌入元組"""
+        with torch.no_grad(), metrics.stage("text_encode"):
+            outputs = pipe.encode_prompt(
+                prompt=text,
+                device=pipe._execution_device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=False
+            )
+        if hasattr(pipe, 'text_encoder_2'):
+            # SDXL: (prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds)
+            return outputs[0], outputs[2]
+        return outputs[0], None
+
+    def get(self, pipe, text, lora_key=None, lora_scale=1.0):
+        """取得單一提示詞的 (embeds, pooled_embeds)，未命中時編碼並放入快取"""
+        key = (text_encoder_identity(pipe), lora_key, float(lora_scale), text)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                metrics.record_cache_lookup("prompt_embedding", "hit")
+                return self._entries[key]
+            self.misses += 1
+        metrics.record_cache_lookup("prompt_embedding", "miss")
+        value = self._encode(pipe, text)
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def build_pipeline_kwargs(self, pipe, prompts, negative_prompts, lora_key=None, lora_scale=1.0):
+        """
+        將 (批次) 提示詞轉為管道可用的嵌入參數，
+        取代 prompt / negative_prompt 字串傳入管道。
+        """
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        if isinstance(negative_prompts, str):
+            negative_prompts = [negative_prompts]
+
+        positive = [self.get(pipe, text, lora_key, lora_scale) for text in prompts]
+        negative = [self.get(pipe, text or "", lora_key, lora_scale) for text in negative_prompts]
+
+        kwargs = {
+            "prompt_embeds": torch.cat([embeds for embeds, _ in positive], dim=0),
+            "negative_prompt_embeds": torch.cat([embeds for embeds, _ in negative], dim=0),
+        }
+        if positive[0][1] is not None:
+            kwargs["pooled_prompt_embeds"] = torch.cat([pooled for _, pooled in positive], dim=0)
+            kwargs["negative_pooled_prompt_embeds"] = torch.cat([pooled for _, pooled in negative], dim=0)
+        return kwargs
+
+    def warmup(self, pipe, prompts, lora_key=None, lora_scale=1.0):
+        """預先計算一組提示詞的嵌入，返回新編碼的數量"""
+        before = self.misses
+        for text in prompts:
+            self.get(pipe, text, lora_key, lora_scale)
+        return self.misses - before
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """返回命中統計"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+            }
+
+print("--- [PromptEmbeddingCache] 模塊已成功被定義。---", flush=True)
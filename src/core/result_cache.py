@@ -0,0 +1,238 @@
+"""
+生成結果快取模塊
+固定種子下，相同的模型、LoRA 組合、提示詞、步數、解析度、引導參數、強度與 scheduler 必定產生相同的圖像；
+以所有影響輸出的參數的規範化雜湊為鍵，把結果圖像保存在 outputs/ 下並以索引檔記錄，重複請求直接返回已有的檔案
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+
+from src.core import metrics
+
+print("--- [ResultCache] 模塊開始被導入... ---", flush=True)
+
+# 雜湊格式版本：影響輸出的參數集合改變時遞增，舊的快取項目自然失效
+# 2: 加入基礎權重指紋與執行設定 (裝置、CPU bf16 / 編譯、ONNX Runtime、融合強度)
+KEY_VERSION = 2
+
+
+def canonical_key(inputs):
+    """以排序鍵、固定分隔符的 JSON 表示計算 sha256，參數順序與字典順序不影響結果"""
+    payload = json.dumps(
+        {"version": KEY_VERSION, **inputs}, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    內容定址的生成結果快取。
+    結果圖像以硬連結 (跨檔案系統時改為複製) 保存在 cache_dir/<鍵前兩碼>/<鍵>.png，
+    原本的輸出檔案被刪除也不影響快取；index.json 記錄每個項目的大小與最後使用時間，
+    總大小超過 max_bytes 時依最久未使用的順序刪除。
+    索引的寫入延遲 flush_interval 秒合併進行 (關閉時以 flush() 寫入)；
+    啟動時刪除不在索引中的快取檔案 (上次關閉前尚未寫入索引的項目)。
+    """
+    INDEX_FILE = "index.json"
+
+    def __init__(self, cache_dir="outputs/.cache/results", max_bytes=None, outputs_dir="outputs", flush_interval=2.0):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.outputs_dir = outputs_dir
+        self.flush_interval = float(flush_interval)
+        self._entries = OrderedDict()  # 鍵 -> {"path", "bytes", "created", "last_used"}，依最後使用時間排序
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._flush_timer = None
+        self.index_writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+        self._remove_orphans()
+
+    @classmethod
+    def from_config(cls, config):
+        """從設定檔的 result_cache 區塊建立快取，停用時返回 None"""
+        cache_config = config.get('result_cache', {}) or {}
+        if not cache_config.get('enabled', False):
+            return None
+        max_size_mb = cache_config.get('max_size_mb', 2048)
+        return cls(
+            cache_dir=cache_config.get('cache_dir', 'outputs/.cache/results'),
+            max_bytes=int(max_size_mb * 1024**2) if max_size_mb else None,
+            flush_interval=cache_config.get('index_flush_seconds', 2.0)
+        )
+
+    @property
+    def index_path(self):
+        return os.path.join(self.cache_dir, self.INDEX_FILE)
+
+    def _load_index(self):
+        """讀取索引並略過檔案已不存在的項目"""
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(f"⚠️ 讀取結果快取索引失敗，從空快取開始: {e}", flush=True)
+            return
+        for key, entry in sorted(entries.items(), key=lambda item: item[1].get("last_used", 0)):
+            if os.path.exists(self._full_path(entry["path"])):
+                self._entries[key] = entry
+        with self._lock:
+            self._evict_to_budget()
+        print(f"--- [ResultCache] 已讀取 {len(self._entries)} 個快取結果 ---", flush=True)
+
+    def _remove_orphans(self):
+        """刪除快取目錄中不在索引裡的圖像 (只走訪快取目錄本身)"""
+        indexed = {os.path.normpath(self._full_path(entry["path"])) for entry in self._entries.values()}
+        removed = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.normpath(os.path.join(root, name))
+                if name.endswith((".png", ".png.tmp")) and path not in indexed:
+                    try:
+                        os.remove(path)
+                        removed += 1
+                    except OSError:
+                        pass
+        if removed:
+            print(f"--- [ResultCache] 已刪除 {removed} 個未被索引的快取檔案 ---", flush=True)
+
+    def _mark_dirty(self):
+        """標記索引需要寫入，並在 flush_interval 秒後合併寫入 (調用者持有鎖)"""
+        self._dirty = True
+        if self.flush_interval <= 0:
+            self._save_index()
+            return
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(self.flush_interval, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def flush(self):
+        """立即寫入尚未保存的索引變更"""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if self._dirty:
+                self._save_index()
+
+    def _save_index(self):
+        """以暫存檔 + os.replace 寫入索引 (調用者持有鎖)"""
+        tmp_path = f"{self.index_path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.index_path)
+            self._dirty = False
+            self.index_writes += 1
+        except Exception as e:
+            print(f"⚠️ 寫入結果快取索引失敗: {e}", flush=True)
+
+    def _full_path(self, relative_path):
+        return os.path.join(self.outputs_dir, relative_path)
+
+    def get(self, key):
+        """命中時返回結果圖像相對於 outputs/ 的路徑，否則返回 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not os.path.exists(self._full_path(entry["path"])):
+                # 檔案被外部刪除，視為未命中
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                metrics.record_cache_lookup("result", "miss")
+                return None
+            entry["last_used"] = time.time()
+            self._entries.move_to_end(key)
+            self._mark_dirty()
+            self.hits += 1
+            metrics.record_cache_lookup("result", "hit")
+            return entry["path"]
+
+    def put(self, key, image_path):
+        """把剛生成的圖像 (相對於 outputs/ 的路徑) 加入快取，返回快取檔案的相對路徑"""
+        source = self._full_path(image_path)
+        relative_path = os.path.relpath(os.path.join(self.cache_dir, key[:2], f"{key}.png"), self.outputs_dir)
+        target = self._full_path(relative_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_target = f"{target}.tmp"
+        try:
+            if os.path.exists(tmp_target):
+                os.remove(tmp_target)
+            try:
+                os.link(source, tmp_target)
+            except OSError:
+                shutil.copyfile(source, tmp_target)
+            os.replace(tmp_target, target)
+        except Exception as e:
+            print(f"⚠️ 加入結果快取失敗: {e}", flush=True)
+            return None
+        now = time.time()
+        with self._lock:
+            self._entries[key] = {
+                "path": relative_path,
+                "bytes": os.path.getsize(target),
+                "created": now,
+                "last_used": now,
+            }
+            self._entries.move_to_end(key)
+            self._evict_to_budget(protected_key=key)
+            self._mark_dirty()
+        return relative_path
+
+    @property
+    def resident_bytes(self):
+        return sum(entry["bytes"] for entry in self._entries.values())
+
+    def _evict_to_budget(self, protected_key=None):
+        """刪除最久未使用的項目直到總大小不超過預算 (調用者持有鎖)"""
+        if self.max_bytes is None:
+            return
+        while self.resident_bytes > self.max_bytes:
+            victim = next((key for key in self._entries if key != protected_key), None)
+            if victim is None:
+                break
+            entry = self._entries.pop(victim)
+            self.evictions += 1
+            try:
+                os.remove(self._full_path(entry["path"]))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            for entry in self._entries.values():
+                try:
+                    os.remove(self._full_path(entry["path"]))
+                except OSError:
+                    pass
+            self._entries.clear()
+            self._mark_dirty()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "resident_bytes": self.resident_bytes,
+                "max_bytes": self.max_bytes,
+                "index_writes": self.index_writes,
+                "cache_dir": self.cache_dir,
+            }
+
+print("--- [ResultCache] 模塊已成功被定義。---", flush=True)
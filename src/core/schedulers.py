@@ -0,0 +1,136 @@
+"""
+Scheduler 註冊模塊
+提供可選的取樣器 (DPM-Solver++ 多步、Euler-ancestral、UniPC、DDIM) 與步數預設組合，
+在已快取的管道上直接切換 scheduler，不重新加載模型
+"""
+import weakref
+import threading
+
+print("--- [SchedulerRegistry] 模塊開始被導入... ---", flush=True)
+
+DEFAULT_SCHEDULER = "default"
+
+# 名稱 -> (diffusers 類別名稱, from_config 額外參數)；default 表示保留管道加載時的 scheduler
+SCHEDULERS = {
+    "dpmpp_2m": ("DPMSolverMultistepScheduler", {"algorithm_type": "dpmsolver++", "solver_order": 2}),
+    "dpmpp_2m_karras": ("DPMSolverMultistepScheduler", {"algorithm_type": "dpmsolver++", "solver_order": 2, "use_karras_sigmas": True}),
+    "euler_a": ("EulerAncestralDiscreteScheduler", {}),
+    "unipc": ("UniPCMultistepScheduler", {}),
+    "ddim": ("DDIMScheduler", {}),
+}
+
+# 步數預設組合：多步求解器在少步數下品質較穩定
+PRESETS = {
+    "draft": {"scheduler": "unipc", "steps": 8},
+    "fast": {"scheduler": "dpmpp_2m", "steps": 12},
+    "balanced": {"scheduler": "dpmpp_2m_karras", "steps": 20},
+    "quality": {"scheduler": "dpmpp_2m_karras", "steps": 30},
+}
+
+
+class SchedulerRegistry:
+    """
+    Scheduler 註冊表。
+    每個管道第一次切換時記住原本的 scheduler (作為 default 與建立其他 scheduler 的設定來源)，
+    建立過的 scheduler 依管道快取，之後的切換只是指派屬性。
+    """
+    def __init__(self, default_scheduler=DEFAULT_SCHEDULER, presets=None, model_defaults=None):
+        self.presets = {**PRESETS, **(presets or {})}
+        self.default_scheduler = default_scheduler or DEFAULT_SCHEDULER
+        self.model_defaults = dict(model_defaults or {})
+        self._originals = weakref.WeakKeyDictionary()  # pipe -> 原本的 scheduler
+        self._instances = weakref.WeakKeyDictionary()  # pipe -> {名稱: scheduler}
+        self._lock = threading.Lock()
+        self.swaps = 0
+        for name in [self.default_scheduler, *self.model_defaults.values()]:
+            self.validate(name)
+        for preset_name, preset in self.presets.items():
+            self.validate(preset.get("scheduler"))
+
+    @classmethod
+    def from_config(cls, config):
+        """從設定檔的 schedulers 區塊與 models.<模型>.scheduler 建立註冊表"""
+        scheduler_config = config.get('schedulers', {}) or {}
+        models_config = config.get('models', {}) or {}
+        model_defaults = {
+            model_name: model_config['scheduler']
+            for model_name, model_config in models_config.items()
+            if isinstance(model_config, dict) and model_config.get('scheduler')
+        }
+        return cls(
+            default_scheduler=scheduler_config.get('default', DEFAULT_SCHEDULER),
+            presets=scheduler_config.get('presets'),
+            model_defaults=model_defaults
+        )
+
+    @staticmethod
+    def names():
+        return [DEFAULT_SCHEDULER, *SCHEDULERS]
+
+    def validate(self, name):
+        if name is not None and name not in SCHEDULERS and name != DEFAULT_SCHEDULER:
+            raise ValueError(f"未知的 scheduler: {name}，可用: {', '.join(self.names())}")
+        return name
+
+    def resolve(self, model_name, steps, scheduler=None, preset=None):
+        """
+        決定實際使用的 (scheduler 名稱, 步數)。
+        優先順序：請求指定的 scheduler > 預設組合的 scheduler > 模型預設 > 全域預設；
+        指定預設組合時使用其步數。
+        """
+        if preset is not None:
+            if preset not in self.presets:
+                raise ValueError(f"未知的步數預設組合: {preset}，可用: {', '.join(self.presets)}")
+            steps = self.presets[preset].get("steps", steps)
+            scheduler = scheduler or self.presets[preset].get("scheduler")
+        scheduler = self.validate(scheduler) or self.model_defaults.get(model_name) or self.default_scheduler
+        return scheduler, int(steps)
+
+    def apply(self, pipe, name, overrides=None):
+        """
+        在管道上切換 scheduler。
+        overrides 為模型自帶的 scheduler 張量 (例如 Animefull 檢查點中的 betas)，建立新 scheduler 時沿用。
+        """
+        name = self.validate(name) or DEFAULT_SCHEDULER
+        if pipe is None or not hasattr(pipe, 'scheduler'):
+            return pipe
+        with self._lock:
+            original = self._originals.setdefault(pipe, pipe.scheduler)
+            instances = self._instances.setdefault(pipe, {DEFAULT_SCHEDULER: original})
+            scheduler = instances.get(name)
+            if scheduler is None:
+                scheduler = self._build(original, name, overrides)
+                instances[name] = scheduler
+            if pipe.scheduler is not scheduler:
+                pipe.scheduler = scheduler
+                self.swaps += 1
+                print(f"--- [SchedulerRegistry] 已切換 scheduler: {name} ({type(scheduler).__name__}) ---", flush=True)
+        return pipe
+
+    @staticmethod
+    def _build(original, name, overrides=None):
+        import diffusers
+        class_name, kwargs = SCHEDULERS[name]
+        kwargs = dict(kwargs)
+        if overrides and 'betas' in overrides:
+            kwargs['trained_betas'] = overrides['betas'].detach().float().cpu().numpy()
+        return getattr(diffusers, class_name).from_config(original.config, **kwargs)
+
+    def current(self, pipe):
+        """目前管道使用的 scheduler 名稱"""
+        with self._lock:
+            for name, scheduler in self._instances.get(pipe, {}).items():
+                if scheduler is pipe.scheduler:
+                    return name
+        return DEFAULT_SCHEDULER
+
+    def stats(self):
+        return {
+            "default": self.default_scheduler,
+            "model_defaults": self.model_defaults,
+            "schedulers": self.names(),
+            "presets": self.presets,
+            "swaps": self.swaps,
+        }
+
+print("--- [SchedulerRegistry] 模塊已成功被定義。---", flush=True)
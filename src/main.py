@@ -3,6 +3,7 @@
 用於生成基於 Stable Diffusion 的圖像
 """
 import os
+import argparse
 import torch
 
 # Mac M1 MPS 記憶體優化：在導入其他模組前設定
@@ -20,9 +21,22 @@ from src.core.config_manager import Config
 from src.core.model_manager import ModelManager
 from src.core.image_generator import ImageGenerator
 
+def parse_args():
+    """
+    解析命令列參數。
+    使用 parse_known_args：run_generate.sh 會傳入 -d / -r / -t 與表情等其他參數。
+    """
+    parser = argparse.ArgumentParser(description="蘑菇角色圖像生成")
+    parser.add_argument("--profile", action="store_true",
+                        help="以 torch.profiler 剖析生成過程 (受設定檔 profiling 的頻率上限約束)")
+    args, _ = parser.parse_known_args()
+    return args
+
 # 主函數
 def main():
     """主函數"""
+    args = parse_args()
+    
     # 加載配置
     config = Config()
     
@@ -35,14 +49,18 @@ def main():
         weight_names = []
     
     for weight_name in weight_names:
-        # 加載模型
-        pipe = model_manager.load_model(weight_name)
+        # 取得管道：常駐模式下只在第一次加載基礎管道，之後只切換 LoRA adapter
+        pipe = model_manager.get_pipeline(weight_name)
         
         # 初始化圖像生成器
-        image_generator = ImageGenerator(config, pipe, weight_name)
+        image_generator = ImageGenerator(config, pipe, weight_name, model_manager.get_img2img_pipeline(pipe))
+        image_generator.profile_requested = args.profile
         
         # 生成圖像
         image_generator.generate_images()
+    
+    # 等待並關閉後處理程序
+    ImageGenerator.get_postprocessor(config).shutdown()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
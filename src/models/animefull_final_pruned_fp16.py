@@ -1,42 +1,220 @@
 from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion import StableDiffusionPipeline
+from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_img2img import StableDiffusionImg2ImgPipeline
 import torch
 import os
+import sys
+import json
+import shutil
+import time
+import hashlib
 from src.models.base_model import BaseModel
 
+# Scheduler 相關的權重鍵
+SCHEDULER_KEYS = [
+    'alphas_cumprod', 'alphas_cumprod_prev', 'betas',
+    'log_one_minus_alphas_cumprod', 'posterior_log_variance_clipped',
+    'posterior_mean_coef1', 'posterior_mean_coef2', 'posterior_variance',
+    'sqrt_alphas_cumprod', 'sqrt_one_minus_alphas_cumprod',
+    'sqrt_recip_alphas_cumprod', 'sqrt_recipm1_alphas_cumprod'
+]
+
+# 烘焙格式版本，合併邏輯改變時遞增以讓舊的烘焙結果失效
+# 3: 沒有複製任何張量時不再烘焙 (舊版本可能把未修改的基礎模型烘焙成「已合併」)
+# 4: LDM 前綴的鍵不再去掉前綴後比對，且各組件的覆蓋率不足時不烘焙 (舊版本可能烘焙出只合併了部分 VAE 卷積的混合模型)
+BAKE_FORMAT_VERSION = 4
+
+# 必須幾乎完整合併的組件，以及每個組件最少需要被複製的參數比例
+REQUIRED_MERGE_COMPONENTS = ("unet", "text_encoder", "vae")
+MIN_MERGE_COVERAGE = 0.9
+
+# 權重鍵前綴 -> 管道組件名稱 (串流合併時依最長前綴路由)
+# 只有前綴與組件名稱相同的 diffusers 格式鍵會去掉前綴後比對參數名稱；
+# LDM 格式 (model.diffusion_model / first_stage_model / cond_stage_model) 的參數命名與 diffusers 不同，
+# 去掉前綴後部分 VAE 卷積會恰好同名同形狀而被誤複製，需先以轉換器 (例如 diffusers 的 from_single_file) 轉換
+COMPONENT_KEY_PREFIXES = {
+    "unet": "unet",
+    "model.diffusion_model": "unet",
+    "vae": "vae",
+    "first_stage_model": "vae",
+    "text_encoder": "text_encoder",
+    "cond_stage_model": "text_encoder",
+}
+
+
+def _current_rss_bytes():
+    """目前行程的常駐記憶體 (RSS)，無法取得時返回 None"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except Exception:
+        pass
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        return None
+
 class AnimefullFinalPrunedFp16Model(BaseModel):
     """
     AnimefullFinalPrunedFp16 模型
     基於 Stable Diffusion v1.5，並加載 animefull-final-pruned-fp16.safetensors 權重
     """
+    img2img_pipeline_class = StableDiffusionImg2ImgPipeline
+    
     def __init__(self):
         super().__init__("animefull_final_pruned_fp16")
         self.base_model_id = "runwayml/stable-diffusion-v1-5"
         self.weights_file = self._get_weights_file_path()
+        self.torch_dtype = torch.float16 if self.device == "cuda" else torch.float32
+        self.baked_dir = self._get_baked_dir_path()
+        self._merged = False
+        self._scheduler_overrides = {}
+        # 串流合併：逐一讀取張量並就地複製到現有參數，峰值記憶體約為模型大小加上單一張量
+        self.streaming_merge = os.getenv('ANIMEFULL_STREAMING_MERGE', 'true').lower() == 'true'
+        self.merge_report = None
     
     def _get_weights_file_path(self):
         """獲取權重文件路徑"""
         base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
         return os.path.join(base_dir, "assets", "models", "animefull-final-pruned-fp16.safetensors")
     
+    def _get_baked_dir_path(self):
+        """獲取烘焙後 (已合併權重) 的 diffusers 格式目錄，依 dtype 區分"""
+        dtype_name = str(self.torch_dtype).replace("torch.", "")
+        return os.path.join(os.path.dirname(self.weights_file), f"animefull-final-pruned-fp16-baked-{dtype_name}")
+    
     def load_pipeline(self):
-        """載入模型管道"""
-        print(f"🔄 加載基礎模型 {self.base_model_id}...")
+        """載入模型管道，優先使用烘焙後的目錄以跳過合併"""
+        pipe = self._load_baked_pipeline()
+        if pipe is None:
+            print(f"🔄 加載基礎模型 {self.base_model_id}...")
+            
+            # 載入基礎模型
+            pipe = StableDiffusionPipeline.from_pretrained(
+                self.base_model_id,
+                torch_dtype=self.torch_dtype,
+                safety_checker=None,
+                requires_safety_checker=False
+            )
+            
+            # 嘗試加載自定義權重 (在移動到設備與啟用卸載之前合併)
+            pipe = self._merge_custom_weights(pipe)
+            
+            # 一次性烘焙：之後的冷啟動直接讀取合併結果
+            if self._merged:
+                self._bake_pipeline(pipe)
+        
+        # 優化管道
+        pipe = self.optimize_pipeline(pipe)
         
-        # 載入基礎模型
+        return pipe
+    
+    def bake(self, force=False):
+        """合併權重並寫入烘焙目錄 (可在部署前單獨執行)"""
+        if not force and self._load_fingerprint_if_valid() is not None:
+            print(f"✅ 烘焙結果已是最新: {self.baked_dir}")
+            return self.baked_dir
         pipe = StableDiffusionPipeline.from_pretrained(
             self.base_model_id,
-            torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
+            torch_dtype=self.torch_dtype,
             safety_checker=None,
             requires_safety_checker=False
         )
-        
-        # 優化管道
-        pipe = self.optimize_pipeline(pipe)
-        
-        # 嘗試加載自定義權重
         pipe = self._merge_custom_weights(pipe)
-        
-        return pipe
+        if not self._merged:
+            print("⚠️ 沒有合併任何自定義權重，略過烘焙")
+            return None
+        return self._bake_pipeline(pipe)
+    
+    def _fingerprint(self):
+        """
+        計算權重來源的指紋：檔案大小、修改時間與 safetensors 標頭雜湊 (包含所有張量的名稱、形狀與偏移)，
+        加上基礎模型、dtype 與烘焙格式版本。不讀取整個檔案內容。
+        """
+        stat = os.stat(self.weights_file)
+        with open(self.weights_file, 'rb') as f:
+            header_size = int.from_bytes(f.read(8), 'little')
+            header_hash = hashlib.sha256(f.read(min(header_size, 100 * 1024 * 1024))).hexdigest()
+        return {
+            "format_version": BAKE_FORMAT_VERSION,
+            "weights_file": os.path.basename(self.weights_file),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "header_sha256": header_hash,
+            "base_model_id": self.base_model_id,
+            "torch_dtype": str(self.torch_dtype),
+            "streaming_merge": self.streaming_merge,
+        }
+    
+    def _load_fingerprint_if_valid(self):
+        """烘焙目錄存在且指紋與目前權重一致時返回指紋，否則返回 None"""
+        fingerprint_path = os.path.join(self.baked_dir, "fingerprint.json")
+        if not os.path.exists(self.weights_file) or not os.path.exists(fingerprint_path):
+            return None
+        try:
+            with open(fingerprint_path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+            if stored == self._fingerprint():
+                return stored
+            print(f"ℹ️ 權重指紋已改變，需要重新烘焙: {self.baked_dir}")
+        except Exception as e:
+            print(f"⚠️ 讀取烘焙指紋失敗: {e}")
+        return None
+    
+    def _load_baked_pipeline(self):
+        """以記憶體映射的 safetensors 與 low_cpu_mem_usage 直接讀取烘焙目錄"""
+        if self._load_fingerprint_if_valid() is None:
+            return None
+        try:
+            print(f"🔄 從烘焙目錄加載已合併的模型: {self.baked_dir}")
+            pipe = StableDiffusionPipeline.from_pretrained(
+                self.baked_dir,
+                torch_dtype=self.torch_dtype,
+                use_safetensors=True,
+                low_cpu_mem_usage=True,
+                safety_checker=None,
+                requires_safety_checker=False
+            )
+            self._apply_baked_scheduler_overrides(pipe)
+            self._merged = True
+            print("✅ 已從烘焙目錄加載，跳過權重合併")
+            return pipe
+        except Exception as e:
+            print(f"⚠️ 加載烘焙目錄失敗，改為重新合併: {e}")
+            return None
+    
+    def _bake_pipeline(self, pipe):
+        """將合併後的管道寫成 diffusers 格式的 safetensors 目錄，最後才寫入指紋"""
+        tmp_dir = f"{self.baked_dir}.tmp"
+        try:
+            print(f"🔄 烘焙合併後的模型到: {self.baked_dir}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            pipe.save_pretrained(tmp_dir, safe_serialization=True)
+            if self._scheduler_overrides:
+                from safetensors.torch import save_file
+                save_file(
+                    {k: v.detach().to("cpu").contiguous() for k, v in self._scheduler_overrides.items()},
+                    os.path.join(tmp_dir, "scheduler_overrides.safetensors")
+                )
+            with open(os.path.join(tmp_dir, "fingerprint.json"), 'w', encoding='utf-8') as f:
+                json.dump(self._fingerprint(), f, indent=2)
+            shutil.rmtree(self.baked_dir, ignore_errors=True)
+            os.replace(tmp_dir, self.baked_dir)
+            print(f"✅ 烘焙完成: {self.baked_dir}")
+            return self.baked_dir
+        except Exception as e:
+            print(f"⚠️ 烘焙失敗 (不影響本次加載): {e}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return None
+    
+    def _apply_baked_scheduler_overrides(self, pipe):
+        """Scheduler 的張量不在 scheduler config 中，需從烘焙目錄另外讀回"""
+        overrides_path = os.path.join(self.baked_dir, "scheduler_overrides.safetensors")
+        if not os.path.exists(overrides_path):
+            return
+        from safetensors.torch import load_file
+        overrides = load_file(overrides_path)
+        self._apply_scheduler_weights(pipe, overrides, list(overrides.keys()))
     
     def _merge_custom_weights(self, pipe):
         """合併自定義權重到模型中"""
@@ -55,15 +233,31 @@ class AnimefullFinalPrunedFp16Model(BaseModel):
                 print("⚠️ 未安裝 safetensors 庫，無法加載自定義權重")
                 return pipe
             
-            # 加載所有權重
-            all_weights = self._load_all_weights(self.weights_file)
-            if not all_weights:
-                return pipe
+            if self.streaming_merge:
+                # 串流合併，不在記憶體中保留整份權重
+                self.merge_report = self._stream_merge_weights(pipe)
+            else:
+                # 加載所有權重
+                all_weights = self._load_all_weights(self.weights_file)
+                if not all_weights:
+                    return pipe
+                
+                # 將權重應用到模型的不同組件
+                pipe = self._apply_weights_to_components(pipe, all_weights)
             
-            # 將權重應用到模型的不同組件
-            pipe = self._apply_weights_to_components(pipe, all_weights)
+            problems = self._merge_coverage_problems(self.merge_report)
+            if problems:
+                # 鍵名沒有匹配或只匹配了一部分 (例如 LDM 格式的檢查點)：管道是基礎模型或混合模型，不可標記為已合併或烘焙
+                print(
+                    f"❌❌❌ 權重沒有完整合併到基礎模型 ({self.weights_file})：{'；'.join(problems)}。"
+                    f"檢查點的鍵名可能是 LDM 格式 (model.diffusion_model.*)，需先轉換為 diffusers 格式。"
+                    f"目前使用的不是 animefull 模型，不會烘焙。",
+                    file=sys.stderr, flush=True
+                )
+                return pipe
+            self._merged = True
             
-            print(f"✅ 成功合併 animefull-final-pruned-fp16 權重")
+            print(f"✅ 成功合併 animefull-final-pruned-fp16 權重 ({self.merge_report['copied']} 個張量)")
             
         except Exception as e:
             print(f"⚠️ 合併權重失敗: {e}")
@@ -71,8 +265,138 @@ class AnimefullFinalPrunedFp16Model(BaseModel):
         
         return pipe
     
+    @staticmethod
+    def _component_parameter_counts(pipe):
+        """各必要組件的參數數量，用來計算合併覆蓋率"""
+        counts = {}
+        for component_name in REQUIRED_MERGE_COMPONENTS:
+            component = getattr(pipe, component_name, None)
+            if component is not None and hasattr(component, 'named_parameters'):
+                counts[component_name] = sum(1 for _ in component.named_parameters())
+        return counts
+    
+    @staticmethod
+    def _merge_coverage_problems(report):
+        """
+        檢查每個必要組件的合併覆蓋率，返回問題描述 (空列表表示可以標記為已合併)。
+        被複製的參數比例需達到 MIN_MERGE_COVERAGE，且路由到該組件卻沒有對應參數的鍵不可超過被複製數量的 (1 - MIN_MERGE_COVERAGE)。
+        """
+        if not report or report.get("copied", 0) == 0:
+            return ["沒有任何張量被複製"]
+        problems = []
+        copied = report.get("per_component", {})
+        unmatched = report.get("per_component_unmatched", {})
+        for component_name, total in (report.get("component_parameters") or {}).items():
+            component_copied = copied.get(component_name, 0)
+            coverage = component_copied / total if total else 0.0
+            if coverage < MIN_MERGE_COVERAGE:
+                problems.append(f"{component_name} 只複製了 {component_copied}/{total} 個參數 ({coverage:.0%})")
+            elif unmatched.get(component_name, 0) > component_copied * (1 - MIN_MERGE_COVERAGE):
+                problems.append(f"{component_name} 有 {unmatched[component_name]} 個鍵沒有對應的參數")
+        return problems
+    
+    def _build_prefix_index(self, pipe):
+        """建立 (前綴, 組件名稱) 索引，依前綴長度由長到短排序，讓 text_encoder_2 不會被 text_encoder 搶先匹配"""
+        routes = dict(COMPONENT_KEY_PREFIXES)
+        for component_name, component in (getattr(pipe, 'components', None) or {}).items():
+            if hasattr(component, 'named_parameters'):
+                routes.setdefault(component_name, component_name)
+        return sorted(routes.items(), key=lambda item: len(item[0]), reverse=True)
+    
+    @staticmethod
+    def _route_key(key, prefix_index):
+        for prefix, component_name in prefix_index:
+            if key == prefix or key.startswith(prefix + "."):
+                return prefix, component_name
+        return None
+    
+    def _stream_merge_weights(self, pipe):
+        """
+        串流合併權重：以 safe_open 逐一讀取張量，依前綴索引找到組件中的參數後就地複製並立即釋放。
+        鍵名先以完整名稱比對，diffusers 格式的鍵 (前綴即組件名稱) 再以去掉前綴的名稱比對；找不到或形狀不符的鍵會被略過並計數。
+        返回包含耗時與峰值記憶體的報告。
+        """
+        from safetensors import safe_open
+        
+        prefix_index = self._build_prefix_index(pipe)
+        scheduler_keys = set(SCHEDULER_KEYS)
+        targets = {}  # 組件名稱 -> {參數 / buffer 名稱: 張量}
+        scheduler_weights = {}
+        report = {
+            "copied": 0, "copied_bytes": 0, "unmatched": 0, "shape_mismatch": 0,
+            "per_component": {}, "per_component_unmatched": {},
+            "component_parameters": self._component_parameter_counts(pipe),
+        }
+        
+        rss_before = _current_rss_bytes()
+        peak_rss = rss_before
+        start = time.perf_counter()
+        
+        with torch.no_grad(), safe_open(self.weights_file, framework="pt", device="cpu") as f:
+            for index, k in enumerate(f.keys()):
+                if k in scheduler_keys:
+                    scheduler_weights[k] = f.get_tensor(k)
+                    continue
+                
+                route = self._route_key(k, prefix_index)
+                if route is None:
+                    report["unmatched"] += 1
+                    continue
+                prefix, component_name = route
+                
+                if component_name not in targets:
+                    component = getattr(pipe, component_name, None)
+                    targets[component_name] = {} if component is None else {
+                        **dict(component.named_parameters()), **dict(component.named_buffers())
+                    }
+                target = targets[component_name]
+                param = target.get(k)
+                if param is None and prefix == component_name:
+                    param = target.get(k[len(prefix) + 1:])
+                if param is None:
+                    report["unmatched"] += 1
+                    report["per_component_unmatched"][component_name] = report["per_component_unmatched"].get(component_name, 0) + 1
+                    continue
+                
+                tensor = f.get_tensor(k)
+                if tensor.shape != param.shape:
+                    report["shape_mismatch"] += 1
+                    report["per_component_unmatched"][component_name] = report["per_component_unmatched"].get(component_name, 0) + 1
+                    del tensor
+                    continue
+                param.data.copy_(tensor)
+                report["copied"] += 1
+                report["copied_bytes"] += tensor.numel() * tensor.element_size()
+                report["per_component"][component_name] = report["per_component"].get(component_name, 0) + 1
+                del tensor
+                
+                # 定期取樣 RSS，避免每個張量都讀取一次行程資訊
+                if index % 64 == 0:
+                    rss = _current_rss_bytes()
+                    if rss is not None and (peak_rss is None or rss > peak_rss):
+                        peak_rss = rss
+        
+        if scheduler_weights:
+            self._apply_scheduler_weights(pipe, scheduler_weights, list(scheduler_weights.keys()))
+        
+        rss_after = _current_rss_bytes()
+        if rss_after is not None and (peak_rss is None or rss_after > peak_rss):
+            peak_rss = rss_after
+        report["merge_seconds"] = time.perf_counter() - start
+        report["rss_before_bytes"] = rss_before
+        report["rss_after_bytes"] = rss_after
+        report["peak_rss_bytes"] = peak_rss
+        
+        to_mb = lambda value: f"{value / 1024**2:.0f}MB" if value is not None else "N/A"
+        print(
+            f"📊 串流合併完成：複製 {report['copied']} 個張量 ({report['copied_bytes'] / 1024**2:.0f}MB)，"
+            f"未匹配 {report['unmatched']}，形狀不符 {report['shape_mismatch']}，"
+            f"耗時 {report['merge_seconds']:.2f}s，RSS {to_mb(rss_before)} -> {to_mb(rss_after)} (峰值 {to_mb(peak_rss)})"
+        )
+        return report
+    
     def _load_all_weights(self, weights_file):
-        """加載所有權重"""
+        """加載所有權重 (非串流路徑，ANIMEFULL_STREAMING_MERGE=false 時使用)"""
         all_weights = {}
         
         try:
@@ -101,14 +425,17 @@ class AnimefullFinalPrunedFp16Model(BaseModel):
         
         keys = list(all_weights.keys())
         
-        # 應用 UNet 權重
-        self._apply_unet_weights(pipe, all_weights, keys)
-        
-        # 應用 VAE 權重
-        self._apply_vae_weights(pipe, all_weights, keys)
-        
-        # 應用 Text Encoder 權重
-        self._apply_text_encoder_weights(pipe, all_weights, keys)
+        # 應用 UNet / VAE / Text Encoder 權重，記錄實際載入的張量數
+        per_component = {
+            "unet": self._apply_unet_weights(pipe, all_weights, keys),
+            "vae": self._apply_vae_weights(pipe, all_weights, keys),
+            "text_encoder": self._apply_text_encoder_weights(pipe, all_weights, keys),
+        }
+        self.merge_report = {
+            "copied": sum(per_component.values()),
+            "per_component": {name: count for name, count in per_component.items() if count},
+            "component_parameters": self._component_parameter_counts(pipe),
+        }
         
         # 應用 Scheduler 權重
         self._apply_scheduler_weights(pipe, all_weights, keys)
@@ -118,36 +445,39 @@ class AnimefullFinalPrunedFp16Model(BaseModel):
         
         return pipe
     
+    @staticmethod
+    def _count_loaded(result, state_dict):
+        """load_state_dict(strict=False) 實際載入的鍵數 (略過的鍵會出現在 unexpected_keys)"""
+        unexpected = getattr(result, "unexpected_keys", None) or []
+        return len(state_dict) - len(unexpected)
+    
     def _apply_unet_weights(self, pipe, all_weights, keys):
         """應用 UNet 權重"""
         unet_keys = [k for k in keys if k.startswith("unet") or k.startswith("model.diffusion_model")]
         if unet_keys:
             unet_state_dict = {k: all_weights[k] for k in unet_keys}
-            pipe.unet.load_state_dict(unet_state_dict, strict=False)
+            return self._count_loaded(pipe.unet.load_state_dict(unet_state_dict, strict=False), unet_state_dict)
+        return 0
     
     def _apply_vae_weights(self, pipe, all_weights, keys):
         """應用 VAE 權重"""
         vae_keys = [k for k in keys if k.startswith("vae") or k.startswith("first_stage_model")]
         if vae_keys:
             vae_state_dict = {k: all_weights[k] for k in vae_keys}
-            pipe.vae.load_state_dict(vae_state_dict, strict=False)
+            return self._count_loaded(pipe.vae.load_state_dict(vae_state_dict, strict=False), vae_state_dict)
+        return 0
     
     def _apply_text_encoder_weights(self, pipe, all_weights, keys):
         """應用 Text Encoder 權重"""
         text_encoder_keys = [k for k in keys if k.startswith("text_encoder") or k.startswith("cond_stage_model")]
         if text_encoder_keys:
             text_encoder_state_dict = {k: all_weights[k] for k in text_encoder_keys}
-            pipe.text_encoder.load_state_dict(text_encoder_state_dict, strict=False)
+            return self._count_loaded(pipe.text_encoder.load_state_dict(text_encoder_state_dict, strict=False), text_encoder_state_dict)
+        return 0
     
     def _apply_scheduler_weights(self, pipe, all_weights, keys):
         """應用 Scheduler 權重"""
-        scheduler_keys = [
-            'alphas_cumprod', 'alphas_cumprod_prev', 'betas',
-            'log_one_minus_alphas_cumprod', 'posterior_log_variance_clipped',
-            'posterior_mean_coef1', 'posterior_mean_coef2', 'posterior_variance',
-            'sqrt_alphas_cumprod', 'sqrt_one_minus_alphas_cumprod',
-            'sqrt_recip_alphas_cumprod', 'sqrt_recipm1_alphas_cumprod'
-        ]
+        scheduler_keys = set(SCHEDULER_KEYS)
         
         found_scheduler_keys = [k for k in keys if k in scheduler_keys]
         if found_scheduler_keys and hasattr(pipe, 'scheduler'):
@@ -155,6 +485,8 @@ class AnimefullFinalPrunedFp16Model(BaseModel):
                 for k in found_scheduler_keys:
                     if hasattr(pipe.scheduler, k):
                         setattr(pipe.scheduler, k, all_weights[k].to(self.device))
+                        # 記錄下來，烘焙時另外保存
+                        self._scheduler_overrides[k] = all_weights[k]
                 
                 # 重新計算時間步長
                 if hasattr(pipe.scheduler, 'set_timesteps') and hasattr(pipe.scheduler, 'num_inference_steps'):
@@ -165,18 +497,14 @@ class AnimefullFinalPrunedFp16Model(BaseModel):
     
     def _apply_other_weights(self, pipe, all_weights, keys):
         """應用其他權重"""
-        # 已處理的鍵
-        processed_keys = []
-        processed_keys.extend([k for k in keys if k.startswith("unet") or k.startswith("model.diffusion_model")])
-        processed_keys.extend([k for k in keys if k.startswith("vae") or k.startswith("first_stage_model")])
-        processed_keys.extend([k for k in keys if k.startswith("text_encoder") or k.startswith("cond_stage_model")])
-        processed_keys.extend([k for k in keys if k in [
-            'alphas_cumprod', 'alphas_cumprod_prev', 'betas',
-            'log_one_minus_alphas_cumprod', 'posterior_log_variance_clipped',
-            'posterior_mean_coef1', 'posterior_mean_coef2', 'posterior_variance',
-            'sqrt_alphas_cumprod', 'sqrt_one_minus_alphas_cumprod',
-            'sqrt_recip_alphas_cumprod', 'sqrt_recipm1_alphas_cumprod'
-        ]])
+        # 已處理的鍵 (以集合保存，避免逐一比對列表造成平方級的時間)
+        handled_prefixes = (
+            "unet", "model.diffusion_model",
+            "vae", "first_stage_model",
+            "text_encoder", "cond_stage_model",
+        )
+        scheduler_keys = set(SCHEDULER_KEYS)
+        processed_keys = {k for k in keys if k.startswith(handled_prefixes) or k in scheduler_keys}
         
         # 未處理的鍵
         other_keys = [k for k in keys if k not in processed_keys]
@@ -205,4 +533,13 @@ class AnimefullFinalPrunedFp16Model(BaseModel):
                         except Exception:
                             pass
                 except Exception:
-                    pass
\ No newline at end of file
+                    pass
+
+
+if __name__ == "__main__":
+    # 一次性烘焙：python -m src.models.animefull_final_pruned_fp16 [--force]
+    import argparse
+    parser = argparse.ArgumentParser(description="合併 animefull-final-pruned-fp16 權重並寫入 diffusers 格式目錄")
+    parser.add_argument("--force", action="store_true", help="即使指紋一致也重新烘焙")
+    args = parser.parse_args()
+    AnimefullFinalPrunedFp16Model().bake(force=args.force)
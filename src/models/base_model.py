@@ -1,14 +1,56 @@
 import torch
 import os
 from abc import ABC, abstractmethod
+from src.core.cpu_acceleration import CpuAccelerator
 
 class BaseModel(ABC):
     """
     基礎模型類，所有模型類都應該繼承自這個類
     """
+    # 子類指定對應的 img2img 管道類別 (例如 StableDiffusionImg2ImgPipeline)
+    img2img_pipeline_class = None
+    # 管道優化開關的預設值 (與原本的行為相同)，可由設定檔的 optimizations 區塊覆寫
+    DEFAULT_OPTIMIZATIONS = {
+        "attention_slicing": True,
+        "cpu_offload": True,
+        "xformers": True,
+        "vae_slicing": True,
+        "vae_tiling": True,
+        # 裝置為 CPU 時改用 CPU 加速設定 (bf16 autocast、channels_last、執行緒、torch.compile)，
+        # 並略過在 CPU 上反而變慢的 attention slicing 與 xformers (需在設定檔中開啟)
+        "cpu_profile": False,
+    }
+    
     def __init__(self, model_name):
         self.model_name = model_name
         self.device = self._get_device()
+        self.optimizations = dict(self.DEFAULT_OPTIMIZATIONS)
+        self.cpu_accelerator = None
+        self.execution_backend = None
+        self.lora_registry = None
+    
+    def set_optimizations(self, optimizations):
+        """覆寫管道優化開關，必須在 load_pipeline 之前調用"""
+        for key, value in (optimizations or {}).items():
+            if key not in self.optimizations:
+                print(f"⚠️ 未知的優化選項: {key}")
+                continue
+            self.optimizations[key] = bool(value)
+    
+    def set_cpu_accelerator(self, cpu_accelerator):
+        """指定 CPU 加速設定 (來自設定檔的 cpu_acceleration 區塊)，必須在 load_pipeline 之前調用"""
+        self.cpu_accelerator = cpu_accelerator
+    
+    def set_execution_backend(self, execution_backend):
+        """指定 CPU 上的替代執行後端 (例如 ONNX Runtime)，None 表示使用 PyTorch"""
+        self.execution_backend = execution_backend
+    
+    def set_lora_registry(self, lora_registry):
+        """指定 LoRA 註冊表，已索引的權重檔改由快取的 state dict 加載"""
+        self.lora_registry = lora_registry
+    
+    def _use_cpu_profile(self):
+        return self.device == "cpu" and self.optimizations["cpu_profile"]
         
     def _get_device(self):
         """獲取可用的設備 (針對 Render 部署優化)"""
@@ -41,13 +83,17 @@ class BaseModel(ABC):
         # 將模型移至指定設備
         pipe = pipe.to(self.device)
         
-        # 🚀 強化記憶體優化
-        if hasattr(pipe, "enable_attention_slicing"):
+        cpu_profile = self._use_cpu_profile()
+        
+        # 🚀 強化記憶體優化 (CPU 上切片注意力只會增加開銷)
+        if self.optimizations["attention_slicing"] and not cpu_profile and hasattr(pipe, "enable_attention_slicing"):
             pipe.enable_attention_slicing()
         
         # 嘗試啟用 CPU 卸載 (需要 accelerate 套件)
         try:
-            if hasattr(pipe, "enable_model_cpu_offload") and self.device in ["mps", "cuda"]:
+            if not self.optimizations["cpu_offload"]:
+                pass
+            elif hasattr(pipe, "enable_model_cpu_offload") and self.device in ["mps", "cuda"]:
                 pipe.enable_model_cpu_offload()
                 print(f"✅ 已啟用 {self.device.upper()} CPU 卸載")
             elif hasattr(pipe, "enable_sequential_cpu_offload") and self.device in ["cuda", "mps"]:
@@ -58,7 +104,9 @@ class BaseModel(ABC):
             print("💡 建議執行: pip install accelerate")
         
         # 記憶體高效注意力：Mac M1 不支援 xformers，跳過
-        if self.device != "mps" and hasattr(pipe, "enable_xformers_memory_efficient_attention"):
+        if not self.optimizations["xformers"] or cpu_profile:
+            pass
+        elif self.device != "mps" and hasattr(pipe, "enable_xformers_memory_efficient_attention"):
             try:
                 pipe.enable_xformers_memory_efficient_attention()
                 print("✅ 已啟用 xformers 記憶體高效注意力")
@@ -68,21 +116,64 @@ class BaseModel(ABC):
             print("ℹ️ Mac M1 不支援 xformers，使用原生 MPS 優化")
         
         # 啟用 VAE 切片 (減少 VAE 記憶體使用)
-        if hasattr(pipe, "enable_vae_slicing"):
+        if self.optimizations["vae_slicing"] and hasattr(pipe, "enable_vae_slicing"):
             pipe.enable_vae_slicing()
         
         # 啟用 VAE 平鋪 (處理大圖像時節省記憶體)
-        if hasattr(pipe, "enable_vae_tiling"):
+        if self.optimizations["vae_tiling"] and hasattr(pipe, "enable_vae_tiling"):
             pipe.enable_vae_tiling()
+        
+        # CPU 加速設定 (UNet 由替代後端執行時不需要 torch.compile)
+        use_backend = self.execution_backend is not None and self.device == "cpu"
+        if cpu_profile:
+            if self.cpu_accelerator is None:
+                self.cpu_accelerator = CpuAccelerator()
+            pipe = self.cpu_accelerator.apply(pipe, compile_unet=False if use_backend else None)
+        
+        # 替代執行後端：保留 PyTorch 模組，推理改由後端執行
+        if use_backend:
+            pipe = self.execution_backend.attach(pipe, self.model_name)
             
         return pipe
     
-    def load_lora_weights(self, pipe, weight_name):
-        """加載 LoRA 權重"""
+    def to_img2img_pipeline(self, pipe):
+        """以相同組件建立 img2img 管道，共用已加載的權重與 LoRA，不重新加載模型"""
+        if self.img2img_pipeline_class is None:
+            return None
+        import inspect
+        accepted = inspect.signature(self.img2img_pipeline_class.__init__).parameters
+        components = {name: component for name, component in pipe.components.items() if name in accepted}
+        if 'requires_safety_checker' in accepted:
+            components['requires_safety_checker'] = False
+        img2img_pipe = self.img2img_pipeline_class(**components)
+        img2img_pipe.safety_checker = None
+        print(f"✅ 已建立 img2img 管道：{self.img2img_pipeline_class.__name__}")
+        return img2img_pipe
+    
+    def load_lora_weights(self, pipe, weight_name, adapter_name=None):
+        """加載 LoRA 權重，提供 adapter_name 時以具名 adapter 掛載，便於之後切換或卸載"""
         if weight_name:
             try:
-                pipe.load_lora_weights("assets/weights", weight_name=weight_name)
+                if self.lora_registry is not None and self.lora_registry.info(weight_name) is not None:
+                    self.lora_registry.load_into(pipe, weight_name, adapter_name=adapter_name)
+                elif adapter_name:
+                    pipe.load_lora_weights("assets/weights", weight_name=weight_name, adapter_name=adapter_name)
+                else:
+                    pipe.load_lora_weights("assets/weights", weight_name=weight_name)
                 print(f"✅ 已加載 LoRA 權重：{weight_name}")
             except Exception as e:
                 print(f"⚠️ 加載 LoRA 權重失敗: {e}")
+        return pipe
+    
+    def unload_lora_weights(self, pipe, adapter_name=None):
+        """卸載 LoRA 權重，提供 adapter_name 時只刪除該 adapter"""
+        try:
+            if adapter_name:
+                pipe.delete_adapters(adapter_name)
+                print(f"✅ 已卸載 LoRA adapter：{adapter_name}")
+            else:
+                pipe.unload_lora_weights()
+                print("✅ 已卸載所有 LoRA 權重")
+        except Exception as e:
+            print(f"⚠️ 卸載 LoRA 權重失敗: {e}")
         return pipe
\ No newline at end of file
@@ -1,4 +1,5 @@
 from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion import StableDiffusionPipeline
+from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_img2img import StableDiffusionImg2ImgPipeline
 import torch
 from src.models.base_model import BaseModel
 
@@ -6,6 +7,8 @@ class StableDiffusionV15Model(BaseModel):
     """
     Stable Diffusion v1.5 模型
     """
+    img2img_pipeline_class = StableDiffusionImg2ImgPipeline
+    
     def __init__(self):
         super().__init__("stable_diffusion_v1_5")
         self.model_id = "runwayml/stable-diffusion-v1-5"
@@ -1,4 +1,5 @@
 from diffusers.pipelines.stable_diffusion_xl.pipeline_stable_diffusion_xl import StableDiffusionXLPipeline
+from diffusers.pipelines.stable_diffusion_xl.pipeline_stable_diffusion_xl_img2img import StableDiffusionXLImg2ImgPipeline
 import torch
 from src.models.base_model import BaseModel
 
@@ -6,6 +7,8 @@ class StableDiffusionXLModel(BaseModel):
     """
     Stable Diffusion XL 模型
     """
+    img2img_pipeline_class = StableDiffusionXLImg2ImgPipeline
+    
     def __init__(self):
         super().__init__("stable_diffusion_xl")
         self.model_id = "stabilityai/stable-diffusion-xl-base-1.0"
@@ -0,0 +1,78 @@
+import os
+import time
+from types import SimpleNamespace
+from PIL import Image, ImageDraw
+from src.models.base_model import BaseModel
+
+class StubPipeline:
+    """
+    模擬 diffusers 文字生成圖像管道的介面，不需要任何權重。
+    每一步以 sleep 模擬推理耗時 (會釋放 GIL，行為接近 GPU 推理)，
+    並在純色背景上畫出依種子變化的圖形，讓去背與後處理照常執行。
+    """
+    def __init__(self, step_seconds=0.0, decode_seconds=0.0):
+        self.step_seconds = step_seconds
+        self.decode_seconds = decode_seconds
+        self.components = {}
+
+    def __call__(self, prompt=None, negative_prompt=None, num_inference_steps=50, height=512, width=512,
+                 generator=None, callback_on_step_end=None, **kwargs):
+        generators = generator if isinstance(generator, list) else [generator]
+        if isinstance(prompt, list):
+            batch_size = len(prompt)
+        elif "prompt_embeds" in kwargs and hasattr(kwargs["prompt_embeds"], "shape"):
+            batch_size = kwargs["prompt_embeds"].shape[0]
+        else:
+            batch_size = len(generators)
+
+        for step in range(num_inference_steps):
+            if self.step_seconds:
+                time.sleep(self.step_seconds)
+            if callback_on_step_end is not None:
+                callback_on_step_end(self, step, step, {})
+        if self.decode_seconds:
+            time.sleep(self.decode_seconds)
+
+        images = [
+            self._render(height, width, self._seed(generators[index] if index < len(generators) else None))
+            for index in range(batch_size)
+        ]
+        return SimpleNamespace(images=images)
+
+    @staticmethod
+    def _seed(generator):
+        try:
+            return int(generator.initial_seed())
+        except Exception:
+            return 0
+
+    @staticmethod
+    def _render(height, width, seed):
+        image = Image.new("RGB", (width, height), (250, 250, 250))
+        draw = ImageDraw.Draw(image)
+        color = (80 + seed % 150, 120 + (seed // 7) % 120, 160 + (seed // 13) % 90)
+        draw.ellipse((width * 0.25, height * 0.15, width * 0.75, height * 0.55), fill=color)
+        draw.rectangle((width * 0.4, height * 0.55, width * 0.6, height * 0.85), fill=(235, 215, 190))
+        return image
+
+class StubPipelineModel(BaseModel):
+    """
+    負載測試用的假模型：不載入任何權重，只用來量測 API、佇列與後處理的服務開銷。
+    每步耗時可由環境變數 STUB_STEP_SECONDS / STUB_DECODE_SECONDS 設定。
+    """
+    def __init__(self):
+        super().__init__("stub_pipeline")
+
+    def load_pipeline(self):
+        print(f"🔄 建立 {self.model_name} 假管道 (不載入權重)...")
+        return StubPipeline(
+            step_seconds=float(os.getenv("STUB_STEP_SECONDS", "0.01")),
+            decode_seconds=float(os.getenv("STUB_DECODE_SECONDS", "0.02"))
+        )
+
+    def load_lora_weights(self, pipe, weight_name, adapter_name=None):
+        """假管道沒有 LoRA，略過加載"""
+        return pipe
+
+    def unload_lora_weights(self, pipe, adapter_name=None):
+        return pipe
@@ -0,0 +1,142 @@
+from diffusers import AutoencoderKL, DDIMScheduler, UNet2DConditionModel
+from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion import StableDiffusionPipeline
+from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_img2img import StableDiffusionImg2ImgPipeline
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+import os
+import json
+import zlib
+import tempfile
+import torch
+from src.models.base_model import BaseModel
+
+TOKENIZER_DIR = os.path.join(tempfile.gettempdir(), "mushroom_tiny_clip_tokenizer")
+BOS_TOKEN = "<|startoftext|>"
+EOS_TOKEN = "<|endoftext|>"
+
+def _bytes_to_unicode():
+    """與 CLIP BPE 相同的位元組 -> 可見字元對應表"""
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(2 ** 8):
+        if b not in bs:
+            bs.append(b)
+            cs.append(2 ** 8 + n)
+            n += 1
+    return [chr(c) for c in cs]
+
+def build_tiny_tokenizer(directory=TOKENIZER_DIR):
+    """
+    在本地建立最小的 CLIP 分詞器：詞彙表只有特殊符號與單一位元組字元 (沒有 BPE 合併規則)，
+    不需要下載任何檔案。
+    """
+    os.makedirs(directory, exist_ok=True)
+    vocab_path = os.path.join(directory, "vocab.json")
+    merges_path = os.path.join(directory, "merges.txt")
+    if not os.path.exists(vocab_path):
+        tokens = [BOS_TOKEN, EOS_TOKEN]
+        for char in _bytes_to_unicode():
+            tokens.extend([char, f"{char}</w>"])
+        with open(vocab_path, "w", encoding="utf-8") as f:
+            json.dump({token: index for index, token in enumerate(tokens)}, f)
+        with open(merges_path, "w", encoding="utf-8") as f:
+            f.write("#version: 0.2\n")
+    return CLIPTokenizer(vocab_path, merges_path, model_max_length=77)
+
+class TinyRandomSdModel(BaseModel):
+    """
+    隨機初始化的迷你 Stable Diffusion 模型 (與 SD v1.5 相同的架構，參數量極小)。
+    不需要下載權重，用於基準測試與負載測試；生成的圖像沒有意義。
+    """
+    img2img_pipeline_class = StableDiffusionImg2ImgPipeline
+
+    def __init__(self, seed=0):
+        super().__init__("tiny_random_sd")
+        self.seed = seed
+
+    def load_pipeline(self):
+        """以固定種子建立隨機權重的管道"""
+        print(f"🔄 建立 {self.model_name} 隨機模型...")
+        torch.manual_seed(self.seed)
+
+        tokenizer = build_tiny_tokenizer()
+        text_encoder = CLIPTextModel(CLIPTextConfig(
+            vocab_size=len(tokenizer),
+            hidden_size=32,
+            intermediate_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            max_position_embeddings=77,
+            bos_token_id=tokenizer.bos_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id
+        ))
+        unet = UNet2DConditionModel(
+            sample_size=64,
+            in_channels=4,
+            out_channels=4,
+            layers_per_block=1,
+            block_out_channels=(32, 64),
+            down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+            up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+            cross_attention_dim=32,
+            attention_head_dim=8,
+            norm_num_groups=32
+        )
+        # 四層 block：VAE 縮放倍數與 SD v1.5 相同 (8 倍)
+        vae = AutoencoderKL(
+            in_channels=3,
+            out_channels=3,
+            latent_channels=4,
+            block_out_channels=(16, 16, 16, 16),
+            down_block_types=("DownEncoderBlock2D",) * 4,
+            up_block_types=("UpDecoderBlock2D",) * 4,
+            layers_per_block=1,
+            norm_num_groups=8,
+            sample_size=512
+        )
+        scheduler = DDIMScheduler(
+            beta_start=0.00085,
+            beta_end=0.012,
+            beta_schedule="scaled_linear",
+            clip_sample=False,
+            set_alpha_to_one=False
+        )
+        pipe = StableDiffusionPipeline(
+            vae=vae,
+            text_encoder=text_encoder,
+            tokenizer=tokenizer,
+            unet=unet,
+            scheduler=scheduler,
+            safety_checker=None,
+            feature_extractor=None,
+            requires_safety_checker=False
+        )
+
+        # 優化管道
+        pipe = self.optimize_pipeline(pipe)
+
+        return pipe
+
+    def load_lora_weights(self, pipe, weight_name, adapter_name=None):
+        """
+        assets/weights 中的 LoRA 與迷你模型的形狀不符：改以權重名稱為種子在 UNet 上建立隨機 LoRA adapter，
+        讓基準測試可以量測 adapter 與融合模式的開銷
+        """
+        if not weight_name:
+            return pipe
+        try:
+            from peft import LoraConfig
+            rng_state = torch.random.get_rng_state()
+            torch.manual_seed(zlib.crc32(weight_name.encode()))
+            try:
+                pipe.unet.add_adapter(
+                    LoraConfig(r=4, lora_alpha=4, init_lora_weights=False, target_modules=["to_q", "to_k", "to_v", "to_out.0"]),
+                    adapter_name=adapter_name or "default"
+                )
+            finally:
+                torch.random.set_rng_state(rng_state)
+            print(f"ℹ️ 迷你模型以隨機 LoRA adapter 代替權重檔：{weight_name}")
+        except Exception as e:
+            print(f"⚠️ 建立隨機 LoRA adapter 失敗: {e}")
+        return pipe
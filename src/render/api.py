@@ -3,10 +3,13 @@ print("--- 步驟 0：Python 腳本開始執行 ---", flush=True)
 
 import os
 import sys
+import math
+import secrets
 import time
-from typing import Optional, Dict, Any
+import asyncio
+from typing import Optional, Dict, Any, List, Tuple
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
@@ -39,6 +42,11 @@ try:
     # 導入第三個模塊
     print("--- 步驟 3.5：準備導入 ImageGenerator... ---", flush=True)
     from src.core.image_generator import ImageGenerator
+    from src.core import metrics
+    from src.render.generation_executor import GenerationExecutor, QueueFullError
+    from src.render.job_store import JobStore, JobRunner
+    from src.render.micro_batcher import MicroBatcher
+    from src.core.result_cache import ResultCache, canonical_key
     print("--- 步驟 4：所有自訂模塊導入成功 ---", flush=True)
 
     # ========================================================================
@@ -52,8 +60,16 @@ try:
     model_manager = ModelManager(config)
     print("--- 步驟 8：ModelManager(config) 物件初始化成功 ---", flush=True)
     
-    loaded_models = {}  # 緩存已加載的模型
-
+    # 生成執行器：推理在專用工作執行緒中執行，佇列滿時快速返回 503
+    generation_executor = GenerationExecutor.from_config(config)
+    
+    # 非同步任務：任務保存在本地 SQLite，重啟後排隊中的任務仍會執行
+    jobs_config = config.get('jobs', {}) or {}
+    job_store = JobStore(jobs_config.get('db_path', 'outputs/jobs.sqlite3'))
+    
+    # 生成結果快取：固定種子的重複請求直接返回已生成的圖像 (result_cache.enabled 為 false 時為 None)
+    result_cache = ResultCache.from_config(config)
+    
     # 創建 FastAPI 應用
     print("--- 步驟 9：準備建立 FastAPI App 實例... ---", flush=True)
     app = FastAPI(
@@ -85,7 +101,10 @@ print("--- 步驟 12：CORS 中間件設定完成 ---", flush=True)
 
 # 定義請求模型
 class GenerateImageRequest(BaseModel):
-    weight_name: str
+    # 單一 LoRA (強度 1.0)；與 loras 都未指定時使用基礎模型
+    weight_name: Optional[str] = None
+    # 多個 LoRA 組合：[(weight_name, 強度)]，例如 [["dgu-01.safetensors", 0.7], ["dgu-02.safetensors", 0.3]]
+    loras: Optional[List[Tuple[str, float]]] = None
     steps: int = 50
     action_key: Optional[str] = "standing"
     expression_key: Optional[str] = "smiling"
@@ -97,19 +116,80 @@ class GenerateImageRequest(BaseModel):
     noise_level: float = 0.0
     height: int = 512
     width: int = 512
+    seed: Optional[int] = None
+    # 取樣器與步數預設組合 (例如 "fast")；未指定時使用模型在 config.yaml 中的預設 scheduler
+    scheduler: Optional[str] = None
+    preset: Optional[str] = None
+    # 要求以 torch.profiler 剖析這次生成 (受伺服器的剖析頻率上限約束)
+    profile: bool = False
 
 # 定義響應模型
 class GenerateImageResponse(BaseModel):
     image_path: str
     generation_time: float
     parameters: Dict[str, Any]
+    stage_timings: Dict[str, float] = {}
+    profile: Optional[Dict[str, str]] = None
+    # 結果來自生成結果快取 (沒有重新生成)
+    cached: bool = False
+
+# 定義任務響應模型
+class JobSubmitResponse(BaseModel):
+    job_id: str
+    status: str
+    queue_position: Optional[int] = None
+
+class JobStatusResponse(BaseModel):
+    job_id: str
+    status: str
+    queue_position: Optional[int] = None
+    image_path: Optional[str] = None
+    error: Optional[str] = None
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    timings: Dict[str, Optional[float]]
+    request: Dict[str, Any]
+    result: Optional[Dict[str, Any]] = None
 
 print("--- 步驟 13：API 端點 (Endpoint) 準備定義... ---", flush=True)
 
 # 健康檢查端點
 @app.get("/health")
 async def health_check():
-    return {"status": "ok", "timestamp": time.time()}
+    return {
+        "status": "ok",
+        "timestamp": time.time(),
+        "generation_queue": generation_executor.stats(),
+        "micro_batching": micro_batcher.stats() if micro_batcher is not None else None,
+        "postprocess_queue": ImageGenerator.get_postprocessor(config).stats(),
+        "memory": ImageGenerator.get_memory_policy(config).stats(),
+        "profiling": ImageGenerator.get_profiler(config).stats()
+    }
+
+@app.on_event("startup")
+async def start_job_runner():
+    global job_runner
+    job_runner = JobRunner(
+        job_store, generation_executor, _run_job,
+        poll_interval=jobs_config.get('poll_interval', 1.0)
+    )
+    job_runner.start()
+    
+    # 在生成執行緒中預熱提示詞嵌入 (會同時加載基礎管道)，不阻塞啟動
+    prompt_cache_config = config.get('prompt_cache', {}) or {}
+    if prompt_cache_config.get('enabled', True) and prompt_cache_config.get('warmup', False):
+        warmup_weights = prompt_cache_config.get('warmup_weights') or (config.get('weight_name', []) or [])[:1]
+        generation_executor.submit(_warmup_prompt_cache, warmup_weights)
+
+@app.on_event("shutdown")
+async def shutdown_generation_executor():
+    if job_runner is not None:
+        await job_runner.stop()
+    generation_executor.shutdown(wait=False)
+    ImageGenerator.get_postprocessor(config).shutdown(wait=False)
+    if result_cache is not None:
+        result_cache.flush()
 
 # 獲取可用模型端點
 @app.get("/models")
@@ -117,6 +197,52 @@ async def get_models():
     models_config = config.get('models', {}) or {}
     return {"models": list(models_config.keys())}
 
+# 管道快取統計端點
+@app.get("/cache/stats")
+async def get_cache_stats():
+    prompt_cache = ImageGenerator.get_prompt_cache(config)
+    return {
+        "pipeline_cache": model_manager.cache_stats(),
+        "prompt_cache": prompt_cache.stats() if prompt_cache is not None else None,
+        "reference_latent_cache": ImageGenerator.get_latent_cache(config).stats(),
+        "background_removal": ImageGenerator.get_postprocessor(config).stats()["backends"],
+        "onnx_runtime": model_manager.onnx_backend.stats() if model_manager.onnx_backend is not None else None,
+        "lora_registry": model_manager.lora_registry.stats(),
+        "result_cache": result_cache.stats() if result_cache is not None else None
+    }
+
+# 已索引的 LoRA 權重檔 (格式、rank、目標模組、大小)
+@app.get("/loras")
+async def get_loras(rescan: bool = False):
+    if rescan:
+        model_manager.lora_registry.scan()
+    return {"loras": model_manager.lora_registry.list()}
+
+# 可用 scheduler 與步數預設組合端點
+@app.get("/schedulers")
+async def get_schedulers():
+    return model_manager.schedulers.stats()
+
+# Prometheus 指標端點
+@app.get("/metrics")
+async def get_metrics():
+    # 量測值在抓取時更新：記憶體與各佇列深度
+    memory = ImageGenerator.get_memory_policy(config).snapshot()
+    for kind in ("allocated_bytes", "reserved_bytes", "rss_bytes"):
+        metrics.MEMORY_BYTES.set(memory[kind], kind=kind.replace("_bytes", ""))
+    generation_queue = generation_executor.stats()
+    metrics.QUEUE_DEPTH.set(generation_queue["running"], queue="generation", state="running")
+    metrics.QUEUE_DEPTH.set(generation_queue["queued"], queue="generation", state="queued")
+    postprocess_queue = ImageGenerator.get_postprocessor(config).stats()
+    metrics.QUEUE_DEPTH.set(postprocess_queue["running"], queue="postprocess", state="running")
+    metrics.QUEUE_DEPTH.set(postprocess_queue["queued"], queue="postprocess", state="queued")
+    if micro_batcher is not None:
+        metrics.QUEUE_DEPTH.set(micro_batcher.stats()["waiting"], queue="micro_batch", state="waiting")
+    job_counts = job_store.counts()
+    for status, count in job_counts.items():
+        metrics.QUEUE_DEPTH.set(count, queue="jobs", state=status)
+    return PlainTextResponse(metrics.render_latest(), media_type="text/plain; version=0.0.4")
+
 # 獲取可用動作端點
 @app.get("/actions")
 async def get_actions():
@@ -129,78 +255,330 @@ async def get_expressions():
     from src.utils.prompts import _expressions
     return {"expressions": _expressions}
 
+def _request_loras(request: GenerateImageRequest):
+    """請求實際使用的 LoRA 組合 [(weight_name, 強度)]：loras 優先，否則為 weight_name"""
+    return model_manager.normalize_loras(request.loras if request.loras else request.weight_name)
+
+def _validate_loras(request: GenerateImageRequest):
+    """檢查 LoRA 組合：權重檔不可重複、強度必須是有限數值"""
+    loras = _request_loras(request)
+    names = [weight_name for weight_name, _ in loras]
+    if len(names) != len(set(names)):
+        raise HTTPException(status_code=400, detail="loras 中的權重檔不可重複")
+    if any(not math.isfinite(scale) for _, scale in loras):
+        raise HTTPException(status_code=400, detail="LoRA 強度必須是有限數值")
+
+def _resolve_scheduler(request: GenerateImageRequest):
+    """依請求的 scheduler / 預設組合決定實際的 scheduler 與步數，並寫回請求"""
+    try:
+        request.scheduler, request.steps = model_manager.schedulers.resolve(
+            model_manager.model_name, request.steps, request.scheduler, request.preset
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _build_request_config(request: GenerateImageRequest):
+    """根據請求參數建立臨時配置對象"""
+    _validate_loras(request)
+    _resolve_scheduler(request)
+    
+    # 創建自定義配置
+    custom_config = {
+        'prompt_template': request.prompt_template or config.get('prompt_template', ''),
+        'negative_prompt': request.negative_prompt or config.get('negative_prompt', ''),
+        'parameters': {
+            'guidance_scale': request.guidance_scale,
+            'strength': request.strength,
+            'noise_level': request.noise_level
+        },
+        'image_size': {
+            'height': request.height,
+            'width': request.width
+        }
+    }
+    
+    # 如果提供了原始圖像路徑
+    if request.original_image_path:
+        if os.path.exists(request.original_image_path):
+            custom_config['original_image'] = {'path': request.original_image_path}
+        else:
+            raise HTTPException(status_code=404, detail=f"原始圖像不存在: {request.original_image_path}")
+    
+    # 創建臨時配置對象
+    temp_config = Config()
+    temp_config.config = {**config.config, **custom_config}
+    return temp_config
+
+def _run_generation_batch(batch) -> List[Dict[str, Any]]:
+    """
+    在生成執行緒中執行的同步推理流程。
+    batch 為 [(request, temp_config, seed)]，同一批次的請求共用 LoRA、解析度、步數與引導參數，
+    以單次管道調用生成，結果依序對應到每個請求。
+    """
+    first_request, first_config, _ = batch[0]
+    loras = _request_loras(first_request)
+    lora_key = model_manager.lora_key(loras)
+    
+    # 創建輸出目錄
+    output_dir = os.path.join('outputs', lora_key, str(first_request.steps))
+    os.makedirs(output_dir, exist_ok=True)
+    
+    start_time = time.time()
+    # 從有預算上限的快取取得管道 (常駐模式下與 main.py 共用基礎管道，只切換 LoRA adapter 組合)
+    # 持有管道鎖直到去噪結束，其他工作執行緒無法在生成途中改變 adapter 權重
+    with model_manager.pipeline_session(loras, first_request.scheduler) as pipe:
+        items = []
+        for request, temp_config, seed in batch:
+            # 每個請求以自己的配置與動作 / 表情解析出提示詞
+            item_generator = ImageGenerator(temp_config, pipe, lora_key)
+            item_generator.action_key = request.action_key or "standing"
+            item_generator.expression_key = request.expression_key or "smiling"
+            prompt, negative_prompt = item_generator.resolve_prompts()
+            items.append({
+                "prompt": prompt, "negative_prompt": negative_prompt, "seed": seed,
+                "action_key": item_generator.action_key, "expression_key": item_generator.expression_key
+            })
+        
+        # 初始化圖像生成器並生成整批圖像 (有參考圖像時使用共用組件的 img2img 管道)
+        image_generator = ImageGenerator(
+            first_config, pipe, lora_key, model_manager.get_img2img_pipeline(pipe)
+        )
+        image_generator.profile_requested = any(request.profile for request, _, _ in batch)
+        image_generator.scheduler_name = first_request.scheduler
+        # 只等待去噪與 VAE 解碼，去背與儲存由後處理程序完成
+        postprocess_futures = image_generator.generate_batch_async(first_request.steps, output_dir, items)
+    
+    # 返回結果 (image_path 在後處理完成後由 _await_postprocess / _wait_postprocess 填入)
+    return [
+        {
+            "_postprocess": postprocess_future,
+            "profile": image_generator.last_profile,
+            "_started": start_time,
+            "parameters": _response_parameters(request, loras, seed, len(batch))
+        }
+        for (request, _, seed), postprocess_future in zip(batch, postprocess_futures)
+    ]
+
+def _response_parameters(request: GenerateImageRequest, loras, seed: int, batch_size: int) -> Dict[str, Any]:
+    """響應中回報的生成參數"""
+    return {
+        "weight_name": request.weight_name,
+        "loras": [list(item) for item in loras],
+        "steps": request.steps,
+        "scheduler": request.scheduler,
+        "action_key": request.action_key,
+        "expression_key": request.expression_key,
+        "guidance_scale": request.guidance_scale,
+        "strength": request.strength,
+        "noise_level": request.noise_level,
+        "height": request.height,
+        "width": request.width,
+        "seed": seed,
+        "batch_size": batch_size
+    }
+
+def _result_cache_key(request: GenerateImageRequest, temp_config) -> Optional[str]:
+    """
+    以所有影響輸出的參數計算結果快取鍵；未指定種子 (每次結果不同)、要求剖析 (必須實際執行)
+    或基礎模型尚未加載 (權重指紋未知) 時返回 None。
+    模型以實際權重的取樣雜湊識別，並包含裝置、CPU bf16 / 編譯、ONNX Runtime 量化與融合強度等執行設定；
+    LoRA 以權重檔的大小與修改時間識別、參考圖像以檔案內容雜湊識別，檔案改變後不會命中舊結果；
+    參考圖像與提示詞依 ImageGenerator 相同的方式解析 (請求未指定時使用設定檔預設的參考圖像與提示詞範本)，
+    去背與裁切設定也會改變輸出，一併計入。
+    """
+    if result_cache is None or request.seed is None or request.profile:
+        return None
+    execution = model_manager.output_fingerprint()
+    if execution is None:
+        return None
+    from src.utils.prompts import build_character_prompt
+    loras = []
+    for weight_name, scale in _request_loras(request):
+        info = model_manager.lora_registry.info(weight_name)
+        loras.append([weight_name, scale, info["size_bytes"] if info else None, info["mtime_ns"] if info else None])
+    original_image_hash = None
+    prompt = temp_config.get('prompt_template', '')
+    original_image_path = ImageGenerator.reference_image_path(temp_config)
+    if original_image_path:
+        original_image_hash = ImageGenerator.get_latent_cache(config).file_hash(original_image_path)
+    else:
+        prompt = build_character_prompt(request.action_key or "standing", request.expression_key or "smiling")
+    postprocess_config = config.get('postprocess', {}) or {}
+    return canonical_key({
+        "model": model_manager.model_name,
+        "execution": execution,
+        "loras": loras,
+        "prompt": prompt,
+        "negative_prompt": temp_config.get('negative_prompt', ''),
+        "original_image": original_image_hash,
+        "steps": request.steps,
+        "scheduler": request.scheduler,
+        "height": request.height,
+        "width": request.width,
+        "guidance_scale": request.guidance_scale,
+        "strength": request.strength,
+        "noise_level": request.noise_level,
+        "seed": request.seed,
+        "background_removal": config.get('background_removal', {}),
+        "crop_alpha": postprocess_config.get('crop_alpha', False),
+        "crop_padding": postprocess_config.get('crop_padding', 0),
+    })
+
+def _cached_result(request: GenerateImageRequest, cache_key: Optional[str]) -> Optional[Dict[str, Any]]:
+    """結果快取命中時返回完整的響應內容，否則返回 None"""
+    if cache_key is None:
+        return None
+    start_time = time.time()
+    image_path = result_cache.get(cache_key)
+    if image_path is None:
+        return None
+    generation_time = time.time() - start_time
+    metrics.observe_stage("request_total", generation_time)
+    return {
+        "image_path": image_path,
+        "generation_time": generation_time,
+        "parameters": _response_parameters(request, _request_loras(request), request.seed, 1),
+        "stage_timings": {"result_cache": generation_time},
+        "profile": None,
+        "cached": True
+    }
+
+async def _await_postprocess(result: Dict[str, Any]) -> Dict[str, Any]:
+    """在事件循環中等待後處理完成，生成執行緒此時已可處理下一個請求"""
+    result = dict(result)
+    postprocess_future = result.pop("_postprocess")
+    result["image_path"] = await asyncio.wrap_future(postprocess_future)
+    return _finish_result(result, postprocess_future)
+
+def _wait_postprocess(result: Dict[str, Any]) -> Dict[str, Any]:
+    """同步等待後處理完成 (用於任務執行)"""
+    result = dict(result)
+    postprocess_future = result.pop("_postprocess")
+    result["image_path"] = postprocess_future.result()
+    return _finish_result(result, postprocess_future)
+
+def _finish_result(result: Dict[str, Any], postprocess_future) -> Dict[str, Any]:
+    """填入總耗時與各階段耗時 (排隊、LoRA 加載、文字編碼、去噪、解碼、去背、儲存)"""
+    result["generation_time"] = time.time() - result.pop("_started")
+    stage_timings = getattr(postprocess_future, "stage_timings", None)
+    result["stage_timings"] = stage_timings.as_dict() if stage_timings is not None else {}
+    metrics.observe_stage("request_total", result["generation_time"])
+    return result
+
+def _run_generation(request: GenerateImageRequest, temp_config, seed: int) -> Dict[str, Any]:
+    """單一請求的同步推理流程"""
+    return _run_generation_batch([(request, temp_config, seed)])[0]
+
+def _batch_key(request: GenerateImageRequest):
+    """只有這些參數都相同的請求才能合併到同一次管道調用"""
+    return (
+        tuple(_request_loras(request)), request.height, request.width, request.steps, request.scheduler,
+        request.guidance_scale, request.strength, request.original_image_path, request.profile
+    )
+
+def _random_seed() -> int:
+    """未指定種子時的預設值：取自隨機來源，同一秒內提交的請求也不會得到相同的種子"""
+    return secrets.randbelow(2**32)
+
+# 動態批次：短窗口內可合併的 /generate 請求以單次去噪完成
+micro_batcher = MicroBatcher.from_config(config, generation_executor, _run_generation_batch)
+
 # 生成圖像端點
 @app.post("/generate", response_model=GenerateImageResponse)
 async def generate_image(request: GenerateImageRequest):
     try:
-        # 獲取或加載模型
-        if request.weight_name not in loaded_models:
-            pipe = model_manager.load_model(request.weight_name)
-            loaded_models[request.weight_name] = pipe
+        temp_config = _build_request_config(request)
+        # 計算快取鍵會雜湊參考圖像檔案，與查詢一起在執行緒中進行，不阻塞事件循環
+        cache_key = await asyncio.to_thread(_result_cache_key, request, temp_config)
+        cached = await asyncio.to_thread(_cached_result, request, cache_key)
+        if cached is not None:
+            metrics.REQUESTS.inc(endpoint="generate", status="ok")
+            return cached
+        # 每個未指定種子的請求各自取得隨機種子，合併到同一批次時各張圖像的 Generator 也不同
+        seed = request.seed if request.seed is not None else _random_seed()
+        # 推理交給生成執行緒，事件循環保持空閒以回應 /health 等輕量端點
+        if micro_batcher is not None:
+            result = await micro_batcher.submit(_batch_key(request), (request, temp_config, seed))
         else:
-            pipe = loaded_models[request.weight_name]
-        
-        # 創建自定義配置
-        custom_config = {
-            'prompt_template': request.prompt_template or config.get('prompt_template', ''),
-            'negative_prompt': request.negative_prompt or config.get('negative_prompt', ''),
-            'parameters': {
-                'guidance_scale': request.guidance_scale,
-                'strength': request.strength,
-                'noise_level': request.noise_level
-            },
-            'image_size': {
-                'height': request.height,
-                'width': request.width
-            }
-        }
-        
-        # 如果提供了原始圖像路徑
-        if request.original_image_path:
-            if os.path.exists(request.original_image_path):
-                custom_config['original_image'] = {'path': request.original_image_path}
-            else:
-                raise HTTPException(status_code=404, detail=f"原始圖像不存在: {request.original_image_path}")
-        
-        # 創建臨時配置對象
-        temp_config = Config()
-        temp_config.config = {**config.config, **custom_config}
-        
-        # 初始化圖像生成器
-        image_generator = ImageGenerator(temp_config, pipe, request.weight_name)
-        
-        # 設置動作和表情
-        image_generator.action_key = request.action_key or "standing"
-        image_generator.expression_key = request.expression_key or "smiling"
-        
-        # 創建輸出目錄
-        output_dir = os.path.join('outputs', f"{request.weight_name}", str(request.steps))
-        os.makedirs(output_dir, exist_ok=True)
-        
-        # 生成圖像
-        start_time = time.time()
-        image_path = image_generator.generate_single_image_api(request.steps, output_dir)
-        generation_time = time.time() - start_time
-        
-        # 返回結果
-        return {
-            "image_path": image_path,
-            "generation_time": generation_time,
-            "parameters": {
-                "weight_name": request.weight_name,
-                "steps": request.steps,
-                "action_key": request.action_key,
-                "expression_key": request.expression_key,
-                "guidance_scale": request.guidance_scale,
-                "strength": request.strength,
-                "noise_level": request.noise_level,
-                "height": request.height,
-                "width": request.width
-            }
-        }
+            result = await generation_executor.run(_run_generation, request, temp_config, seed)
+        result = await _await_postprocess(result)
+        if cache_key is not None and result.get("image_path"):
+            await asyncio.to_thread(result_cache.put, cache_key, result["image_path"])
+        metrics.REQUESTS.inc(endpoint="generate", status="ok")
+        return result
+    except QueueFullError as e:
+        metrics.REQUESTS.inc(endpoint="generate", status="rejected")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    except HTTPException as e:
+        metrics.REQUESTS.inc(endpoint="generate", status=str(e.status_code))
+        raise
     except Exception as e:
+        metrics.REQUESTS.inc(endpoint="generate", status="error")
         raise HTTPException(status_code=500, detail=str(e))
 
+def _run_job(request_data: Dict[str, Any]) -> Dict[str, Any]:
+    """在生成執行緒中執行已保存的任務"""
+    request = GenerateImageRequest(**request_data)
+    temp_config = _build_request_config(request)
+    return _wait_postprocess(_run_generation(request, temp_config, request.seed))
+
+def _warmup_prompt_cache(weight_names):
+    """為指定 LoRA 預先計算所有動作 × 表情組合的提示詞嵌入"""
+    for weight_name in weight_names:
+        try:
+            with model_manager.pipeline_session(weight_name) as pipe:
+                ImageGenerator(config, pipe, weight_name).warmup_prompt_cache()
+        except Exception as e:
+            print(f"⚠️ 提示詞嵌入預熱失敗 ({weight_name}): {e}", file=sys.stderr, flush=True)
+
+job_runner = None
+
+# 提交非同步任務端點
+@app.post("/jobs", response_model=JobSubmitResponse, status_code=202)
+async def submit_job(request: GenerateImageRequest):
+    # 提交時就檢查原始圖像，避免任務排隊後才失敗
+    _build_request_config(request)
+    # 固定種子，讓任務重啟後重新執行時結果一致
+    if request.seed is None:
+        request.seed = _random_seed()
+    job_id = job_store.create(request.model_dump())
+    if job_runner is not None:
+        job_runner.notify()
+    job = job_store.get(job_id)
+    return {"job_id": job_id, "status": job["status"], "queue_position": job["queue_position"]}
+
+# 列出任務端點
+@app.get("/jobs")
+async def list_jobs(status: Optional[str] = None, limit: int = 50):
+    return {"jobs": job_store.list(status=status, limit=min(max(limit, 1), 500)), "counts": job_store.counts()}
+
+# 查詢任務狀態端點
+@app.get("/jobs/{job_id}", response_model=JobStatusResponse)
+async def get_job(job_id: str):
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任務不存在")
+    return job
+
+# 圖庫端點：從輸出清單 (SQLite) 查詢，依 id 游標分頁，不走訪 outputs/ 目錄
+@app.get("/gallery")
+async def get_gallery(
+    weight_name: Optional[str] = None,
+    seed: Optional[int] = None,
+    steps: Optional[int] = None,
+    action_key: Optional[str] = None,
+    expression_key: Optional[str] = None,
+    cursor: Optional[int] = None,
+    limit: int = 50
+):
+    manifest = ImageGenerator.get_manifest(config)
+    if manifest is None:
+        raise HTTPException(status_code=404, detail="輸出清單未啟用")
+    return manifest.query(
+        cursor=cursor, limit=min(max(limit, 1), 500),
+        weight_name=weight_name, seed=seed, steps=steps, action_key=action_key, expression_key=expression_key
+    )
+
 # 獲取生成的圖像端點
 @app.get("/image/{image_path:path}")
 async def get_image(image_path: str):
@@ -0,0 +1,125 @@
+"""
+生成執行器模塊
+將推理工作移出 asyncio 事件循環，交由專用的工作執行緒處理
+"""
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from src.core import metrics
+
+print("--- [GenerationExecutor] 模塊開始被導入... ---", flush=True)
+
+
+class QueueFullError(Exception):
+    """生成佇列已滿，應立即以 503 回應"""
+    pass
+
+
+class GenerationExecutor:
+    """
+    生成執行器。
+    以固定數量的工作執行緒執行推理，並以有上限的佇列保護伺服器：
+    排隊中 + 執行中的工作超過 workers + max_queue 時立即拋出 QueueFullError。
+    """
+    def __init__(self, workers=1, max_queue=8):
+        self.workers = max(1, int(workers))
+        self.max_queue = max(0, int(max_queue))
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="generation")
+        self._lock = threading.Lock()
+        self._pending = 0   # 已接受但尚未完成的工作 (排隊中 + 執行中)
+        self._running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """從設定檔的 generation_executor 區塊建立執行器"""
+        executor_config = config.get('generation_executor', {}) or {}
+        return cls(
+            workers=executor_config.get('workers', 1),
+            max_queue=executor_config.get('max_queue', 8)
+        )
+
+    @property
+    def capacity(self):
+        return self.workers + self.max_queue
+
+    def check_capacity(self):
+        """只檢查佇列是否已滿 (不預留位置)，已滿時拋出 QueueFullError"""
+        with self._lock:
+            if self._pending >= self.capacity:
+                self.rejected += 1
+                raise QueueFullError(f"生成佇列已滿 ({self._pending}/{self.capacity})，請稍後再試")
+
+    def try_reserve(self):
+        """預留一個佇列位置，佇列已滿時拋出 QueueFullError"""
+        with self._lock:
+            if self._pending >= self.capacity:
+                self.rejected += 1
+                raise QueueFullError(f"生成佇列已滿 ({self._pending}/{self.capacity})，請稍後再試")
+            self._pending += 1
+
+    def release(self):
+        with self._lock:
+            self._pending = max(0, self._pending - 1)
+
+    def _run_in_worker(self, fn, args, kwargs, submitted_at):
+        with self._lock:
+            self._running += 1
+        try:
+            # 每個工作各自收集分階段耗時，fn 內可用 metrics.current_timings() 取得
+            with metrics.collect_timings():
+                metrics.record_stage("queue_wait", time.perf_counter() - submitted_at)
+                result = fn(*args, **kwargs)
+            with self._lock:
+                self.completed += 1
+            return result
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def submit(self, fn, *args, reserved=False, **kwargs):
+        """
+        提交同步工作並返回 concurrent.futures.Future。
+        reserved=True 表示調用者已先以 try_reserve 預留位置。
+        """
+        if not reserved:
+            self.try_reserve()
+        try:
+            future = self._executor.submit(self._run_in_worker, fn, args, kwargs, time.perf_counter())
+        except Exception:
+            self.release()
+            raise
+        future.add_done_callback(lambda _: self.release())
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        """在工作執行緒中執行 fn 並等待結果，不阻塞事件循環"""
+        future = self.submit(fn, *args, **kwargs)
+        return await asyncio.wrap_future(future)
+
+    def stats(self):
+        """返回佇列深度與完成統計"""
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "queued": max(0, self._pending - self._running),
+                "pending": self._pending,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+            }
+
+    def shutdown(self, wait=False):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+print("--- [GenerationExecutor] 模塊已成功被定義。---", flush=True)
@@ -0,0 +1,264 @@
+"""
+非同步任務模塊
+以本地 SQLite 檔案保存生成任務，並在背景依序派發給生成執行器
+"""
+import os
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+import threading
+
+print("--- [JobStore] 模塊開始被導入... ---", flush=True)
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+
+class JobStore:
+    """任務儲存，所有狀態都寫入 SQLite，排隊中的任務在重啟後仍會保留"""
+    def __init__(self, db_path="outputs/jobs.sqlite3"):
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id TEXT NOT NULL UNIQUE,
+                    status TEXT NOT NULL,
+                    request_json TEXT NOT NULL,
+                    result_json TEXT,
+                    image_path TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_seq ON jobs (status, seq)")
+
+    def create(self, request_data):
+        """新增排隊中的任務並返回任務 id"""
+        job_id = uuid.uuid4().hex
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, request_json, created_at) VALUES (?, ?, ?, ?)",
+                (job_id, JOB_QUEUED, json.dumps(request_data, ensure_ascii=False), time.time())
+            )
+        return job_id
+
+    def get(self, job_id):
+        """取得任務資訊 (含排隊位置與各階段耗時)，不存在時返回 None"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            queue_position = None
+            if row["status"] == JOB_QUEUED:
+                queue_position = self._conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = ? AND seq < ?",
+                    (JOB_QUEUED, row["seq"])
+                ).fetchone()[0]
+        return self._row_to_job(row, queue_position)
+
+    def list(self, status=None, limit=50):
+        """依建立順序列出最近的任務"""
+        with self._lock:
+            if status:
+                rows = self._conn.execute(
+                    "SELECT * FROM jobs WHERE status = ? ORDER BY seq DESC LIMIT ?", (status, limit)
+                ).fetchall()
+            else:
+                rows = self._conn.execute("SELECT * FROM jobs ORDER BY seq DESC LIMIT ?", (limit,)).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def claim_next(self):
+        """取出最早排隊的任務並標記為執行中，沒有任務時返回 None"""
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY seq LIMIT 1", (JOB_QUEUED,)
+            ).fetchone()
+            if row is None:
+                return None
+            started_at = time.time()
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, started_at = ? WHERE seq = ?",
+                (JOB_RUNNING, started_at, row["seq"])
+            )
+        job = self._row_to_job(row)
+        job["status"] = JOB_RUNNING
+        job["started_at"] = started_at
+        return job
+
+    def mark_succeeded(self, job_id, result):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, result_json = ?, image_path = ?, finished_at = ? WHERE id = ?",
+                (JOB_SUCCEEDED, json.dumps(result, ensure_ascii=False, default=str),
+                 result.get("image_path"), time.time(), job_id)
+            )
+
+    def mark_failed(self, job_id, error):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                (JOB_FAILED, str(error), time.time(), job_id)
+            )
+
+    def requeue(self, job_id):
+        """將單一執行中的任務放回佇列 (例如關閉時執行器取消了尚未開始的任務)"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, started_at = NULL WHERE id = ? AND status = ?",
+                (JOB_QUEUED, job_id, JOB_RUNNING)
+            )
+
+    def requeue_running(self):
+        """將上次關閉時仍在執行的任務放回佇列 (用於重啟後恢復)"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, started_at = NULL WHERE status = ?", (JOB_QUEUED, JOB_RUNNING)
+            )
+            return cursor.rowcount
+
+    def counts(self):
+        """各狀態的任務數量"""
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def _row_to_job(row, queue_position=None):
+        result = json.loads(row["result_json"]) if row["result_json"] else None
+        created_at, started_at, finished_at = row["created_at"], row["started_at"], row["finished_at"]
+        timings = {
+            "queue_wait": (started_at - created_at) if started_at else None,
+            "run": (finished_at - started_at) if started_at and finished_at else None,
+            "total": (finished_at - created_at) if finished_at else None,
+        }
+        if result and result.get("generation_time") is not None:
+            timings["generation"] = result["generation_time"]
+        return {
+            "job_id": row["id"],
+            "status": row["status"],
+            "queue_position": queue_position,
+            "request": json.loads(row["request_json"]),
+            "result": result,
+            "image_path": row["image_path"],
+            "error": row["error"],
+            "created_at": created_at,
+            "started_at": started_at,
+            "finished_at": finished_at,
+            "timings": timings,
+        }
+
+
+class JobRunner:
+    """
+    背景派發器。
+    只在生成執行器有空閒工作執行緒時才從 SQLite 取出任務，
+    因此排隊中的任務留在資料庫中，不佔用記憶體中的執行器佇列。
+    """
+    def __init__(self, store, executor, handler, poll_interval=1.0):
+        self.store = store
+        self.executor = executor
+        self.handler = handler  # 同步函數：handler(request_data) -> result dict
+        self.poll_interval = poll_interval
+        self._wakeup = None
+        self._task = None
+
+    def start(self):
+        recovered = self.store.requeue_running()
+        if recovered:
+            print(f"--- [JobRunner] 恢復 {recovered} 個中斷的任務 ---", flush=True)
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def notify(self):
+        """有新任務時喚醒派發迴圈"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def _has_idle_worker(self):
+        stats = self.executor.stats()
+        return stats["pending"] < stats["workers"]
+
+    async def _run(self):
+        while True:
+            dispatched = False
+            while self._has_idle_worker():
+                try:
+                    self.executor.try_reserve()
+                except Exception:
+                    break
+                job = self.store.claim_next()
+                if job is None:
+                    self.executor.release()
+                    break
+                self._dispatch(job)
+                dispatched = True
+            if not dispatched:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await asyncio.sleep(0)
+
+    def _dispatch(self, job):
+        job_id = job["job_id"]
+        print(f"--- [JobRunner] 派發任務 {job_id} ---", flush=True)
+        try:
+            future = self.executor.submit(self.handler, job["request"], reserved=True)
+        except Exception as e:
+            self.store.mark_failed(job_id, e)
+            return
+
+        def _on_done(fut):
+            # 關閉時執行器以 cancel_futures 取消尚未開始的任務：放回佇列，重啟後繼續執行
+            # (被取消的 Future 調用 exception() 會拋出 CancelledError，必須先檢查)
+            if fut.cancelled():
+                print(f"--- [JobRunner] 任務 {job_id} 尚未開始即被取消，放回佇列 ---", flush=True)
+                self.store.requeue(job_id)
+                return
+            error = fut.exception()
+            if error is not None:
+                print(f"⚠️ [JobRunner] 任務 {job_id} 失敗: {error}", flush=True)
+                self.store.mark_failed(job_id, getattr(error, "detail", error))
+            else:
+                self.store.mark_succeeded(job_id, fut.result())
+                print(f"✅ [JobRunner] 任務 {job_id} 完成", flush=True)
+            self.notify_threadsafe()
+
+        future.add_done_callback(_on_done)
+
+    def notify_threadsafe(self):
+        """從工作執行緒喚醒派發迴圈"""
+        if self._task is not None and self._wakeup is not None:
+            self._task.get_loop().call_soon_threadsafe(self._wakeup.set)
+
+print("--- [JobStore] 模塊已成功被定義。---", flush=True)
@@ -0,0 +1,381 @@
+"""
+API 負載測試腳本
+以可設定的並發數、階段式加壓與請求組合 (動作 × 表情 × LoRA) 驅動 /generate、/jobs 與 /image，
+輸出吞吐量、p50/p95/p99 延遲、錯誤率與 503 比例，以及每秒的時間序列
+
+用法:
+    # 對已啟動的 API
+    PYTHONPATH=$(pwd) python src/render/load_test.py --url http://localhost:10000 --ramp 1,2,4
+    # 在同一行程內以假管道啟動 API (不需要模型權重)
+    PYTHONPATH=$(pwd) python src/render/load_test.py --in-process --model StubPipelineModel --ramp 1,4,8,16
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+REQUEST_KINDS = ("generate", "jobs", "image")
+TERMINAL_JOB_STATES = ("succeeded", "failed")
+
+def _int_list(value):
+    return [int(item) for item in value.split(",") if item.strip()]
+
+def _parse_mix(value):
+    """解析請求組合，例如 generate=0.7,jobs=0.2,image=0.1"""
+    mix = {}
+    for part in value.split(","):
+        if not part.strip():
+            continue
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in REQUEST_KINDS:
+            raise argparse.ArgumentTypeError(f"未知的請求類型: {kind}")
+        mix[kind] = float(weight or 1.0)
+    if not mix or sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError("請求組合不可為空")
+    return mix
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="蘑菇角色生成 API 負載測試")
+    parser.add_argument("--url", default="http://localhost:10000", help="API 位址")
+    parser.add_argument("--in-process", action="store_true", help="在本行程內啟動 API (搭配 --model 使用假管道)")
+    parser.add_argument("--model", default="StubPipelineModel", help="--in-process 時使用的模型 (StubPipelineModel / TinyRandomSdModel)")
+    parser.add_argument("--port", type=int, default=10099, help="--in-process 時的埠號")
+    parser.add_argument("--ramp", type=_int_list, default=[1, 2, 4], help="各階段的並發數，例如 1,2,4,8")
+    parser.add_argument("--stage-seconds", type=float, default=20.0, help="每個階段的持續秒數")
+    parser.add_argument("--mix", type=_parse_mix, default={"generate": 0.7, "jobs": 0.2, "image": 0.1},
+                        help="請求組合權重，例如 generate=0.7,jobs=0.2,image=0.1")
+    parser.add_argument("--weights", default=None, help="LoRA 權重列表 (逗號分隔，預設取設定檔的 weight_name)")
+    parser.add_argument("--steps", type=int, default=4, help="每次生成的步數")
+    parser.add_argument("--size", type=int, default=256, help="生成圖像的邊長")
+    parser.add_argument("--timeout", type=float, default=300.0, help="單一請求 (含任務輪詢) 的逾時秒數")
+    parser.add_argument("--job-poll-interval", type=float, default=0.25, help="任務輪詢間隔")
+    parser.add_argument("--seed", type=int, default=0, help="請求組合的隨機種子")
+    parser.add_argument("--output", default=None, help="結果 JSON 路徑 (預設 outputs/load_tests/)")
+    return parser.parse_args()
+
+
+class HttpClient:
+    """優先使用 httpx.AsyncClient，未安裝時以 requests 在執行緒池中發送"""
+    def __init__(self, base_url, timeout, max_connections):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        try:
+            import httpx
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url, timeout=timeout,
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+            )
+            self._session = None
+            self.backend = "httpx"
+        except ImportError:
+            import requests
+            self._client = None
+            self._session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+            self._session.mount("http://", adapter)
+            self._session.mount("https://", adapter)
+            self._executor = ThreadPoolExecutor(max_workers=max_connections)
+            self.backend = "requests"
+
+    async def request(self, method, path, json_body=None):
+        """返回 (狀態碼, JSON 內容或 None, 內容位元組數)"""
+        if self._client is not None:
+            response = await self._client.request(method, path, json=json_body)
+            content = response.content
+            status = response.status_code
+            content_type = response.headers.get("content-type", "")
+        else:
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(
+                self._executor,
+                lambda: self._session.request(method, f"{self.base_url}{path}", json=json_body, timeout=self.timeout)
+            )
+            content = response.content
+            status = response.status_code
+            content_type = response.headers.get("content-type", "")
+        data = None
+        if "application/json" in content_type:
+            try:
+                data = json.loads(content)
+            except ValueError:
+                pass
+        return status, data, len(content)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+        else:
+            self._session.close()
+            self._executor.shutdown(wait=False)
+
+
+class LoadTester:
+    """以階段式並發驅動 API 並記錄每個請求的結果"""
+    def __init__(self, client, args, actions, expressions, weights):
+        self.client = client
+        self.args = args
+        self.actions = actions
+        self.expressions = expressions
+        self.weights = weights
+        self.random = random.Random(args.seed)
+        self.samples = []  # 每個請求一筆
+        self.image_paths = []
+        self.started_at = None
+
+    def _payload(self):
+        return {
+            "weight_name": self.random.choice(self.weights),
+            "action_key": self.random.choice(self.actions),
+            "expression_key": self.random.choice(self.expressions),
+            "steps": self.args.steps,
+            "height": self.args.size,
+            "width": self.args.size,
+            "seed": self.random.randint(0, 2 ** 31 - 1),
+        }
+
+    def _pick_kind(self):
+        kinds = list(self.args.mix)
+        kind = self.random.choices(kinds, weights=[self.args.mix[k] for k in kinds])[0]
+        if kind == "image" and not self.image_paths:
+            # 還沒有可讀取的圖像時先生成
+            return "generate"
+        return kind
+
+    async def _generate(self):
+        status, data, _ = await self.client.request("POST", "/generate", self._payload())
+        if status == 200 and data:
+            self.image_paths.append(data["image_path"])
+            return status, {"stage_timings": data.get("stage_timings", {})}
+        return status, {}
+
+    async def _job(self):
+        status, data, _ = await self.client.request("POST", "/jobs", self._payload())
+        if status != 202 or not data:
+            return status, {}
+        job_id = data["job_id"]
+        polls = 0
+        deadline = time.monotonic() + self.args.timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.args.job_poll_interval)
+            polls += 1
+            poll_status, job, _ = await self.client.request("GET", f"/jobs/{job_id}")
+            if poll_status != 200 or not job:
+                return poll_status, {"polls": polls}
+            if job["status"] in TERMINAL_JOB_STATES:
+                if job["status"] == "succeeded" and job.get("image_path"):
+                    self.image_paths.append(job["image_path"])
+                return (200 if job["status"] == "succeeded" else 500), {"polls": polls, "timings": job.get("timings")}
+        raise asyncio.TimeoutError(f"任務 {job_id} 逾時")
+
+    async def _image(self):
+        path = self.random.choice(self.image_paths)
+        status, _, size = await self.client.request("GET", f"/image/{path}")
+        return status, {"bytes": size}
+
+    async def _one_request(self, concurrency):
+        kind = self._pick_kind()
+        start = time.monotonic()
+        error = None
+        extra = {}
+        try:
+            handler = {"generate": self._generate, "jobs": self._job, "image": self._image}[kind]
+            status, extra = await asyncio.wait_for(handler(), timeout=self.args.timeout)
+        except Exception as e:
+            status, error = None, f"{type(e).__name__}: {e}"
+        end = time.monotonic()
+        self.samples.append({
+            "kind": kind,
+            "concurrency": concurrency,
+            "start": start - self.started_at,
+            "end": end - self.started_at,
+            "latency": end - start,
+            "status": status,
+            "error": error,
+            **extra,
+        })
+
+    async def _worker(self, concurrency, stop_at):
+        while time.monotonic() < stop_at:
+            await self._one_request(concurrency)
+
+    async def run(self):
+        """依 ramp 逐階段加壓，每個階段以固定數量的工作者持續發送請求"""
+        self.started_at = time.monotonic()
+        for concurrency in self.args.ramp:
+            stop_at = time.monotonic() + self.args.stage_seconds
+            print(f"--- [LoadTest] 階段：並發 {concurrency}，持續 {self.args.stage_seconds:.0f} 秒 ---", flush=True)
+            await asyncio.gather(*(self._worker(concurrency, stop_at) for _ in range(concurrency)))
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+def summarize(samples, duration=None):
+    """彙總一組請求：吞吐量、延遲百分位、錯誤率與 503 比例"""
+    if not samples:
+        return {"requests": 0}
+    if duration is None:
+        duration = max(s["end"] for s in samples) - min(s["start"] for s in samples)
+    ok = [s for s in samples if s["status"] is not None and 200 <= s["status"] < 300]
+    rejected = [s for s in samples if s["status"] == 503]
+    latencies = [s["latency"] for s in ok]
+    return {
+        "requests": len(samples),
+        "succeeded": len(ok),
+        "throughput_rps": len(ok) / duration if duration > 0 else None,
+        "p50_seconds": _percentile(latencies, 0.50),
+        "p95_seconds": _percentile(latencies, 0.95),
+        "p99_seconds": _percentile(latencies, 0.99),
+        "mean_seconds": sum(latencies) / len(latencies) if latencies else None,
+        "error_rate": (len(samples) - len(ok)) / len(samples),
+        "rate_503": len(rejected) / len(samples),
+    }
+
+def time_series(samples, bucket_seconds=1.0):
+    """依完成時間分桶的每秒統計"""
+    buckets = {}
+    for sample in samples:
+        index = int(sample["end"] // bucket_seconds)
+        bucket = buckets.setdefault(index, {"completed": 0, "errors": 0, "rejected": 0, "latencies": [], "concurrency": 0})
+        bucket["completed"] += 1
+        bucket["concurrency"] = max(bucket["concurrency"], sample["concurrency"])
+        if sample["status"] == 503:
+            bucket["rejected"] += 1
+        elif sample["status"] is None or not 200 <= sample["status"] < 300:
+            bucket["errors"] += 1
+        else:
+            bucket["latencies"].append(sample["latency"])
+    series = []
+    for index in sorted(buckets):
+        bucket = buckets.pop(index)
+        latencies = bucket.pop("latencies")
+        series.append({
+            "t": index * bucket_seconds,
+            **bucket,
+            "mean_latency": sum(latencies) / len(latencies) if latencies else None,
+            "p95_latency": _percentile(latencies, 0.95),
+        })
+    return series
+
+def build_report(tester, args, client_backend, server_stats):
+    samples = tester.samples
+    return {
+        "settings": {
+            "url": args.url, "in_process": args.in_process, "model": args.model if args.in_process else None,
+            "ramp": args.ramp, "stage_seconds": args.stage_seconds, "mix": args.mix,
+            "steps": args.steps, "size": args.size, "client": client_backend,
+        },
+        "overall": summarize(samples),
+        "by_kind": {kind: summarize([s for s in samples if s["kind"] == kind]) for kind in REQUEST_KINDS},
+        "by_concurrency": {
+            str(concurrency): summarize([s for s in samples if s["concurrency"] == concurrency])
+            for concurrency in args.ramp
+        },
+        "time_series": time_series(samples),
+        "errors": sorted({s["error"] for s in samples if s["error"]})[:20],
+        "server": server_stats,
+    }
+
+def print_report(report):
+    print("\n========== 負載測試結果 ==========")
+    header = f"{'分組':<16}{'請求':>8}{'成功':>8}{'RPS':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'錯誤率':>9}{'503':>8}"
+    print(header)
+    rows = [("overall", report["overall"])]
+    rows += [(f"kind={k}", v) for k, v in report["by_kind"].items()]
+    rows += [(f"concurrency={k}", v) for k, v in report["by_concurrency"].items()]
+    for name, summary in rows:
+        if not summary.get("requests"):
+            continue
+        fmt = lambda value: f"{value:.3f}" if value is not None else "-"
+        print(
+            f"{name:<16}{summary['requests']:>8}{summary['succeeded']:>8}{fmt(summary['throughput_rps']):>8}"
+            f"{fmt(summary['p50_seconds']):>9}{fmt(summary['p95_seconds']):>9}{fmt(summary['p99_seconds']):>9}"
+            f"{summary['error_rate']:>9.1%}{summary['rate_503']:>8.1%}"
+        )
+    for error in report["errors"]:
+        print(f"⚠️ {error}")
+
+
+def start_in_process_server(model, port):
+    """在背景執行緒中以 uvicorn 啟動 API，模型以 MUSHROOM_MODEL 覆寫 (不需要權重)"""
+    os.environ["MUSHROOM_MODEL"] = model
+    os.environ.setdefault("FORCE_CPU", "true")
+    # 假管道的輸出不寫入正式的輸出清單
+    os.environ.setdefault("MUSHROOM_MANIFEST", "false")
+    import uvicorn
+    from src.render.api import app
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, name="load-test-server", daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 120
+    while not server.started:
+        if time.monotonic() > deadline or not thread.is_alive():
+            raise RuntimeError("API 伺服器啟動失敗")
+        time.sleep(0.1)
+    return server, thread
+
+async def _fetch_workload(client, weights):
+    """從 API 取得動作與表情列表"""
+    _, actions, _ = await client.request("GET", "/actions")
+    _, expressions, _ = await client.request("GET", "/expressions")
+    action_keys = list((actions or {}).get("actions", {}).keys()) or ["standing"]
+    expression_keys = list((expressions or {}).get("expressions", {}).keys()) or ["smiling"]
+    if not weights:
+        from src.core.config_manager import Config
+        config = Config()
+        weights = config.get('weight_name', []) or ((config.get('lora_weights', {}) or {}).get('sd15') or ["benchmark"])
+    return action_keys, expression_keys, weights
+
+async def run_load_test(args):
+    max_concurrency = max(args.ramp)
+    client = HttpClient(args.url, args.timeout, max_connections=max_concurrency * 2 + 4)
+    try:
+        status, _, _ = await client.request("GET", "/health")
+        if status != 200:
+            raise RuntimeError(f"健康檢查失敗: {status}")
+        weights = [w.strip() for w in args.weights.split(",")] if args.weights else None
+        actions, expressions, weights = await _fetch_workload(client, weights)
+        print(f"--- [LoadTest] 使用 {client.backend}，動作 {len(actions)} × 表情 {len(expressions)} × LoRA {len(weights)} ---", flush=True)
+
+        tester = LoadTester(client, args, actions, expressions, weights)
+        await tester.run()
+
+        _, health, _ = await client.request("GET", "/health")
+        return build_report(tester, args, client.backend, health)
+    finally:
+        await client.close()
+
+def main():
+    args = parse_args()
+    server = None
+    if args.in_process:
+        server, thread = start_in_process_server(args.model, args.port)
+        args.url = f"http://127.0.0.1:{args.port}"
+    try:
+        report = asyncio.run(run_load_test(args))
+    finally:
+        if server is not None:
+            server.should_exit = True
+            thread.join(timeout=30)
+
+    print_report(report)
+    output_path = args.output or os.path.join("outputs", "load_tests", f"load_test_{int(time.time())}.json")
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"✅ 負載測試結果已寫入: {output_path}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""
+動態批次模塊
+在短時間窗口內收集可合併的 /generate 請求，以單次管道調用完成去噪
+"""
+import asyncio
+
+print("--- [MicroBatcher] 模塊開始被導入... ---", flush=True)
+
+
+class MicroBatcher:
+    """
+    微批次器。
+    相同批次鍵 (LoRA、解析度、步數等) 的請求在 window_ms 內會被合併，
+    達到 max_batch_size 時立即送出；整批交給生成執行器執行，結果再依序拆回各請求。
+    """
+    def __init__(self, executor, run_batch, window_ms=50, max_batch_size=4):
+        self.executor = executor
+        self.run_batch = run_batch  # 同步函數：run_batch(items) -> 與 items 對應的結果列表
+        self.window = max(0.0, window_ms / 1000.0)
+        self.max_batch_size = max(1, int(max_batch_size))
+        self._buckets = {}  # batch_key -> [(item, asyncio.Future)]
+        self._timers = {}
+        self.batches = 0
+        self.batched_items = 0
+        self.max_observed_batch = 0
+
+    @classmethod
+    def from_config(cls, config, executor, run_batch):
+        """從設定檔的 micro_batching 區塊建立批次器，未啟用時返回 None"""
+        batching_config = config.get('micro_batching', {}) or {}
+        if not batching_config.get('enabled', False):
+            return None
+        return cls(
+            executor, run_batch,
+            window_ms=batching_config.get('window_ms', 50),
+            max_batch_size=batching_config.get('max_batch_size', 4)
+        )
+
+    async def submit(self, batch_key, item):
+        """提交一個請求並等待所屬批次完成後的結果"""
+        # 執行器已滿時快速拒絕，而不是在窗口中等待
+        self.executor.check_capacity()
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        bucket = self._buckets.setdefault(batch_key, [])
+        bucket.append((item, future))
+        if len(bucket) >= self.max_batch_size:
+            self._flush(batch_key)
+        elif len(bucket) == 1:
+            self._timers[batch_key] = loop.call_later(self.window, self._flush, batch_key)
+        return await future
+
+    def _flush(self, batch_key):
+        timer = self._timers.pop(batch_key, None)
+        if timer is not None:
+            timer.cancel()
+        pending = self._buckets.pop(batch_key, [])
+        if not pending:
+            return
+        items = [item for item, _ in pending]
+        futures = [future for _, future in pending]
+
+        try:
+            batch_future = asyncio.wrap_future(self.executor.submit(self.run_batch, items))
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.batched_items += len(items)
+        self.max_observed_batch = max(self.max_observed_batch, len(items))
+        if len(items) > 1:
+            print(f"--- [MicroBatcher] 合併 {len(items)} 個請求為一個批次 ---", flush=True)
+
+        def _on_done(done):
+            if done.cancelled():
+                error = asyncio.CancelledError()
+            else:
+                error = done.exception()
+            for index, future in enumerate(futures):
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(done.result()[index])
+
+        batch_future.add_done_callback(_on_done)
+
+    def stats(self):
+        """返回批次統計"""
+        return {
+            "window_ms": self.window * 1000.0,
+            "max_batch_size": self.max_batch_size,
+            "batches": self.batches,
+            "batched_items": self.batched_items,
+            "average_batch_size": self.batched_items / self.batches if self.batches else 0.0,
+            "max_observed_batch": self.max_observed_batch,
+            "waiting": sum(len(bucket) for bucket in self._buckets.values()),
+        }
+
+print("--- [MicroBatcher] 模塊已成功被定義。---", flush=True)
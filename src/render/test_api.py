@@ -40,6 +40,14 @@ def test_expressions():
     print(response.json())
     return response.status_code == 200
 
+def test_loras():
+    """測試 LoRA 註冊表端點"""
+    response = requests.get(f"{API_URL}/loras")
+    print(f"獲取 LoRA 響應: {response.status_code}")
+    for lora in response.json().get("loras", []):
+        print(f"{lora['weight_name']}: {lora['format']} rank={lora['rank']} {lora['size_bytes'] / 1024**2:.1f}MB")
+    return response.status_code == 200
+
 def test_generate_image():
     """測試生成圖像端點"""
     # 請求數據
@@ -145,6 +153,109 @@ def test_generate_with_original_image():
     
     return response.status_code == 200
 
+def test_jobs(timeout=600, poll_interval=2):
+    """測試非同步任務端點：提交任務後輪詢狀態直到完成"""
+    data = {
+        "weight_name": "mushroom-16.safetensors",
+        "steps": 20,
+        "action_key": "standing",
+        "expression_key": "smiling",
+        "height": 512,
+        "width": 512
+    }
+    
+    print(f"提交任務: {json.dumps(data, indent=2)}")
+    response = requests.post(f"{API_URL}/jobs", json=data)
+    print(f"提交任務響應: {response.status_code}")
+    if response.status_code != 202:
+        print(f"提交任務失敗: {response.text}")
+        return False
+    
+    job_id = response.json()["job_id"]
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = requests.get(f"{API_URL}/jobs/{job_id}").json()
+        print(f"任務 {job_id} 狀態: {job['status']}，排隊位置: {job['queue_position']}")
+        if job["status"] == "succeeded":
+            print(f"任務耗時: {json.dumps(job['timings'], indent=2)}")
+            print(f"圖像 URL: {API_URL}/image/{job['image_path']}")
+            return True
+        if job["status"] == "failed":
+            print(f"任務失敗: {job['error']}")
+            return False
+        time.sleep(poll_interval)
+    
+    print("等待任務超時")
+    return False
+
+def test_generate_multi_lora():
+    """測試以多個 LoRA 與各自的強度組合生成圖像"""
+    data = {
+        "loras": [["dgu-01.safetensors", 0.7], ["dgu-02.safetensors", 0.3]],
+        "steps": 20,
+        "height": 512,
+        "width": 512
+    }
+    print(f"發送多 LoRA 生成請求: {json.dumps(data, indent=2)}")
+    response = requests.post(f"{API_URL}/generate", json=data)
+    print(f"多 LoRA 生成響應: {response.status_code}")
+    if response.status_code == 200:
+        result = response.json()
+        print(f"使用的 LoRA: {result['parameters']['loras']}，圖像: {result['image_path']}")
+    else:
+        print(f"多 LoRA 生成失敗: {response.text}")
+    return response.status_code == 200
+
+def test_result_cache():
+    """測試固定種子的重複請求直接返回快取的結果"""
+    if requests.get(f"{API_URL}/cache/stats").json().get("result_cache") is None:
+        print("結果快取未啟用 (result_cache.enabled: false)，略過")
+        return True
+    data = {
+        "weight_name": "dgu-01.safetensors",
+        "steps": 20,
+        "height": 512,
+        "width": 512,
+        "seed": 42
+    }
+    results = []
+    for attempt in range(2):
+        response = requests.post(f"{API_URL}/generate", json=data)
+        if response.status_code != 200:
+            print(f"生成失敗: {response.text}")
+            return False
+        results.append(response.json())
+        print(f"第 {attempt + 1} 次: {results[-1]['generation_time']:.3f}秒，快取: {results[-1]['cached']}，圖像: {results[-1]['image_path']}")
+    return results[1]["cached"]
+
+def test_gallery():
+    """測試圖庫端點的篩選與游標分頁"""
+    response = requests.get(f"{API_URL}/gallery", params={"weight_name": "dgu-01.safetensors", "limit": 2})
+    print(f"圖庫響應: {response.status_code}")
+    if response.status_code == 404:
+        print("輸出清單未啟用 (manifest.enabled: false)，略過")
+        return True
+    if response.status_code != 200:
+        return False
+    page = response.json()
+    for item in page["items"]:
+        print(f"#{item['id']} {item['image_path']} seed={item['seed']} steps={item['steps']} phash={item['phash']}")
+    if page["next_cursor"] is not None:
+        next_page = requests.get(
+            f"{API_URL}/gallery",
+            params={"weight_name": "dgu-01.safetensors", "limit": 2, "cursor": page["next_cursor"]}
+        ).json()
+        print(f"下一頁: {[item['id'] for item in next_page['items']]}")
+    return True
+
+def test_metrics():
+    """測試 Prometheus 指標端點"""
+    response = requests.get(f"{API_URL}/metrics")
+    print(f"獲取指標響應: {response.status_code}")
+    stage_lines = [line for line in response.text.splitlines() if line.startswith("mushroom_stage_seconds_sum")]
+    print("\n".join(stage_lines))
+    return response.status_code == 200 and "mushroom_stage_seconds" in response.text
+
 def main():
     """主函數"""
     print("開始測試 API...")
@@ -163,12 +274,30 @@ def main():
     # 測試獲取可用表情
     test_expressions()
     
+    # 測試 LoRA 註冊表
+    test_loras()
+    
     # 測試生成圖像
     test_generate_image()
     
     # 測試使用原始圖像生成圖像
     test_generate_with_original_image()
     
+    # 測試多 LoRA 組合
+    test_generate_multi_lora()
+    
+    # 測試生成結果快取
+    test_result_cache()
+    
+    # 測試圖庫
+    test_gallery()
+    
+    # 測試非同步任務
+    test_jobs()
+    
+    # 測試指標端點 (生成後應有各階段耗時)
+    test_metrics()
+    
     print("API 測試完成")
 
 if __name__ == "__main__":
@@ -43,6 +43,19 @@ def get_default_action_dict() -> dict[str, str]:
 def get_default_expression_dict() -> dict[str, str]:
     return {_default_expression_key: _expressions[_default_expression_key]}
 
+# 角色基本描述 (沒有參考圖像時作為提示詞前綴)
+_base_character_prompt = "a cartoon mushroom character with a light blue mushroom cap with white dots, eyes and mouth on its body, yellow feet"
+
+# 組合動作與表情的完整提示詞，未知的鍵使用預設動作 / 表情
+def build_character_prompt(action_key: str, expression_key: str) -> str:
+    action = _actions.get(action_key, _actions[_default_action_key])
+    expression = _expressions.get(expression_key, _expressions[_default_expression_key])
+    return f"{_base_character_prompt}, {action}, {expression}, consistent proportions, symmetrical features"
+
+# 所有動作 × 表情組合的提示詞 (用於預先計算提示詞嵌入)
+def get_all_character_prompts() -> list[str]:
+    return [build_character_prompt(action_key, expression_key) for action_key in _actions for expression_key in _expressions]
+
 
 # 使用詳述說明來生成提示詞
 # action_description = _actions[action_key]